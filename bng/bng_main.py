@@ -2,13 +2,24 @@
 import argparse
 import asyncio
 import ipaddress
+import itertools
 import json
 import os
+import time
 import uuid
 
 import redis.asyncio as aioredis
 
+from lib.constants import (
+    DHCP_REQUEST_COALESCE_SECONDS,
+    DHCP_SHED_HIGH_WATERMARK,
+    DHCP_SHED_LOW_WATERMARK,
+    SESSION_REPLICATION_ENABLED,
+)
+from lib.dhcp.overload import DHCPOverloadPolicy
+from lib.mailbox import Mailbox, MailboxChannel
 from lib.services.bng import bng_event_loop
+from lib.services.session_replication import SessionReplica, acquire_ownership
 
 SUBSCRIBER_IFACE = os.getenv("BNG_SUBSCRIBER_IFACE", "eth1")
 UPLINK_IFACE = os.getenv("BNG_UPLINK_IFACE", "eth2")
@@ -44,8 +55,14 @@ async def wait_for_redis(max_retries=30, delay=2) -> aioredis.Redis:
     raise RuntimeError("Could not connect to Redis")
 
 
-async def run_sniffer(bng_id: str, event_queue: asyncio.PriorityQueue):
+async def run_sniffer(bng_id: str, event_queue: MailboxChannel, event_seq: itertools.count):
     """Start the DHCP sniffer and feed its stdout JSON lines into the priority queue."""
+    overload = DHCPOverloadPolicy(
+        event_queue.maxsize,
+        low_watermark=DHCP_SHED_LOW_WATERMARK,
+        high_watermark=DHCP_SHED_HIGH_WATERMARK,
+        coalesce_seconds=DHCP_REQUEST_COALESCE_SECONDS,
+    )
     # Get DHCP server-facing MAC (mgmt interface)
     proc = await asyncio.create_subprocess_shell(
         f"cat /sys/class/net/{DHCP_UPLINK_IFACE}/address",
@@ -73,7 +90,6 @@ async def run_sniffer(bng_id: str, event_queue: asyncio.PriorityQueue):
         "--bng-id", bng_id,
     ]
 
-    seq = 0
     while True:
         sniffer = await asyncio.create_subprocess_exec(
             *cmd,
@@ -93,9 +109,13 @@ async def run_sniffer(bng_id: str, event_queue: asyncio.PriorityQueue):
                 continue
             try:
                 event = json.loads(line)
-                seq += 1
-                # Priority 1 for DHCP events; seq for FIFO ordering within same priority
-                await event_queue.put((1, seq, event))
+                # Shed before queueing, so a DISCOVER flood can't hold ACKs up behind a full queue
+                if not overload.admit(event, event_queue.qsize()):
+                    continue
+                # Start of the ACK's time-to-online (ack_to_forwarding_ms)
+                event["received_at"] = time.monotonic()
+                # Priority by message type; seq for FIFO ordering within same priority
+                await event_queue.put((overload.priority(event), next(event_seq), event))
             except Exception:
                 continue
 
@@ -139,10 +159,20 @@ async def async_main():
     # Connect to Redis for session events stream
     redis_client = await wait_for_redis()
 
-    event_queue: asyncio.PriorityQueue = asyncio.PriorityQueue(maxsize=1000)
+    # The event loop's mailbox; its commands and the session shards' queues are channels of their own
+    event_queue = Mailbox().channel(maxsize=1000)
+    # Sniffer and Kea lease events share priority 1, so they must not share sequence numbers either
+    event_seq = itertools.count(1)
+
+    replica = None
+    if SESSION_REPLICATION_ENABLED:
+        # Standby until the owner key for this bng_id is ours; the sniffer must not relay in the meantime
+        replica = SessionReplica(redis_client, args.bng_id)
+        await acquire_ownership(redis_client, args.bng_id, bng_instance_id, replica)
+        print(f"BNG active for bng_id={args.bng_id} with {len(replica.sessions)} replicated sessions")
 
     # Start sniffer as background task (replaces thread + tail -F)
-    sniffer_task = asyncio.create_task(run_sniffer(bng_id=args.bng_id, event_queue=event_queue))
+    sniffer_task = asyncio.create_task(run_sniffer(bng_id=args.bng_id, event_queue=event_queue, event_seq=event_seq))
 
     print("Starting BNG event loop")
     await bng_event_loop(
@@ -157,6 +187,8 @@ async def async_main():
         bng_id=args.bng_id,
         bng_instance_id=bng_instance_id,
         redis_conn=redis_client,
+        event_seq=event_seq,
+        replica=replica,
     )
 
 
@@ -1,3 +1,5 @@
+import os
+
 DHCP_LEASE_FILE_DIR_PATH = "/tmp/dnsmasq"
 DHCP_LEASE_FILE_PATH = DHCP_LEASE_FILE_DIR_PATH + "/dnsmasq-bng.leases"
 DHCP_GRACE_SECONDS = 10
@@ -15,3 +17,68 @@ TOMBSTONE_EXPIRY_GRACE_SECONDS = 60
 
 # Event dispatcher settings
 EVENT_DISPATCHER_STREAM_ID = "bng_events"
+
+# nftables accounting data plane
+#   "rules": per-subscriber counter rules in the `bngacct sess` chain (linear in subscriber count)
+#   "set":   per-element counters in the `sub_up`/`sub_down` sets keyed by IPv4 address (O(1) per packet)
+NFT_ACCOUNTING_MODE = os.getenv("BNG_NFT_ACCOUNTING_MODE", "rules")
+NFT_ACCOUNTING_SET_SIZE = 65535
+# How long one nftables counter dump is shared between interim/reconcile/terminate consumers
+NFT_COUNTER_SNAPSHOT_TTL_SECONDS = float(os.getenv("BNG_NFT_COUNTER_SNAPSHOT_TTL_SECONDS", "1.0"))
+
+# In-process RADIUS client
+RADIUS_CLIENT_POOL_SIZE = int(os.getenv("BNG_RADIUS_CLIENT_POOL_SIZE", "4")) # UDP sockets per server, 256 requests in flight each
+RADIUS_CLIENT_TIMEOUT_SECONDS = float(os.getenv("BNG_RADIUS_CLIENT_TIMEOUT_SECONDS", "1.0")) # Per attempt
+RADIUS_CLIENT_RETRIES = int(os.getenv("BNG_RADIUS_CLIENT_RETRIES", "2"))
+# Interim-Update accounting: max Acct-Interim requests (and their event dispatches) in flight per tick
+RADIUS_INTERIM_WINDOW = int(os.getenv("BNG_RADIUS_INTERIM_WINDOW", "64"))
+# Share of the interim interval one batch of due Acct-Interims may hold its shard for (at least one RADIUS
+# attempt); sessions still unsent then are skipped until their next interval
+RADIUS_INTERIM_BUDGET_FRACTION = float(os.getenv("BNG_RADIUS_INTERIM_BUDGET_FRACTION", "0.1"))
+# Bulk session bring-up (reconcile discovering many leases, cold start): sessions per nft transaction / tc batch,
+# and Access-Requests / Acct-Starts in flight at once
+SESSION_BRINGUP_BATCH = int(os.getenv("BNG_SESSION_BRINGUP_BATCH", "512"))
+SESSION_BRINGUP_RADIUS_WINDOW = int(os.getenv("BNG_SESSION_BRINGUP_RADIUS_WINDOW", "64"))
+# Sessions are split by a hash of (circuit_id, remote_id) across this many session shards, each with its own
+# session maps, timers and event/command queues, so one subscriber's slow RADIUS or tc call only holds up its shard
+SESSION_SHARDS = max(1, int(os.getenv("BNG_SESSION_SHARDS", "1")))
+# Most events and commands an event loop takes from its mailbox per wakeup; authed_ips and the session
+# journal are flushed once per batch
+MAILBOX_DRAIN_MAX = max(1, int(os.getenv("BNG_MAILBOX_DRAIN_MAX", "64")))
+# DHCP overload control, as fractions of the event queue's bound: past the low watermark DISCOVER/INFORM are shed
+# and retransmitted REQUESTs (same subscriber within the coalesce window) dropped, past the high one every REQUEST
+DHCP_SHED_LOW_WATERMARK = float(os.getenv("BNG_DHCP_SHED_LOW_WATERMARK", "0.5"))
+DHCP_SHED_HIGH_WATERMARK = float(os.getenv("BNG_DHCP_SHED_HIGH_WATERMARK", "0.9"))
+DHCP_REQUEST_COALESCE_SECONDS = float(os.getenv("BNG_DHCP_REQUEST_COALESCE_SECONDS", "2.0"))
+# Reconcile requests are coalesced; at most one Kea reconcile per this many seconds
+RECONCILE_MIN_SPACING_SECONDS = float(os.getenv("BNG_RECONCILE_MIN_SPACING_SECONDS", "1.0"))
+
+# Kea lease sync
+#   BNG_KEA_SUBNET_IDS:    comma-separated Kea subnet ids of this BNG's pools, empty fetches every subnet
+#   BNG_KEA_LEASE_PAGE_SIZE: > 0 pages through leases with lease4-get-page instead of one lease4-get-all
+KEA_SUBNET_IDS = [int(i) for i in os.getenv("BNG_KEA_SUBNET_IDS", "").split(",") if i.strip()]
+KEA_LEASE_PAGE_SIZE = int(os.getenv("BNG_KEA_LEASE_PAGE_SIZE", "0"))
+# Kea control agent HTTP: keep-alive connection, per-attempt timeouts, retries with exponential backoff
+KEA_HTTP_CONNECT_TIMEOUT_SECONDS = float(os.getenv("BNG_KEA_HTTP_CONNECT_TIMEOUT_SECONDS", "3.0"))
+KEA_HTTP_READ_TIMEOUT_SECONDS = float(os.getenv("BNG_KEA_HTTP_READ_TIMEOUT_SECONDS", "10.0")) # Per read, not per response
+KEA_HTTP_RETRIES = int(os.getenv("BNG_KEA_HTTP_RETRIES", "2"))
+KEA_HTTP_RETRY_BACKOFF_SECONDS = float(os.getenv("BNG_KEA_HTTP_RETRY_BACKOFF_SECONDS", "0.5"))
+# Push-based lease events from Kea, one Redis stream per relay_id ("<prefix>:<relay_id>").
+# With BNG_KEA_LEASE_EVENTS=1 there is no periodic reconcile or anti-entropy: changes arrive as events
+KEA_LEASE_EVENTS_ENABLED = os.getenv("BNG_KEA_LEASE_EVENTS", "0") == "1"
+KEA_LEASE_EVENT_STREAM_PREFIX = os.getenv("BNG_KEA_LEASE_EVENT_STREAM_PREFIX", "kea_lease_events")
+KEA_LEASE_EVENT_STREAM_MAXLEN = int(os.getenv("BNG_KEA_LEASE_EVENT_STREAM_MAXLEN", "100000"))
+# Sessions are reconciled against the sniffed lease cache; Kea is compared against it this often
+KEA_ANTI_ENTROPY_INTERVAL_SECONDS = int(os.getenv("BNG_KEA_ANTI_ENTROPY_INTERVAL_SECONDS", "300"))
+# Warm restart: the session table is checkpointed to a local file every BNG_SESSION_CHECKPOINT_INTERVAL_SECONDS
+# (0 disables) and on shutdown. With BNG_WARM_RESTART=1 a restarted BNG re-adopts the checkpointed sessions whose
+# nft rules and tc classes are still in the kernel, and only re-authorizes the ones that diverged
+WARM_RESTART_ENABLED = os.getenv("BNG_WARM_RESTART", "0") == "1"
+SESSION_CHECKPOINT_INTERVAL_SECONDS = int(os.getenv("BNG_SESSION_CHECKPOINT_INTERVAL_SECONDS", "30"))
+# Hot-standby session replication. With BNG_SESSION_REPLICATION=1 the active BNG journals every session change to Redis
+# ("<prefix>:<bng_id>" stream plus a ":sessions" hash); a BNG started with the same id waits as a standby, tails the
+# journal and takes over without RADIUS once the active one stops renewing its owner key
+SESSION_REPLICATION_ENABLED = os.getenv("BNG_SESSION_REPLICATION", "0") == "1"
+SESSION_JOURNAL_PREFIX = os.getenv("BNG_SESSION_JOURNAL_PREFIX", "bng_session_journal")
+SESSION_JOURNAL_MAXLEN = int(os.getenv("BNG_SESSION_JOURNAL_MAXLEN", "100000"))
+SESSION_OWNER_TTL_SECONDS = float(os.getenv("BNG_SESSION_OWNER_TTL_SECONDS", "3.0")) # Failure detection time
@@ -0,0 +1,120 @@
+import time
+from dataclasses import dataclass
+from typing import Dict, List, Tuple
+
+from lib.dhcp.lease import DHCPLease
+from lib.dhcp.lease_service import LeaseService
+
+LeaseKey = Tuple[str, str, str] # (relay_id, circuit_id, remote_id)
+
+# Sniffed expiry is computed from the ACK's arrival, Kea's from cltt; allow for the skew
+EXPIRY_TOLERANCE_SECONDS = 5
+
+
+@dataclass
+class LeaseDivergence:
+    key: LeaseKey
+    kind: str # "missing": Kea only, "stale": cache only, "mismatch": both but different
+    cached: DHCPLease | None
+    kea: DHCPLease | None
+
+
+class SniffedLeaseCache(LeaseService):
+    """
+    This BNG's active leases, maintained from the DHCP ACKs and RELEASEs the sniffer sees.
+
+    The BNG relays every DHCP exchange for its subscribers, so this is authoritative for the hot path
+    and the reconciler reads it instead of Kea. Kea is only consulted by the slow anti-entropy pass
+    (`diff` + `apply`), which catches anything the sniffer missed, e.g. leases granted while the BNG
+    was down.
+    """
+
+    def __init__(self, relay_id: str) -> None:
+        self.relay_id = relay_id
+        self._by_key: Dict[LeaseKey, DHCPLease] = {}
+        self._key_by_ip: Dict[str, LeaseKey] = {}
+
+    def __len__(self) -> int:
+        return len(self._by_key)
+
+    def get(self, key: LeaseKey) -> DHCPLease | None:
+        return self._by_key.get(key)
+
+    def _put(self, key: LeaseKey, lease: DHCPLease) -> None:
+        old = self._by_key.get(key)
+        if old is not None and self._key_by_ip.get(old.ip) == key:
+            self._key_by_ip.pop(old.ip, None)
+
+        # An IP belongs to one subscriber; a new holder evicts the previous one
+        previous_holder = self._key_by_ip.get(lease.ip)
+        if previous_holder is not None and previous_holder != key:
+            self._by_key.pop(previous_holder, None)
+
+        self._by_key[key] = lease
+        self._key_by_ip[lease.ip] = key
+
+    def _drop(self, key: LeaseKey) -> DHCPLease | None:
+        lease = self._by_key.pop(key, None)
+        if lease is not None and self._key_by_ip.get(lease.ip) == key:
+            self._key_by_ip.pop(lease.ip, None)
+        return lease
+
+    def on_ack(self, circuit_id: str, remote_id: str, ip: str, mac: str, expiry: int, now: float | None = None) -> None:
+        now = time.time() if now is None else now
+        self._put(
+            (self.relay_id, circuit_id, remote_id),
+            DHCPLease(
+                ip=ip,
+                mac=mac,
+                expiry_for=max(0, int(expiry - now)),
+                expiry=expiry,
+                relay_id=self.relay_id,
+                remote_id=remote_id,
+                circuit_id=circuit_id,
+                last_state_update_ts=now,
+                _kea_state=0,
+            ),
+        )
+
+    def on_release(self, ip: str) -> None:
+        key = self._key_by_ip.get(ip)
+        if key is not None:
+            self._drop(key)
+
+    def prune(self, now: float | None = None) -> List[LeaseKey]:
+        """Drops leases past their expiry. returns: the dropped keys"""
+        now = time.time() if now is None else now
+        expired = [key for key, lease in self._by_key.items() if lease.expiry <= now]
+        for key in expired:
+            self._drop(key)
+        return expired
+
+    async def get_all_leases(self) -> list[DHCPLease]:
+        self.prune()
+        return list(self._by_key.values())
+
+    def diff(self, kea_leases: List[DHCPLease]) -> List[LeaseDivergence]:
+        """Compares the cache against Kea's active leases for this relay."""
+        kea_by_key = {(l.relay_id, l.circuit_id, l.remote_id): l for l in kea_leases if l._kea_state == 0}
+        divergences: List[LeaseDivergence] = []
+
+        for key, kea in kea_by_key.items():
+            cached = self._by_key.get(key)
+            if cached is None:
+                divergences.append(LeaseDivergence(key, "missing", None, kea))
+            elif cached.ip != kea.ip or abs(cached.expiry - kea.expiry) > EXPIRY_TOLERANCE_SECONDS:
+                divergences.append(LeaseDivergence(key, "mismatch", cached, kea))
+
+        for key, cached in self._by_key.items():
+            if key not in kea_by_key:
+                divergences.append(LeaseDivergence(key, "stale", cached, None))
+
+        return divergences
+
+    def apply(self, divergences: List[LeaseDivergence]) -> None:
+        """Repairs the cache to Kea's view for the given divergences."""
+        for d in divergences:
+            if d.kea is None:
+                self._drop(d.key)
+            else:
+                self._put(d.key, d.kea)
@@ -0,0 +1,160 @@
+import asyncio
+from dataclasses import dataclass
+from typing import Awaitable, Callable, Dict
+
+import redis.asyncio as aioredis
+
+from lib.constants import KEA_LEASE_EVENT_STREAM_MAXLEN, KEA_LEASE_EVENT_STREAM_PREFIX
+from lib.dhcp.lease_service import _parse_relay_agent_info
+
+# Lease event kinds, as published by Kea (hook or lease-backend sidecar) or the fake publisher
+LEASE_EVENT_ADD = "add"
+LEASE_EVENT_UPDATE = "update"
+LEASE_EVENT_EXPIRE = "expire"
+LEASE_EVENT_RELEASE = "release"
+LEASE_EVENT_KINDS = (LEASE_EVENT_ADD, LEASE_EVENT_UPDATE, LEASE_EVENT_EXPIRE, LEASE_EVENT_RELEASE)
+
+
+def lease_event_stream(relay_id: str) -> str:
+    return f"{KEA_LEASE_EVENT_STREAM_PREFIX}:{relay_id}"
+
+
+@dataclass
+class LeaseEvent:
+    kind: str
+    ip: str
+    mac: str
+    relay_id: str
+    circuit_id: str
+    remote_id: str
+    cltt: int
+    valid_lft: int
+    subnet_id: int = 0
+
+    @property
+    def expiry(self) -> int:
+        return self.cltt + self.valid_lft
+
+    def to_fields(self) -> Dict[str, str]:
+        return {
+            "kind": self.kind,
+            "ip": self.ip,
+            "mac": self.mac,
+            "relay_id": self.relay_id,
+            "circuit_id": self.circuit_id,
+            "remote_id": self.remote_id,
+            "cltt": str(self.cltt),
+            "valid_lft": str(self.valid_lft),
+            "subnet_id": str(self.subnet_id),
+        }
+
+    @classmethod
+    def from_fields(cls, fields: dict) -> "LeaseEvent":
+        def field(name: str) -> str:
+            value = fields.get(name, fields.get(name.encode(), ""))
+            return value.decode(errors="replace") if isinstance(value, bytes) else str(value)
+
+        kind = field("kind")
+        if kind not in LEASE_EVENT_KINDS:
+            raise ValueError(f"unknown lease event kind: {kind!r}")
+
+        return cls(
+            kind=kind,
+            ip=field("ip"),
+            mac=field("mac"),
+            relay_id=field("relay_id"),
+            circuit_id=field("circuit_id"),
+            remote_id=field("remote_id"),
+            cltt=int(field("cltt") or 0),
+            valid_lft=int(field("valid_lft") or 0),
+            subnet_id=int(field("subnet_id") or 0),
+        )
+
+    @classmethod
+    def from_kea_lease(cls, kind: str, data: dict) -> "LeaseEvent | None":
+        """From a Kea lease4 JSON object (lease4-get-*, lease hooks). returns: None if it has no usable option 82"""
+        user_ctx = data.get("user-context") or {}
+        relay_info = (user_ctx.get("ISC") or {}).get("relay-agent-info")
+        sub_options = relay_info.get("sub-options") if isinstance(relay_info, dict) else relay_info
+        if not sub_options:
+            return None
+
+        relay_id, circuit_id, remote_id = _parse_relay_agent_info(sub_options)
+        if not relay_id or not circuit_id or not remote_id:
+            return None
+
+        return cls(
+            kind=kind,
+            ip=data.get("ip-address", ""),
+            mac=data.get("hw-address", ""),
+            relay_id=relay_id,
+            circuit_id=circuit_id,
+            remote_id=remote_id,
+            cltt=int(data.get("cltt", 0)),
+            valid_lft=int(data.get("valid-lft", 0)),
+            subnet_id=int(data.get("subnet-id", 0)),
+        )
+
+
+class LeaseEventPublisher:
+    """Publishes lease events to the per-relay_id Redis stream the BNG owning that relay consumes."""
+
+    def __init__(self, redis_conn: aioredis.Redis, maxlen: int = KEA_LEASE_EVENT_STREAM_MAXLEN) -> None:
+        self.redis_conn = redis_conn
+        self.maxlen = maxlen
+
+    async def publish(self, event: LeaseEvent) -> str:
+        """returns: the stream entry id"""
+        entry_id = await self.redis_conn.xadd(
+            lease_event_stream(event.relay_id),
+            event.to_fields(),
+            maxlen=self.maxlen,
+            approximate=True,
+        )
+        return entry_id.decode() if isinstance(entry_id, bytes) else entry_id
+
+
+async def consume_lease_events(
+    redis_conn: aioredis.Redis,
+    relay_id: str,
+    on_event: Callable[[LeaseEvent], Awaitable[None]],
+    *,
+    on_resync: Callable[[], Awaitable[None]],
+    block_ms: int = 5000,
+    batch: int = 256,
+) -> None:
+    """
+    Tails this relay's lease event stream and hands each event to `on_event`, in stream order.
+
+    Reading starts at the stream's current tail; whatever happened before is covered by the Kea
+    anti-entropy pass the BNG runs at startup. After a Redis error `on_resync` is awaited, since
+    entries may have been trimmed away while disconnected, and reading resumes where it stopped.
+    """
+    stream = lease_event_stream(relay_id)
+    last_id: str | None = None
+
+    while True:
+        try:
+            if last_id is None:
+                latest = await redis_conn.xrevrange(stream, count=1)
+                last_id = latest[0][0].decode() if latest else "0-0"
+
+            reply = await redis_conn.xread({stream: last_id}, count=batch, block=block_ms)
+            for _, entries in reply or []:
+                for entry_id, fields in entries:
+                    last_id = entry_id.decode() if isinstance(entry_id, bytes) else entry_id
+                    try:
+                        event = LeaseEvent.from_fields(fields)
+                    except (ValueError, TypeError) as e:
+                        print(f"Lease events: dropping malformed entry {last_id}: {e}")
+                        continue
+                    await on_event(event)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"Lease events: stream {stream} read error: {e}, resyncing in 2s")
+            await asyncio.sleep(2)
+            try:
+                await on_resync()
+            except Exception as resync_error:
+                print(f"Lease events: resync failed: {resync_error}")
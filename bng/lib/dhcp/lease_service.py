@@ -1,11 +1,16 @@
-import asyncio
 import functools
 from abc import ABC, abstractmethod
 from dataclasses import dataclass
-from typing import Tuple
-import requests
-
+from typing import Callable, Dict, List, Tuple
+
+from lib.constants import (
+    KEA_HTTP_CONNECT_TIMEOUT_SECONDS,
+    KEA_HTTP_READ_TIMEOUT_SECONDS,
+    KEA_HTTP_RETRIES,
+    KEA_HTTP_RETRY_BACKOFF_SECONDS,
+)
 from lib.dhcp.lease import DHCPLease
+from lib.http.client import AsyncHTTPClient, stream_json_array
 from lib.secrets import __KEA_CTRL_AGENT_PASSWORD
 from lib.dhcp.utils import parse_network_tlv
 
@@ -18,88 +23,218 @@ class LeaseService(ABC):
         ...
 
 class KeaClient:
+    """
+    Kea control agent client over a persistent keep-alive HTTP connection.
+
+    Lease lists are decoded as they arrive and handed to `on_lease` one at a time, so a large
+    lease4-get-all never has to sit in memory as one response body plus its parsed copy.
+    """
+
     def __init__(self, base_url: str, auth_key: str) -> None:
         self.base_url = base_url
         self.auth_key = auth_key
-
-    async def get_leases(self) -> Tuple[list[dict], bool]:
-        loop = asyncio.get_running_loop()
-        def _sync_get():
-            url = f"{self.base_url}/leases"
-            headers = {
-                "Content-Type": "application/json"
-            }
-            response = requests.post(
-                url,
-                headers=headers,
-                auth=('bng', self.auth_key),
-                json={
-                    "command": "lease4-get-all",
-                    "service": ["dhcp4"]
-                }
-            )
-            response.raise_for_status()
-            return response.json()
-
-        response = await loop.run_in_executor(None, _sync_get)
+        self.http = AsyncHTTPClient(
+            base_url,
+            auth=("bng", auth_key),
+            connect_timeout=KEA_HTTP_CONNECT_TIMEOUT_SECONDS,
+            read_timeout=KEA_HTTP_READ_TIMEOUT_SECONDS,
+            retries=KEA_HTTP_RETRIES,
+            backoff=KEA_HTTP_RETRY_BACKOFF_SECONDS,
+        )
+
+    async def _command(
+        self,
+        command: str,
+        arguments: dict | None = None,
+        on_lease: Callable[[dict], None] | None = None,
+    ) -> dict | None:
+        """
+        Leases in the reply are passed to `on_lease` as they are decoded and left out of the result.
+        returns: the dhcp4 service's response object, None if the reply was malformed
+        """
+        body = {
+            "command": command,
+            "service": ["dhcp4"],
+        }
+        if arguments:
+            body["arguments"] = arguments
+
+        def _on_item(item) -> None:
+            if on_lease is not None and isinstance(item, dict):
+                on_lease(item)
+
+        response = await self.http.request("POST", "/leases", json_body=body)
+        try:
+            result = await stream_json_array(response.iter_chunks(), "leases", _on_item)
+        except ValueError as e: # Includes json.JSONDecodeError and bad UTF-8
+            print(f"KeaClient: malformed {command} reply: {e}")
+            return None
 
         try:
-            leases = response[0]["arguments"]["leases"]
+            return result[0]
         except (KeyError, IndexError, TypeError):
-            return [], False
-        if not isinstance(leases, list):
-            return [], False
-        return leases, True
+            return None
+
+    async def get_leases(self, on_lease: Callable[[dict], None], subnets: List[int] | None = None) -> bool:
+        """lease4-get-all, limited to `subnets` (Kea subnet ids) if given. returns: success"""
+        response = await self._command("lease4-get-all", {"subnets": subnets} if subnets else None, on_lease)
+        try:
+            return response["result"] in (0, 3) # 3: no leases
+        except (KeyError, TypeError):
+            return False
+
+    async def get_leases_paged(self, on_lease: Callable[[dict], None], page_size: int) -> bool:
+        """lease4-get-page over the whole lease database, `page_size` leases per request. returns: success"""
+        cursor = "start"
+        while True:
+            page_count = 0
+            last_ip = None
+
+            def _on_page_lease(data: dict) -> None:
+                nonlocal page_count, last_ip
+                page_count += 1
+                last_ip = data.get("ip-address")
+                on_lease(data)
+
+            response = await self._command("lease4-get-page", {"from": cursor, "limit": page_size}, _on_page_lease)
+            if response is None:
+                return False
+            if response.get("result") == 3: # Empty: no leases past the cursor
+                return True
+            if response.get("result") != 0 or last_ip is None:
+                return False
+
+            if page_count < page_size:
+                return True
+            cursor = last_ip
+
+    def close(self) -> None:
+        self.http.close()
+
+
+@functools.lru_cache(maxsize=65536)
+def _parse_relay_agent_info(sub_options: str) -> Tuple[str | None, str | None, str | None]:
+    # Memoized on the raw sub-options hex; a subscriber's option 82 doesn't change between reconciles
+    parsed_opt82 = parse_network_tlv(sub_options)
+    return parsed_opt82.get("relay_id"), parsed_opt82.get("circuit_id"), parsed_opt82.get("remote_id")
+
+
+@dataclass
+class _LeaseMemo:
+    cltt: int
+    state: int
+    valid_lft: int
+    lease: DHCPLease | None # None: lease belongs to another BNG or lacks option 82
+
 
 class KeaLeaseService(LeaseService):
-    def __init__(self, kea_client: KeaClient, bng_relay_id: str) -> None:
+    """
+    Keeps this BNG's view of Kea's leases in sync.
+
+    Leases are fetched subnet-scoped (or paged) and every lease is remembered by IP together with the
+    cltt it was parsed at. A lease at or below the cltt watermark whose cltt/state/lifetime are unchanged
+    reuses its previous result, so only leases that changed since the last sync are decoded again.
+    """
+
+    def __init__(
+        self,
+        kea_client: KeaClient,
+        bng_relay_id: str,
+        subnets: List[int] | None = None,
+        page_size: int = 0,
+    ) -> None:
         self.kea_client = kea_client
         self.relay_id = bng_relay_id
+        self.subnets = subnets or []
+        self.page_size = page_size
+        self.cltt_watermark = 0
+        self._memo: Dict[str, _LeaseMemo] = {}
+        self.last_sync_changed = 0
+
+    async def _fetch(self, on_lease: Callable[[dict], None]) -> bool:
+        if self.page_size > 0:
+            if not self.subnets:
+                return await self.kea_client.get_leases_paged(on_lease, self.page_size)
+            wanted = set(self.subnets)
+
+            def _in_subnets(data: dict) -> None:
+                if data.get("subnet-id") in wanted:
+                    on_lease(data)
+
+            return await self.kea_client.get_leases_paged(_in_subnets, self.page_size)
+        return await self.kea_client.get_leases(on_lease, self.subnets)
+
+    def _to_lease(self, data: dict) -> DHCPLease | None:
+        user_ctx = data.get("user-context") or {}
+        isc_ctx = user_ctx.get("ISC") or {}
+        relay_info = isc_ctx.get("relay-agent-info")
+        sub_options = None
+        if isinstance(relay_info, dict):
+            sub_options = relay_info.get("sub-options")
+        elif isinstance(relay_info, str):
+            sub_options = relay_info
+        if not sub_options:
+            return None
+
+        relay_id, circuit_id, remote_id = _parse_relay_agent_info(sub_options)
+        if not relay_id or not circuit_id or not remote_id:
+            return None
+
+        if relay_id != self.relay_id:
+            return None
+
+        return DHCPLease(
+            ip=data.get("ip-address", ""),
+            mac=data.get("hw-address", ""),
+
+            expiry_for=data.get("valid-lifetime", None),
+            expiry=data["cltt"]+data["valid-lft"],
+
+            remote_id=remote_id,
+            relay_id=relay_id,
+            circuit_id=circuit_id,
+
+            last_state_update_ts=data["cltt"],
+            _kea_state=data.get("state", -1),
+        )
 
     async def get_all_leases(self) -> list[DHCPLease]:
-        leases_data, success = await self.kea_client.get_leases()
-        if not success:
-            raise Exception("Failed to get leases from Kea")
-
+        memo: Dict[str, _LeaseMemo] = {}
+        watermark = self.cltt_watermark
+        changed = 0
         leases = []
-        for data in leases_data:
+
+        # Runs per lease while the reply is still streaming in
+        def on_lease(data: dict) -> None:
+            nonlocal watermark, changed
             if data.get("state", -1) != 0:
-                continue
-
-            user_ctx = data.get("user-context") or {}
-            isc_ctx = user_ctx.get("ISC") or {}
-            relay_info = isc_ctx.get("relay-agent-info")
-            sub_options = None
-            if isinstance(relay_info, dict):
-                sub_options = relay_info.get("sub-options")
-            elif isinstance(relay_info, str):
-                sub_options = relay_info
-            if not sub_options:
-                continue
-
-            parsed_opt82 = parse_network_tlv(sub_options)
-            relay_id = parsed_opt82.get("relay_id")
-            circuit_id = parsed_opt82.get("circuit_id")
-            remote_id = parsed_opt82.get("remote_id")
-            if not relay_id or not circuit_id or not remote_id:
-                continue
-
-            if relay_id != self.relay_id:
-                continue
-
-            lease = DHCPLease(
-                ip=data.get("ip-address", ""),
-                mac=data.get("hw-address", ""),
-
-                expiry_for=data.get("valid-lifetime", None),
-                expiry=data["cltt"]+data["valid-lft"],
-
-                remote_id=remote_id,
-                relay_id=relay_id,
-                circuit_id=circuit_id,
-
-                last_state_update_ts=data["cltt"],
-                _kea_state=data.get("state", -1),
-            )
-            leases.append(lease)
+                return
+
+            ip = data.get("ip-address", "")
+            cltt = data.get("cltt", 0)
+            valid_lft = data.get("valid-lft", 0)
+
+            entry = self._memo.get(ip)
+            if (
+                entry is None
+                or cltt > self.cltt_watermark
+                or entry.cltt != cltt
+                or entry.state != 0
+                or entry.valid_lft != valid_lft
+            ):
+                entry = _LeaseMemo(cltt=cltt, state=0, valid_lft=valid_lft, lease=self._to_lease(data))
+                changed += 1
+
+            memo[ip] = entry
+            watermark = max(watermark, cltt)
+            if entry.lease is not None:
+                leases.append(entry.lease)
+
+        if not await self._fetch(on_lease):
+            raise Exception("Failed to get leases from Kea")
+
+        # Leases gone from Kea drop out of the memo with the rebuild
+        self._memo = memo
+        self.cltt_watermark = watermark
+        self.last_sync_changed = changed
         return leases
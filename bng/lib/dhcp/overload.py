@@ -0,0 +1,92 @@
+import time
+from typing import Any, Dict, Tuple
+
+from lib.services.bng_metrics import get_metrics
+
+DHCP_MSG_REQUEST = 3
+DHCP_MSG_ACK = 5
+DHCP_MSG_NAK = 6
+DHCP_MSG_RELEASE = 7
+
+# Messages that create, end or refuse a session; never shed
+DHCP_ESSENTIAL_MSG_TYPES = frozenset({DHCP_MSG_ACK, DHCP_MSG_NAK, DHCP_MSG_RELEASE})
+
+DHCP_MSG_NAMES = {1: "discover", 2: "offer", 3: "request", 4: "decline", 5: "ack", 6: "nak", 7: "release", 8: "inform"}
+
+# event_queue priorities for sniffed messages. REQUEST stays with ACK: the ACK needs the session its REQUEST creates
+DHCP_PRIORITY = 1
+DHCP_LOW_VALUE_PRIORITY = 5 # DISCOVER, INFORM and the rest the BNG doesn't act on, behind session timers
+
+
+class DHCPOverloadPolicy:
+    """
+    Decides whether a sniffed DHCP message is queued, and at which priority, from how full its queue is.
+
+    Below `low_watermark` everything is queued. Past it, DISCOVER/INFORM and other messages the BNG doesn't act
+    on are shed, and a REQUEST for a subscriber whose REQUEST was queued within `coalesce_seconds` is dropped as
+    a retransmit. Past `high_watermark` every REQUEST is shed too; its ACK still carries the lease, and the
+    scoped reconcile brings the session up from it. ACK/NAK/RELEASE are always queued, waiting for room if need be.
+    Watermarks are fractions of `capacity`, the queue's bound; 0 turns shedding off. Every shed message is
+    counted in `dhcp_shed` and `dhcp_shed_<type>`; coalesced REQUESTs also in `dhcp_coalesced_request`.
+    """
+
+    def __init__(
+        self,
+        capacity: int,
+        *,
+        low_watermark: float,
+        high_watermark: float,
+        coalesce_seconds: float,
+    ) -> None:
+        self.capacity = capacity
+        self.low = int(capacity * low_watermark)
+        self.high = int(capacity * high_watermark)
+        self.coalesce_seconds = coalesce_seconds
+        # (circuit_id, remote_id) -> when its last REQUEST was queued, oldest first
+        self._requests: Dict[Tuple[Any, Any], float] = {}
+        self._metrics = get_metrics()
+
+    def priority(self, event: dict) -> int:
+        msg_type = event.get("msg_type")
+        if msg_type in DHCP_ESSENTIAL_MSG_TYPES or msg_type == DHCP_MSG_REQUEST:
+            return DHCP_PRIORITY
+        return DHCP_LOW_VALUE_PRIORITY
+
+    def admit(self, event: dict, depth: int) -> bool:
+        """
+        `depth` is how many events are waiting in the queue now
+        returns: whether to queue the message; False means it was shed and counted
+        """
+        msg_type = event.get("msg_type")
+        if msg_type in DHCP_ESSENTIAL_MSG_TYPES or self.capacity <= 0:
+            return True
+
+        if msg_type != DHCP_MSG_REQUEST:
+            if depth < self.low:
+                return True
+            return self._shed(msg_type)
+
+        if depth >= self.high:
+            return self._shed(msg_type)
+
+        now = time.monotonic()
+        while self._requests:
+            # Insertion order is queue time order, so stale entries are at the front
+            oldest_key = next(iter(self._requests))
+            if now - self._requests[oldest_key] < self.coalesce_seconds:
+                break
+            del self._requests[oldest_key]
+
+        key = (event.get("circuit_id"), event.get("remote_id"))
+        if depth >= self.low and key in self._requests:
+            self._metrics.incr("dhcp_coalesced_request")
+            return self._shed(msg_type)
+
+        self._requests.pop(key, None)
+        self._requests[key] = now
+        return True
+
+    def _shed(self, msg_type: Any) -> bool:
+        self._metrics.incr("dhcp_shed")
+        self._metrics.incr(f"dhcp_shed_{DHCP_MSG_NAMES.get(msg_type, 'other')}")
+        return False
@@ -0,0 +1,57 @@
+import asyncio
+from typing import Awaitable, Callable, Generic, List, Sequence, Tuple, TypeVar
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+
+class GroupCommit(Generic[T, R]):
+    """
+    Funnels one-item calls from concurrent callers into calls of a batch function.
+
+    Items submitted while no batch is running go out together on the next loop iteration. Items submitted
+    while a batch is in flight go out together right after it. A lone caller pays one loop iteration; a
+    busy service makes one round trip per batch instead of one per item.
+
+    `run_batch` gets the items in submission order and returns one result per item, in the same order.
+    If it raises, every item of that batch gets the exception.
+    """
+
+    def __init__(self, run_batch: Callable[[List[T]], Awaitable[Sequence[R]]]) -> None:
+        self._run_batch = run_batch
+        self._pending: List[Tuple[T, asyncio.Future]] = []
+        self._drainer: asyncio.Task | None = None
+
+    async def submit(self, item: T) -> R:
+        """returns: the item's result from its batch"""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((item, future))
+        if self._drainer is None:
+            self._drainer = loop.create_task(self._drain())
+        return await future
+
+    async def _drain(self) -> None:
+        try:
+            while self._pending:
+                batch, self._pending = self._pending, []
+                try:
+                    results = await self._run_batch([item for item, _ in batch])
+                except Exception as e:
+                    for _, future in batch:
+                        if not future.done():
+                            future.set_exception(e)
+                    continue
+                except BaseException:
+                    # Cancelled: nothing would ever answer this batch or the ones waiting behind it
+                    batch, self._pending = batch + self._pending, []
+                    for _, future in batch:
+                        if not future.done():
+                            future.set_exception(RuntimeError("batch was cancelled"))
+                    raise
+                for (_, future), result in zip(batch, results):
+                    # A caller that was cancelled meanwhile has no one waiting on its result
+                    if not future.done():
+                        future.set_result(result)
+        finally:
+            self._drainer = None
@@ -0,0 +1,301 @@
+import asyncio
+import base64
+import codecs
+import json
+from typing import AsyncIterator, Callable, Dict, List, Tuple
+from urllib.parse import urlsplit
+
+_READ_CHUNK = 64 * 1024
+
+
+class HTTPError(Exception):
+    def __init__(self, message: str, status: int | None = None) -> None:
+        super().__init__(message)
+        self.status = status
+
+
+class _Connection:
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        self.reader = reader
+        self.writer = writer
+
+    def close(self) -> None:
+        self.writer.close()
+
+
+class HTTPResponse:
+    """A response whose body is read incrementally; the connection is returned once the body is consumed."""
+
+    def __init__(self, client: "AsyncHTTPClient", conn: _Connection, status: int, headers: Dict[str, str]) -> None:
+        self._client = client
+        self._conn: _Connection | None = conn
+        self.status = status
+        self.headers = headers
+
+    async def _read(self, coro):
+        return await asyncio.wait_for(coro, self._client.read_timeout)
+
+    async def _chunks(self) -> AsyncIterator[bytes]:
+        assert self._conn is not None
+        reader = self._conn.reader
+
+        if self.headers.get("transfer-encoding", "").lower() == "chunked":
+            while True:
+                size_line = await self._read(reader.readline())
+                size = int(size_line.split(b";")[0].strip() or b"0", 16)
+                if size == 0:
+                    # Trailers end with an empty line
+                    while (await self._read(reader.readline())).strip():
+                        pass
+                    return
+                yield await self._read(reader.readexactly(size))
+                await self._read(reader.readexactly(2))
+        elif "content-length" in self.headers:
+            remaining = int(self.headers["content-length"])
+            while remaining > 0:
+                chunk = await self._read(reader.read(min(_READ_CHUNK, remaining)))
+                if not chunk:
+                    raise HTTPError("connection closed mid-body")
+                remaining -= len(chunk)
+                yield chunk
+        else:
+            # Body runs until the server closes the connection
+            self.headers["connection"] = "close"
+            while True:
+                chunk = await self._read(reader.read(_READ_CHUNK))
+                if not chunk:
+                    return
+                yield chunk
+
+    async def iter_chunks(self) -> AsyncIterator[bytes]:
+        if self._conn is None:
+            return
+        try:
+            async for chunk in self._chunks():
+                yield chunk
+        except BaseException:
+            self._conn.close()
+            self._conn = None
+            raise
+        self._release()
+
+    async def read(self) -> bytes:
+        return b"".join([chunk async for chunk in self.iter_chunks()])
+
+    def _release(self) -> None:
+        if self._conn is None:
+            return
+        if self.headers.get("connection", "").lower() == "close":
+            self._conn.close()
+        else:
+            self._client._checkin(self._conn)
+        self._conn = None
+
+    def close(self) -> None:
+        # Abandons an unread body; the connection can't be reused
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+
+class AsyncHTTPClient:
+    """
+    Minimal asyncio HTTP/1.1 client for the BNG's control-plane calls (Kea control agent).
+
+    Keeps up to `max_connections` idle keep-alive connections per client, enforces connect and
+    per-read timeouts, and retries requests that fail before a response arrives (connect errors,
+    timeouts, closed keep-alive connections, 5xx) with exponential backoff.
+    """
+
+    def __init__(
+        self,
+        base_url: str,
+        *,
+        auth: Tuple[str, str] | None = None,
+        connect_timeout: float = 3.0,
+        read_timeout: float = 10.0,
+        retries: int = 2,
+        backoff: float = 0.5,
+        max_connections: int = 2,
+    ) -> None:
+        parts = urlsplit(base_url)
+        if parts.scheme != "http":
+            raise ValueError(f"unsupported URL scheme: {parts.scheme}")
+        self.host = parts.hostname or "localhost"
+        self.port = parts.port or 80
+        self.base_path = parts.path.rstrip("/")
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.retries = max(0, retries)
+        self.backoff = backoff
+        self.max_connections = max(1, max_connections)
+        self._idle: List[_Connection] = []
+        self._auth_header = None
+        if auth is not None:
+            token = base64.b64encode(f"{auth[0]}:{auth[1]}".encode()).decode()
+            self._auth_header = f"Basic {token}"
+
+    async def _checkout(self) -> Tuple[_Connection, bool]:
+        # returns: connection, whether it was reused from the pool
+        while self._idle:
+            conn = self._idle.pop()
+            if not conn.writer.is_closing() and not conn.reader.at_eof():
+                return conn, True
+            conn.close()
+
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(self.host, self.port), self.connect_timeout
+        )
+        return _Connection(reader, writer), False
+
+    def _checkin(self, conn: _Connection) -> None:
+        if len(self._idle) >= self.max_connections or conn.writer.is_closing():
+            conn.close()
+            return
+        self._idle.append(conn)
+
+    async def _send(self, conn: _Connection, method: str, path: str, body: bytes) -> HTTPResponse:
+        lines = [
+            f"{method} {self.base_path}{path} HTTP/1.1",
+            f"Host: {self.host}:{self.port}",
+            "Connection: keep-alive",
+            "Accept: application/json",
+            f"Content-Length: {len(body)}",
+        ]
+        if body:
+            lines.append("Content-Type: application/json")
+        if self._auth_header:
+            lines.append(f"Authorization: {self._auth_header}")
+        conn.writer.write(("\r\n".join(lines) + "\r\n\r\n").encode() + body)
+        await asyncio.wait_for(conn.writer.drain(), self.read_timeout)
+
+        status_line = await asyncio.wait_for(conn.reader.readline(), self.read_timeout)
+        if not status_line:
+            raise ConnectionResetError("connection closed before response")
+        try:
+            _, status, _ = (status_line.decode("latin-1").split(" ", 2) + [""])[:3]
+            status_code = int(status)
+        except ValueError:
+            raise HTTPError(f"malformed status line: {status_line!r}")
+
+        headers: Dict[str, str] = {}
+        while True:
+            line = await asyncio.wait_for(conn.reader.readline(), self.read_timeout)
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+
+        return HTTPResponse(self, conn, status_code, headers)
+
+    async def request(self, method: str, path: str, json_body=None) -> HTTPResponse:
+        """
+        Sends a request and returns once the status line and headers are in; the body is left to the caller.
+        Raises HTTPError for non-2xx responses (after retries for 5xx).
+        """
+        body = json.dumps(json_body).encode() if json_body is not None else b""
+        last_error: Exception | None = None
+
+        for attempt in range(self.retries + 1):
+            if attempt:
+                await asyncio.sleep(self.backoff * (2 ** (attempt - 1)))
+
+            conn = None
+            try:
+                conn, reused = await self._checkout()
+                try:
+                    response = await self._send(conn, method, path, body)
+                except (ConnectionError, asyncio.IncompleteReadError):
+                    if not reused:
+                        raise
+                    # The server dropped an idle keep-alive connection; that doesn't count as an attempt
+                    conn.close()
+                    conn, _ = await self._checkout()
+                    response = await self._send(conn, method, path, body)
+            except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError) as e:
+                if conn is not None:
+                    conn.close()
+                last_error = e
+                continue
+
+            if response.status >= 500:
+                await response.read()
+                last_error = HTTPError(f"HTTP {response.status}", response.status)
+                continue
+            if response.status >= 300:
+                await response.read()
+                raise HTTPError(f"HTTP {response.status}", response.status)
+            return response
+
+        raise HTTPError(f"{method} {path} failed after {self.retries + 1} attempts: {last_error!r}")
+
+    def close(self) -> None:
+        for conn in self._idle:
+            conn.close()
+        self._idle = []
+
+
+async def stream_json_array(
+    chunks: AsyncIterator[bytes],
+    key: str,
+    on_item: Callable[[object], None],
+) -> object:
+    """
+    Incrementally decodes a JSON document, handing every element of the first array under `key`
+    to `on_item` as soon as it has been received instead of buffering the whole document.
+    returns: the rest of the document, with that array left empty
+    """
+    decoder = json.JSONDecoder()
+    utf8 = codecs.getincrementaldecoder("utf-8")()
+    marker = json.dumps(key)
+    buf = ""
+    prefix = ""
+    pos = 0
+    state = "prefix" # prefix -> items -> suffix
+    suffix_parts: List[str] = []
+
+    async for raw in chunks:
+        buf += utf8.decode(raw)
+
+        if state == "prefix":
+            idx = buf.find(marker)
+            if idx < 0:
+                continue
+            open_idx = buf.find("[", idx + len(marker))
+            if open_idx < 0:
+                continue
+            prefix = buf[:open_idx + 1]
+            pos = open_idx + 1
+            state = "items"
+
+        if state == "items":
+            while True:
+                while pos < len(buf) and buf[pos] in " \t\r\n,":
+                    pos += 1
+                if pos >= len(buf):
+                    break
+                if buf[pos] == "]":
+                    suffix_parts.append(buf[pos:])
+                    buf, pos = "", 0
+                    state = "suffix"
+                    break
+                try:
+                    item, end = decoder.raw_decode(buf, pos)
+                except json.JSONDecodeError:
+                    break # Element not complete yet, wait for more data
+                on_item(item)
+                pos = end
+            # Drop what's been consumed so the buffer holds at most one partial element
+            buf = buf[pos:]
+            pos = 0
+            continue
+
+        if state == "suffix":
+            suffix_parts.append(buf)
+            buf = ""
+
+    if state == "prefix":
+        return json.loads(buf) if buf.strip() else None
+    if state == "items":
+        raise ValueError("JSON document ended inside the streamed array")
+    return json.loads(prefix + "".join(suffix_parts))
@@ -0,0 +1,105 @@
+import asyncio
+import collections
+import contextlib
+import heapq
+import itertools
+from typing import Any, Deque, List, Tuple
+
+# Commands queue alongside DHCP events (priority 1), ahead of session timers
+COMMAND_PRIORITY = 1
+
+
+class MailboxChannel:
+    """
+    One producer-facing queue of a Mailbox, with the put/put_nowait/qsize interface of asyncio.Queue.
+
+    Items of a channel without a fixed priority are (priority, seq, payload) tuples, as on a
+    PriorityQueue. `maxsize` bounds the channel's items waiting in the mailbox; 0 means unbounded.
+    """
+
+    def __init__(self, mailbox: "Mailbox", maxsize: int = 0, priority: int | None = None) -> None:
+        self.mailbox = mailbox
+        self.maxsize = maxsize
+        self.priority = priority
+        self._size = 0
+        self._putters: Deque[asyncio.Future] = collections.deque()
+
+    def qsize(self) -> int:
+        return self._size
+
+    def full(self) -> bool:
+        return 0 < self.maxsize <= self._size
+
+    def put_nowait(self, item: Any) -> None:
+        if self.full():
+            raise asyncio.QueueFull
+        self._size += 1
+        self.mailbox._push(item[0] if self.priority is None else self.priority, self, item)
+
+    async def put(self, item: Any) -> None:
+        while self.full():
+            putter = asyncio.get_running_loop().create_future()
+            self._putters.append(putter)
+            try:
+                await putter
+            except BaseException:
+                putter.cancel()
+                with contextlib.suppress(ValueError):
+                    self._putters.remove(putter)
+                if not self.full() and not putter.cancelled():
+                    # Woken and cancelled at once: pass the free slot on
+                    self._wake_putter()
+                raise
+        self.put_nowait(item)
+
+    def _taken(self) -> None:
+        self._size -= 1
+        self._wake_putter()
+
+    def _wake_putter(self) -> None:
+        while self._putters:
+            putter = self._putters.popleft()
+            if not putter.done():
+                putter.set_result(None)
+                return
+
+
+class Mailbox:
+    """
+    A single-consumer priority inbox fed by any number of channels.
+
+    The consumer wakes once per batch: `get_batch` waits for the first item, then takes every
+    waiting item up to `max_items`, lowest priority first and in arrival order within a priority.
+    """
+
+    def __init__(self) -> None:
+        self._heap: List[Tuple[int, int, MailboxChannel, Any]] = []
+        self._arrivals = itertools.count()
+        self._waiter: asyncio.Future | None = None
+
+    def channel(self, maxsize: int = 0, priority: int | None = None) -> MailboxChannel:
+        return MailboxChannel(self, maxsize=maxsize, priority=priority)
+
+    def qsize(self) -> int:
+        return len(self._heap)
+
+    def _push(self, priority: int, channel: MailboxChannel, item: Any) -> None:
+        heapq.heappush(self._heap, (priority, next(self._arrivals), channel, item))
+        if self._waiter is not None and not self._waiter.done():
+            self._waiter.set_result(None)
+
+    async def get_batch(self, max_items: int) -> List[Tuple[MailboxChannel, Any]]:
+        """returns: 1 to `max_items` (channel, item) pairs in priority order"""
+        while not self._heap:
+            self._waiter = asyncio.get_running_loop().create_future()
+            try:
+                await self._waiter
+            finally:
+                self._waiter = None
+
+        batch = []
+        while self._heap and len(batch) < max_items:
+            _, _, channel, item = heapq.heappop(self._heap)
+            channel._taken()
+            batch.append((channel, item))
+        return batch
@@ -0,0 +1,132 @@
+import asyncio
+import ctypes
+import ctypes.util
+from typing import List, Tuple
+
+# libnftables output flags (see nftables/libnftables.h)
+NFT_CTX_OUTPUT_HANDLE = 1 << 3
+NFT_CTX_OUTPUT_JSON = 1 << 4
+NFT_CTX_OUTPUT_ECHO = 1 << 5
+
+
+class NftClient:
+    """
+    Long-lived nftables backend.
+
+    Uses libnftables through ctypes so every transaction is a netlink round trip inside this
+    process instead of a fork/exec of the `nft` binary. All commands passed to `run` are sent
+    as one buffer, which libnftables commits as a single atomic batch.
+
+    If libnftables can't be loaded, falls back to one `nft -f -` process per batch so callers
+    still get batching (and echo) semantics.
+    """
+
+    def __init__(self, lib_name: str | None = None) -> None:
+        self._lib = None
+        self._ctx = None
+
+        path = lib_name or ctypes.util.find_library("nftables") or "libnftables.so.1"
+        try:
+            lib = ctypes.CDLL(path)
+        except OSError as e:
+            print(f"NftClient: libnftables unavailable ({e}), falling back to nft subprocess")
+            return
+
+        lib.nft_ctx_new.restype = ctypes.c_void_p
+        lib.nft_ctx_new.argtypes = [ctypes.c_uint32]
+        lib.nft_ctx_output_get_flags.restype = ctypes.c_uint
+        lib.nft_ctx_output_get_flags.argtypes = [ctypes.c_void_p]
+        lib.nft_ctx_output_set_flags.argtypes = [ctypes.c_void_p, ctypes.c_uint]
+        lib.nft_ctx_buffer_output.restype = ctypes.c_int
+        lib.nft_ctx_buffer_output.argtypes = [ctypes.c_void_p]
+        lib.nft_ctx_buffer_error.restype = ctypes.c_int
+        lib.nft_ctx_buffer_error.argtypes = [ctypes.c_void_p]
+        lib.nft_ctx_get_output_buffer.restype = ctypes.c_char_p
+        lib.nft_ctx_get_output_buffer.argtypes = [ctypes.c_void_p]
+        lib.nft_ctx_get_error_buffer.restype = ctypes.c_char_p
+        lib.nft_ctx_get_error_buffer.argtypes = [ctypes.c_void_p]
+        lib.nft_run_cmd_from_buffer.restype = ctypes.c_int
+        lib.nft_run_cmd_from_buffer.argtypes = [ctypes.c_void_p, ctypes.c_char_p]
+
+        ctx = lib.nft_ctx_new(0)  # NFT_CTX_DEFAULT
+        if not ctx:
+            print("NftClient: nft_ctx_new failed, falling back to nft subprocess")
+            return
+
+        lib.nft_ctx_buffer_output(ctx)
+        lib.nft_ctx_buffer_error(ctx)
+
+        self._lib = lib
+        self._ctx = ctx
+        self._base_flags = lib.nft_ctx_output_get_flags(ctx)
+
+    @property
+    def in_process(self) -> bool:
+        return self._ctx is not None
+
+    def _run_in_process(self, buffer: str, flags: int) -> Tuple[bool, str]:
+        assert self._lib is not None
+        self._lib.nft_ctx_output_set_flags(self._ctx, self._base_flags | flags)
+        rc = self._lib.nft_run_cmd_from_buffer(self._ctx, buffer.encode())
+        output = self._lib.nft_ctx_get_output_buffer(self._ctx) or b""
+        error = self._lib.nft_ctx_get_error_buffer(self._ctx) or b""
+        if rc != 0:
+            return False, error.decode(errors="replace")
+        return True, output.decode(errors="replace")
+
+    async def _run_subprocess(self, buffer: str, flags: int) -> Tuple[bool, str]:
+        args = ["nft"]
+        if flags & NFT_CTX_OUTPUT_JSON:
+            args.append("-j")
+        if flags & NFT_CTX_OUTPUT_ECHO:
+            args.append("-e")
+        if flags & NFT_CTX_OUTPUT_HANDLE:
+            args.append("-a")
+        args += ["-f", "-"]
+
+        proc = await asyncio.create_subprocess_exec(
+            *args,
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+        )
+        stdout, stderr = await proc.communicate(buffer.encode())
+        if proc.returncode != 0:
+            return False, stderr.decode(errors="replace") if stderr else ""
+        return True, stdout.decode(errors="replace") if stdout else ""
+
+    async def run(
+        self,
+        commands: str | List[str],
+        *,
+        json_output: bool = False,
+        echo: bool = False,
+    ) -> Tuple[bool, str]:
+        """
+        Run one or more nft commands as a single transaction.
+        returns: success: bool, output (or error text on failure): str
+        """
+        if isinstance(commands, list):
+            buffer = "\n".join(commands)
+        else:
+            buffer = commands
+
+        flags = 0
+        if json_output:
+            flags |= NFT_CTX_OUTPUT_JSON
+        if echo:
+            flags |= NFT_CTX_OUTPUT_ECHO | NFT_CTX_OUTPUT_HANDLE
+
+        if self.in_process:
+            return self._run_in_process(buffer, flags)
+        return await self._run_subprocess(buffer, flags)
+
+
+_client: NftClient | None = None
+
+
+def get_nft_client() -> NftClient:
+    global _client
+    if _client is None:
+        _client = NftClient()
+    return _client
@@ -1,23 +1,22 @@
 import asyncio
+import ipaddress
 import json
-from typing import Tuple
+import time
+from typing import Dict, Iterator, List, Tuple
 
+from lib.constants import NFT_ACCOUNTING_MODE, NFT_ACCOUNTING_SET_SIZE, NFT_COUNTER_SNAPSHOT_TTL_SECONDS
+from lib.group_commit import GroupCommit
+from lib.nftables.client import get_nft_client
 
-async def _cmd(command: str) -> str:
-    proc = await asyncio.create_subprocess_shell(
-        command,
-        stdout=asyncio.subprocess.PIPE,
-        stderr=asyncio.subprocess.STDOUT,
-    )
-    stdout, _ = await proc.communicate()
-    return stdout.decode() if stdout else ""
+ACCT_SET_UP = "sub_up"
+ACCT_SET_DOWN = "sub_down"
 
-# nftables helpers
-async def nft_list_chain_rules():
-    out = await _cmd("nft -j list chain inet bngacct sess")
 
-    try:
+async def _nft(commands: str | List[str], *, json_output: bool = False, echo: bool = False) -> Tuple[bool, str]:
+    return await get_nft_client().run(commands, json_output=json_output, echo=echo)
 
+def _parse_nft_json(out: str) -> dict:
+    try:
         if not out or not out.strip():
             return {}
 
@@ -27,9 +26,12 @@ async def nft_list_chain_rules():
         print(f"INSIDE Failed to parse nftables JSON output: {e} with output: {out}")
         return {}
 
-def nft_find_rule_handle(nft_json: dict, comment_match: str):
+def _iter_sess_rules(nft_json: dict) -> Iterator[dict]:
+    # Handles both `list` output ({"rule": {...}}) and echo output ({"add": {"rule": {...}}})
     for item in nft_json.get("nftables", []):
         rule = item.get("rule")
+        if rule is None and isinstance(item.get("add"), dict):
+            rule = item["add"].get("rule")
         if not rule:
             continue
 
@@ -37,6 +39,78 @@ def nft_find_rule_handle(nft_json: dict, comment_match: str):
         if rule.get("table") != "bngacct" or rule.get("chain") != "sess":
             continue
 
+        yield rule
+
+# nftables helpers
+async def nft_list_chain_rules():
+    ok, out = await _nft("list chain inet bngacct sess", json_output=True)
+    if not ok:
+        print(f"Failed to list nftables chain: {out}")
+        return {}
+
+    return _parse_nft_json(out)
+
+async def nft_list_accounting():
+    """Single dump of everything accounting reads counters from, for the active accounting mode."""
+    if NFT_ACCOUNTING_MODE != "set":
+        return await nft_list_chain_rules()
+
+    ok, out = await _nft("list table inet bngacct", json_output=True)
+    if not ok:
+        print(f"Failed to list nftables accounting sets: {out}")
+        return {}
+
+    return _parse_nft_json(out)
+
+async def nft_setup_accounting(sub_if: str):
+    """
+    Set mode only: declares the per-subscriber counter sets and the three shared rules in `bngacct sess`.
+    A lookup match against a set declared with `counter` bumps the matched element's counter.
+    Safe to call on every start, existing sets/rules are left in place.
+    """
+    if NFT_ACCOUNTING_MODE != "set":
+        return
+
+    nft_json = await nft_list_chain_rules()
+    comments = {rule.get("comment") for rule in _iter_sess_rules(nft_json)}
+
+    commands = [
+        f"add set inet bngacct {ACCT_SET_UP} {{ type ipv4_addr; size {NFT_ACCOUNTING_SET_SIZE}; counter; }}",
+        f"add set inet bngacct {ACCT_SET_DOWN} {{ type ipv4_addr; size {NFT_ACCOUNTING_SET_SIZE}; counter; }}",
+    ]
+    if "acct;dhcp" not in comments:
+        # Single shared DHCP exclusion instead of one pair per subscriber
+        commands.append(
+            "add rule inet bngacct sess meta l4proto udp udp sport { 67, 68 } udp dport { 67, 68 } accept "
+            "comment \"acct;dhcp\""
+        )
+    if "acct;dir=up" not in comments:
+        commands.append(
+            f"add rule inet bngacct sess iif \"{sub_if}\" ip saddr @{ACCT_SET_UP} comment \"acct;dir=up\""
+        )
+    if "acct;dir=down" not in comments:
+        commands.append(
+            f"add rule inet bngacct sess oif \"{sub_if}\" ip daddr @{ACCT_SET_DOWN} comment \"acct;dir=down\""
+        )
+
+    ok, out = await _nft(commands)
+    if not ok:
+        raise RuntimeError(f"Failed to set up nftables accounting sets: {out}")
+
+def nft_subscriber_comment(mac: str, ip: str, direction: str) -> str:
+    # Identifies a subscriber's counter rule in the chain, e.g. when re-adopting rules after a restart
+    return f"sub;mac={mac.lower()};dir={direction};ip={ip}"
+
+def nft_subscriber_rule_comments(nft_json: dict) -> Dict[int, str]:
+    """returns: {handle: comment} of every subscriber counter rule in `bngacct sess`"""
+    return {
+        rule["handle"]: rule["comment"]
+        for rule in _iter_sess_rules(nft_json)
+        if rule.get("handle") is not None and str(rule.get("comment", "")).startswith("sub;")
+    }
+
+def nft_find_rule_handle(nft_json: dict, comment_match: str):
+    for rule in _iter_sess_rules(nft_json):
         comment = rule.get("comment", None);
         if comment == comment_match:
             return rule.get("handle", None)
@@ -49,62 +123,376 @@ async def nft_add_subscriber_rules(
     sub_if: str = "eth0", # if = interface
     # NOTE: We have eth0 as the default iface because we want to measure on subscriber facing interface
     #   We could have measured on eth1 ( upstream facing ) but that would not capture traffic that is dropped by BNG itself
-):
-    mac_l = mac.lower()
-
-    # Upload counter rule (exclude DHCP udp 67/68)
-    await _cmd(
-        f"nft \'add rule inet bngacct sess iif \"{sub_if}\" ip saddr {ip} meta l4proto udp udp sport {{ 67, 68 }} accept\'"
-    )
-    await _cmd(
-        f"nft \'add rule inet bngacct sess iif \"{sub_if}\" ip saddr {ip} counter "
-        f"comment \"sub;mac={mac_l};dir=up;ip={ip}\"\'"
-    )
-
-    # Download counter rule (exclude DHCP udp 67/68)
-    await _cmd(
-        f"nft \'add rule inet bngacct sess oif \"{sub_if}\" ip daddr {ip} meta l4proto udp udp dport {{ 67, 68 }} accept\'"
-    )
-    await _cmd(
-        f"nft \'add rule inet bngacct sess oif \"{sub_if}\" ip daddr {ip} counter "
-        f"comment \"sub;mac={mac_l};dir=down;ip={ip}\"\'"
-    )
-
-    nftables_data = await nft_list_chain_rules()
-    up_rule_handle = nft_find_rule_handle(nftables_data, f"sub;mac={mac_l};dir=up;ip={ip}")
-    down_rule_handle = nft_find_rule_handle(nftables_data, f"sub;mac={mac_l};dir=down;ip={ip}")
+) -> Tuple[int, int, dict]:
+    """
+    Installs the subscriber's accounting rules as one nft transaction and reads the new rule handles
+    back from the echo, so no chain listing is needed.
+    returns: up_handle, down_handle, echo_json (carries the initial counter values for baselining)
+    """
+    if NFT_ACCOUNTING_MODE == "set":
+        return await _nft_add_subscriber_elements(ip)
+
+    up_comment = nft_subscriber_comment(mac, ip, "up")
+    down_comment = nft_subscriber_comment(mac, ip, "down")
+
+    ok, out = await _nft(_subscriber_rule_commands(ip, mac, sub_if), json_output=True, echo=True)
+
+    if not ok:
+        raise RuntimeError(f"Failed to add nftables rules for subscriber: {out}")
+    nft_invalidate_counter_snapshot()
+
+    echo_json = _parse_nft_json(out)
+    up_rule_handle = nft_find_rule_handle(echo_json, up_comment)
+    down_rule_handle = nft_find_rule_handle(echo_json, down_comment)
 
     if up_rule_handle is None or down_rule_handle is None:
         raise RuntimeError("Failed to add nftables rules for subscriber")
 
-    return up_rule_handle, down_rule_handle
+    return up_rule_handle, down_rule_handle, echo_json
 
-async def nft_delete_rule_by_handle(handle: int):
-    await _cmd(f"nft delete rule inet bngacct sess handle {handle} 2>/dev/null || true")
+def _subscriber_rule_commands(ip: str, mac: str, sub_if: str) -> List[str]:
+    up_comment = nft_subscriber_comment(mac, ip, "up")
+    down_comment = nft_subscriber_comment(mac, ip, "down")
+    return [
+        # Upload counter rule (exclude DHCP udp 67/68)
+        f"add rule inet bngacct sess iif \"{sub_if}\" ip saddr {ip} meta l4proto udp udp sport {{ 67, 68 }} accept",
+        f"add rule inet bngacct sess iif \"{sub_if}\" ip saddr {ip} counter comment \"{up_comment}\"",
 
+        # Download counter rule (exclude DHCP udp 67/68)
+        f"add rule inet bngacct sess oif \"{sub_if}\" ip daddr {ip} meta l4proto udp udp dport {{ 67, 68 }} accept",
+        f"add rule inet bngacct sess oif \"{sub_if}\" ip daddr {ip} counter comment \"{down_comment}\"",
+    ]
 
-def nft_get_counter_by_handle(nftables_json, handle: int) -> Tuple[int, int] | None:
-    for item in nftables_json.get("nftables", []):
-        rule = item.get("rule")
-        if not rule:
-            continue
+async def nft_add_subscriber_rules_bulk(
+    subscribers: List[Tuple[str, str]],
+    sub_if: str = "eth0",
+    chunk: int = 512,
+) -> Dict[str, Tuple[int, int]]:
+    """
+    Installs many subscribers' accounting rules (or set elements), one nft transaction per `chunk`
+    subscribers. The new counters start at zero. A failed transaction only loses its own chunk.
+    returns: {ip: (up_handle, down_handle)} for every subscriber installed
+    """
+    results: Dict[str, Tuple[int, int]] = {}
 
-        if rule.get("table") != "bngacct" or rule.get("chain") != "sess":
+    for start in range(0, len(subscribers), chunk):
+        batch = subscribers[start:start + chunk]
+
+        if NFT_ACCOUNTING_MODE == "set":
+            elements = ", ".join(ip for ip, _ in batch)
+            ok, out = await _nft([
+                f"add element inet bngacct {set_name} {{ {elements} }}\n"
+                f"delete element inet bngacct {set_name} {{ {elements} }}\n"
+                f"add element inet bngacct {set_name} {{ {elements} }}"
+                for set_name in (ACCT_SET_UP, ACCT_SET_DOWN)
+            ])
+            if not ok:
+                print(f"Failed to add nftables accounting elements for {len(batch)} subscribers: {out}")
+                continue
+            nft_invalidate_counter_snapshot()
+            for ip, _ in batch:
+                key = int(ipaddress.IPv4Address(ip))
+                results[ip] = (key, key)
             continue
 
-        if rule.get("handle") != handle:
+        commands = [command for ip, mac in batch for command in _subscriber_rule_commands(ip, mac, sub_if)]
+        ok, out = await _nft(commands, json_output=True, echo=True)
+        if not ok:
+            print(f"Failed to add nftables rules for {len(batch)} subscribers: {out}")
             continue
+        nft_invalidate_counter_snapshot()
 
-        expr = rule.get("expr", [])
-        for e in expr:
-            counter = e.get("counter", None)
-            if counter:
-                return counter.get("bytes", 0), counter.get("packets", 0)
+        handles = {
+            rule.get("comment"): rule.get("handle")
+            for rule in _iter_sess_rules(_parse_nft_json(out))
+            if rule.get("comment")
+        }
+        for ip, mac in batch:
+            up_handle = handles.get(nft_subscriber_comment(mac, ip, "up"))
+            down_handle = handles.get(nft_subscriber_comment(mac, ip, "down"))
+            if up_handle is not None and down_handle is not None:
+                results[ip] = (up_handle, down_handle)
 
-    return None
+    return results
+
+async def _add_subscriber_rules_batch(subscribers: List[Tuple[str, str, str]]) -> List[Tuple[int, int] | None]:
+    by_iface: Dict[str, List[Tuple[str, str]]] = {}
+    for ip, mac, sub_if in subscribers:
+        by_iface.setdefault(sub_if, []).append((ip, mac))
+
+    handles: Dict[str, Tuple[int, int]] = {}
+    for sub_if, batch in by_iface.items():
+        handles.update(await nft_add_subscriber_rules_bulk(batch, sub_if))
+    return [handles.get(ip) for ip, _, _ in subscribers]
+
+_subscriber_rules = GroupCommit(_add_subscriber_rules_batch)
+
+async def nft_add_subscriber_rules_batched(ip: str, mac: str, sub_if: str = "eth0") -> Tuple[int, int]:
+    """
+    One subscriber's accounting rules (or set elements), installed in one nft transaction together with
+    every other subscriber's submitted meanwhile, from any caller. The new counters start at zero.
+    returns: up_handle, down_handle
+    """
+    handles = await _subscriber_rules.submit((ip, mac, sub_if))
+    if handles is None:
+        raise RuntimeError("Failed to add nftables rules for subscriber")
+    return handles
+
+async def _nft_add_subscriber_elements(ip: str) -> Tuple[int, int, dict]:
+    # add/delete/add so a leftover element from an earlier session restarts its counter from zero
+    ok, out = await _nft([
+        f"add element inet bngacct {set_name} {{ {ip} }}\n"
+        f"delete element inet bngacct {set_name} {{ {ip} }}\n"
+        f"add element inet bngacct {set_name} {{ {ip} }}"
+        for set_name in (ACCT_SET_UP, ACCT_SET_DOWN)
+    ])
+    if not ok:
+        raise RuntimeError(f"Failed to add nftables accounting elements for subscriber: {out}")
+    nft_invalidate_counter_snapshot()
+
+    # In set mode the "handle" is the element key (the IPv4 address as int), the counters start at zero
+    key = int(ipaddress.IPv4Address(ip))
+    return key, key, {}
+
+async def nft_delete_subscriber_rules(ip: str | None, up_handle: int | None, down_handle: int | None):
+    if NFT_ACCOUNTING_MODE == "set":
+        if not ip:
+            return
+        # add-then-delete never fails on a missing element, so the batch can't abort
+        await _nft([
+            f"add element inet bngacct {set_name} {{ {ip} }}\n"
+            f"delete element inet bngacct {set_name} {{ {ip} }}"
+            for set_name in (ACCT_SET_UP, ACCT_SET_DOWN)
+        ])
+        nft_invalidate_counter_snapshot()
+        return
 
-async def nft_allow_ip(ip: str):
-    await _cmd(f"nft add element inet aether_auth authed_ips {{ {ip} }}")
+    await nft_delete_rules_by_handle([h for h in (up_handle, down_handle) if h is not None])
+    nft_invalidate_counter_snapshot()
+
+async def nft_delete_rules_by_handle(handles: List[int]):
+    if not handles:
+        return
+
+    ok, _ = await _nft([f"delete rule inet bngacct sess handle {h}" for h in handles])
+    if ok or len(handles) == 1:
+        return
+
+    # One stale handle aborts the whole transaction, retry individually
+    for h in handles:
+        await _nft(f"delete rule inet bngacct sess handle {h}")
+
+
+class NftCounterSnapshot:
+    """
+    Counters from one `nft_list_accounting` dump (or an echo), indexed once so every lookup is O(1).
+    Rules mode is indexed by rule handle, set mode by (set name, ip).
+    """
+
+    def __init__(self, nftables_json: dict, taken_at: float | None = None) -> None:
+        self.taken_at = taken_at if taken_at is not None else time.monotonic()
+        self._by_handle: Dict[int, Tuple[int, int]] = {}
+        self._by_element: Dict[Tuple[str, str], Tuple[int, int]] = {}
+
+        for rule in _iter_sess_rules(nftables_json):
+            handle = rule.get("handle")
+            if handle is None:
+                continue
+            for e in rule.get("expr", []):
+                counter = e.get("counter", None)
+                if counter:
+                    self._by_handle[handle] = (counter.get("bytes", 0), counter.get("packets", 0))
+                    break
+
+        for item in nftables_json.get("nftables", []):
+            nft_set = item.get("set")
+            if not nft_set or nft_set.get("table") != "bngacct":
+                continue
+            set_name = nft_set.get("name")
+
+            for elem in nft_set.get("elem", []):
+                if not isinstance(elem, dict):
+                    continue
+                elem = elem.get("elem", elem)
+                counter = elem.get("counter") or {}
+                self._by_element[(set_name, elem.get("val"))] = (counter.get("bytes", 0), counter.get("packets", 0))
+
+    def counter_by_handle(self, handle: int) -> Tuple[int, int] | None:
+        return self._by_handle.get(handle)
+
+    def counter_by_element(self, set_name: str, ip: str) -> Tuple[int, int] | None:
+        return self._by_element.get((set_name, ip))
+
+    def element_ips(self, set_name: str) -> List[str]:
+        return [ip for name, ip in self._by_element if name == set_name]
+
+    def subscriber_counters(
+        self,
+        ip: str | None,
+        up_handle: int | None,
+        down_handle: int | None,
+    ) -> Tuple[int, int, int, int]:
+        """
+        Raw counters for a subscriber, in either accounting mode.
+        returns: up_bytes, up_pkts, down_bytes, down_pkts
+        """
+        up_bytes, up_pkts = 0, 0
+        down_bytes, down_pkts = 0, 0
+
+        if NFT_ACCOUNTING_MODE == "set":
+            if ip and up_handle is not None:
+                up_bytes, up_pkts = self.counter_by_element(ACCT_SET_UP, ip) or (0, 0)
+            if ip and down_handle is not None:
+                down_bytes, down_pkts = self.counter_by_element(ACCT_SET_DOWN, ip) or (0, 0)
+            return up_bytes, up_pkts, down_bytes, down_pkts
+
+        if up_handle is not None:
+            up_bytes, up_pkts = self.counter_by_handle(up_handle) or (0, 0)
+        if down_handle is not None:
+            down_bytes, down_pkts = self.counter_by_handle(down_handle) or (0, 0)
+        return up_bytes, up_pkts, down_bytes, down_pkts
+
+
+class NftCounterSnapshotCache:
+    """
+    Shares one NftCounterSnapshot between every consumer within a scheduling tick.
+    A snapshot younger than `ttl_seconds` is reused, and concurrent callers wait on a single dump.
+    Installing or deleting a subscriber's counters invalidates it, so no consumer reads an IP's previous
+    holder's counters against the new session's zero baselines.
+    """
+
+    def __init__(self, ttl_seconds: float) -> None:
+        self.ttl_seconds = ttl_seconds
+        self._snapshot: NftCounterSnapshot | None = None
+        self._inflight: asyncio.Future[NftCounterSnapshot] | None = None
+        self._generation = 0
+
+    def invalidate(self) -> None:
+        self._snapshot = None
+        # A dump already in flight may predate the change; it is handed to its waiters but not cached
+        self._generation += 1
+
+    async def get(self) -> NftCounterSnapshot:
+        snapshot = self._snapshot
+        if snapshot is not None and time.monotonic() - snapshot.taken_at < self.ttl_seconds:
+            return snapshot
+
+        if self._inflight is not None:
+            return await asyncio.shield(self._inflight)
+
+        inflight = self._inflight = asyncio.get_running_loop().create_future()
+        generation = self._generation
+        try:
+            taken_at = time.monotonic()
+            snapshot = NftCounterSnapshot(await nft_list_accounting(), taken_at=taken_at)
+            if generation == self._generation:
+                self._snapshot = snapshot
+            inflight.set_result(snapshot)
+            return snapshot
+        except Exception as e:
+            inflight.set_exception(e)
+            # Mark retrieved, waiters (if any) re-raise it themselves
+            inflight.exception()
+            raise
+        finally:
+            self._inflight = None
+            if not inflight.done():
+                # This caller was cancelled; waiters on its dump must not hang
+                inflight.set_exception(RuntimeError("counter snapshot dump was cancelled"))
+                inflight.exception()
+
+
+_snapshot_cache = NftCounterSnapshotCache(ttl_seconds=NFT_COUNTER_SNAPSHOT_TTL_SECONDS)
+
+async def nft_get_counter_snapshot() -> NftCounterSnapshot:
+    return await _snapshot_cache.get()
+
+def nft_invalidate_counter_snapshot() -> None:
+    _snapshot_cache.invalidate()
+
+class NftAuthedSetBatcher:
+    """
+    Collects `authed_ips` element changes and applies them as one nft transaction per event-loop tick.
+    Elements carry the lease's remaining lifetime as their timeout, so the kernel stops forwarding for
+    an expired subscriber on its own. The last queued change for an IP wins. When the transaction fails,
+    each change is retried on its own, and the ones that still fail are queued again for the next flush.
+    """
+
+    _REMOVE = object()
+    # Flushes an IP's change is retried on before it is given up
+    _MAX_ATTEMPTS = 3
+
+    def __init__(self) -> None:
+        # ip -> timeout seconds to add/refresh with (None = no timeout), or _REMOVE
+        self._pending: Dict[str, int | None | object] = {}
+        # ip -> failed flushes of its queued change
+        self._failures: Dict[str, int] = {}
+
+    def allow(self, ip: str, timeout_seconds: int | None = None) -> None:
+        self._pending[ip] = timeout_seconds
+        self._failures.pop(ip, None)
+
+    def remove(self, ip: str) -> None:
+        self._pending[ip] = self._REMOVE
+        self._failures.pop(ip, None)
+
+    def _commands(self, ip: str, op: int | None | object) -> List[str]:
+        # Adding first guarantees the delete can't fail and abort the batch
+        commands = [
+            f"add element inet aether_auth authed_ips {{ {ip} }}",
+            f"delete element inet aether_auth authed_ips {{ {ip} }}",
+        ]
+        if op is self._REMOVE:
+            return commands
+        # Re-adding is the refresh, `add` on an existing element leaves its timeout untouched
+        if op is None:
+            commands.append(f"add element inet aether_auth authed_ips {{ {ip} }}")
+        else:
+            commands.append(f"add element inet aether_auth authed_ips {{ {ip} timeout {max(1, int(op))}s }}")
+        return commands
+
+    async def flush(self) -> None:
+        if not self._pending:
+            return
+
+        pending, self._pending = self._pending, {}
+        commands = [c for ip, op in pending.items() for c in self._commands(ip, op)]
+
+        ok, out = await _nft(commands)
+        if ok:
+            for ip in pending:
+                self._failures.pop(ip, None)
+            return
+        print(f"Failed to apply {len(pending)} authed_ips changes: {out}")
+
+        # One bad element aborts the whole transaction, retry individually
+        for ip, op in pending.items():
+            if ip in self._pending:
+                # Superseded by a change queued meanwhile
+                self._failures.pop(ip, None)
+                continue
+            if len(pending) > 1:
+                ok, out = await _nft(self._commands(ip, op))
+                if ok:
+                    self._failures.pop(ip, None)
+                    continue
+            failures = self._failures.get(ip, 0) + 1
+            if failures >= self._MAX_ATTEMPTS:
+                self._failures.pop(ip, None)
+                print(f"Giving up on authed_ips change for {ip} after {failures} attempts: {out}")
+                continue
+            self._failures[ip] = failures
+            # Back in the queue for the next flush, unless a newer change for the IP arrived meanwhile
+            self._pending.setdefault(ip, op)
+
+
+_authed_set = NftAuthedSetBatcher()
+
+async def nft_allow_ip(ip: str, timeout_seconds: int | None = None):
+    _authed_set.allow(ip, timeout_seconds)
 
 async def nft_remove_ip(ip: str):
-    await _cmd(f"nft delete element inet aether_auth authed_ips {{ {ip} }}")
+    _authed_set.remove(ip)
+
+async def nft_flush_authed_ips():
+    await _authed_set.flush()
@@ -0,0 +1,171 @@
+import asyncio
+from dataclasses import dataclass
+from typing import Dict, List, Tuple
+
+from lib.radius.packet import (
+    Attribute,
+    RadiusPacket,
+    RadiusPacketError,
+    decode_reply,
+    encode_request,
+)
+
+# One UDP socket can have 256 requests (identifiers) in flight
+_IDS_PER_SOCKET = 256
+
+
+@dataclass
+class _PendingRequest:
+    authenticator: bytes
+    future: asyncio.Future
+
+
+class _RadiusSocket(asyncio.DatagramProtocol):
+    # One connected UDP socket and the requests in flight on it, keyed by RADIUS identifier
+
+    def __init__(self, secret: bytes) -> None:
+        self.secret = secret
+        self.transport: asyncio.DatagramTransport | None = None
+        self.pending: Dict[int, _PendingRequest] = {}
+        self._next_id = 0
+
+    def connection_made(self, transport) -> None:
+        self.transport = transport
+
+    def datagram_received(self, data: bytes, addr) -> None:
+        if len(data) < 2:
+            return
+        request = self.pending.get(data[1])
+        if request is None or request.future.done():
+            return # Late reply to a request that already timed out
+
+        try:
+            reply = decode_reply(data, self.secret, request.authenticator)
+        except RadiusPacketError as e:
+            # Could be a stale reply for a reused identifier; keep waiting for the real one
+            print(f"RadiusClient: dropping reply id={data[1]}: {e}")
+            return
+        request.future.set_result(reply)
+
+    def error_received(self, exc) -> None:
+        # ICMP errors (e.g. port unreachable) surface here; retransmit/timeout handles them
+        pass
+
+    def connection_lost(self, exc) -> None:
+        self.transport = None
+        for request in self.pending.values():
+            if not request.future.done():
+                request.future.set_exception(ConnectionError("RADIUS socket closed"))
+
+    def free_id(self) -> int | None:
+        if len(self.pending) >= _IDS_PER_SOCKET:
+            return None
+        for _ in range(_IDS_PER_SOCKET):
+            identifier = self._next_id
+            self._next_id = (self._next_id + 1) % _IDS_PER_SOCKET
+            if identifier not in self.pending:
+                return identifier
+        return None
+
+
+class RadiusClient:
+    """
+    In-process RADIUS client for one server (auth or acct port).
+
+    Requests are multiplexed over a small pool of UDP sockets by RADIUS identifier, so up to
+    pool_size * 256 requests can be in flight at once. Unanswered requests are retransmitted
+    unchanged (same identifier and authenticator) every `timeout` seconds, `retries` times.
+    """
+
+    def __init__(
+        self,
+        server_ip: str,
+        port: int,
+        secret: str,
+        *,
+        pool_size: int = 4,
+        timeout: float = 1.0,
+        retries: int = 2,
+    ) -> None:
+        self.server_ip = server_ip
+        self.port = port
+        self.secret = secret.encode()
+        self.pool_size = max(1, pool_size)
+        self.timeout = timeout
+        self.retries = max(0, retries)
+
+        self._sockets: List[_RadiusSocket] = []
+        self._next_socket = 0
+        self._open_lock = asyncio.Lock()
+        self._slots = asyncio.Semaphore(self.pool_size * _IDS_PER_SOCKET)
+
+    async def _ensure_sockets(self) -> None:
+        if len(self._sockets) == self.pool_size and all(sock.transport is not None for sock in self._sockets):
+            return
+
+        async with self._open_lock:
+            loop = asyncio.get_running_loop()
+            alive = [sock for sock in self._sockets if sock.transport is not None]
+            while len(alive) < self.pool_size:
+                _, protocol = await loop.create_datagram_endpoint(
+                    lambda: _RadiusSocket(self.secret),
+                    remote_addr=(self.server_ip, self.port),
+                )
+                alive.append(protocol)
+            self._sockets = alive
+
+    def _reserve(self) -> Tuple[_RadiusSocket, int]:
+        # Round-robin over the pool; the semaphore guarantees some socket has a free identifier
+        for _ in range(len(self._sockets)):
+            sock = self._sockets[self._next_socket]
+            self._next_socket = (self._next_socket + 1) % len(self._sockets)
+            identifier = sock.free_id()
+            if identifier is not None:
+                return sock, identifier
+        raise RuntimeError("RADIUS identifier space exhausted")
+
+    async def request(self, code: int, attributes: List[Attribute]) -> RadiusPacket | None:
+        """
+        Sends one request and waits for its authenticated reply.
+        returns: the decoded reply, or None if the server never answered
+        """
+        async with self._slots:
+            await self._ensure_sockets()
+            sock, identifier = self._reserve()
+
+            packet, authenticator = encode_request(code, identifier, attributes, self.secret)
+            future = asyncio.get_running_loop().create_future()
+            sock.pending[identifier] = _PendingRequest(authenticator=authenticator, future=future)
+
+            try:
+                for _ in range(self.retries + 1):
+                    if sock.transport is None:
+                        raise ConnectionError("RADIUS socket closed")
+                    sock.transport.sendto(packet)
+                    try:
+                        return await asyncio.wait_for(asyncio.shield(future), self.timeout)
+                    except asyncio.TimeoutError:
+                        continue
+                return None
+            finally:
+                sock.pending.pop(identifier, None)
+                if not future.done():
+                    future.cancel()
+
+    def close(self) -> None:
+        for sock in self._sockets:
+            if sock.transport is not None:
+                sock.transport.close()
+        self._sockets = []
+
+
+_clients: Dict[Tuple[str, int, str], RadiusClient] = {}
+
+
+def get_radius_client(server_ip: str, port: int, secret: str, **kwargs) -> RadiusClient:
+    key = (server_ip, port, secret)
+    client = _clients.get(key)
+    if client is None:
+        client = RadiusClient(server_ip, port, secret, **kwargs)
+        _clients[key] = client
+    return client
@@ -0,0 +1,243 @@
+import hashlib
+import ipaddress
+import os
+import struct
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Tuple
+
+# RFC 2865 / 2866 packet codes
+ACCESS_REQUEST = 1
+ACCESS_ACCEPT = 2
+ACCESS_REJECT = 3
+ACCOUNTING_REQUEST = 4
+ACCOUNTING_RESPONSE = 5
+
+RADIUS_HEADER_LEN = 20
+RADIUS_MAX_PACKET_LEN = 4096
+
+VENDOR_SPECIFIC = 26
+OSS_VENDOR_ID = 43242
+
+# Attribute name -> (type, data type). Only what the BNG sends or reads back.
+ATTRIBUTES: Dict[str, Tuple[int, str]] = {
+    "User-Name": (1, "string"),
+    "User-Password": (2, "password"),
+    "NAS-IP-Address": (4, "ipaddr"),
+    "Framed-IP-Address": (8, "ipaddr"),
+    "Reply-Message": (18, "string"),
+    "Class": (25, "octets"),
+    "Session-Timeout": (27, "integer"),
+    "Called-Station-Id": (30, "string"),
+    "Calling-Station-Id": (31, "string"),
+    "Acct-Status-Type": (40, "integer"),
+    "Acct-Delay-Time": (41, "integer"),
+    "Acct-Input-Octets": (42, "integer"),
+    "Acct-Output-Octets": (43, "integer"),
+    "Acct-Session-Id": (44, "string"),
+    "Acct-Session-Time": (46, "integer"),
+    "Acct-Input-Packets": (47, "integer"),
+    "Acct-Output-Packets": (48, "integer"),
+    "Acct-Terminate-Cause": (49, "integer"),
+    "Acct-Input-Gigawords": (52, "integer"),
+    "Acct-Output-Gigawords": (53, "integer"),
+    "Event-Timestamp": (55, "integer"),
+    "NAS-Port-Type": (61, "integer"),
+    "NAS-Port-Id": (87, "string"),
+}
+_ATTRIBUTES_BY_TYPE = {attr_type: (name, data_type) for name, (attr_type, data_type) in ATTRIBUTES.items()}
+
+# OSS vendor attributes (see docker/radius/raddb/dictionary.oss), all integers in kbit/s
+OSS_ATTRIBUTES: Dict[str, int] = {
+    "OSS-Download-Speed": 1,
+    "OSS-Upload-Speed": 2,
+    "OSS-Download-Burst": 3,
+    "OSS-Upload-Burst": 4,
+}
+_OSS_ATTRIBUTES_BY_TYPE = {vendor_type: name for name, vendor_type in OSS_ATTRIBUTES.items()}
+
+# Named integer values
+VALUES: Dict[str, Dict[str, int]] = {
+    "Acct-Status-Type": {"Start": 1, "Stop": 2, "Interim-Update": 3},
+    "NAS-Port-Type": {"Ethernet": 15},
+    "Acct-Terminate-Cause": {
+        "User-Request": 1,
+        "Lost-Carrier": 2,
+        "Lost-Service": 3,
+        "Idle-Timeout": 4,
+        "Session-Timeout": 5,
+        "Admin-Reset": 6,
+        "Admin-Reboot": 7,
+        "Port-Error": 8,
+        "NAS-Error": 9,
+        "NAS-Request": 10,
+        "NAS-Reboot": 11,
+    },
+}
+
+# BNG-internal stop causes that have no RFC 2866 value
+TERMINATE_CAUSE_ALIASES = {
+    "IP-change": "NAS-Request",
+    "Reconcile-Timeout": "Lost-Service",
+}
+
+Attribute = Tuple[str, Any]
+
+
+class RadiusPacketError(Exception):
+    pass
+
+
+@dataclass
+class RadiusPacket:
+    code: int
+    identifier: int
+    authenticator: bytes
+    # Decoded attributes in wire order; unknown standard attributes are keyed as "Attr-<type>"
+    attributes: List[Attribute] = field(default_factory=list)
+    # OSS vendor attributes, name -> value
+    vendor_attributes: Dict[str, int] = field(default_factory=dict)
+
+    def get(self, name: str, default: Any = None) -> Any:
+        for attr_name, value in self.attributes:
+            if attr_name == name:
+                return value
+        return default
+
+
+def _encode_value(name: str, data_type: str, value: Any) -> bytes:
+    if data_type == "integer":
+        if isinstance(value, str):
+            if name == "Acct-Terminate-Cause":
+                value = TERMINATE_CAUSE_ALIASES.get(value, value)
+            value = VALUES.get(name, {}).get(value, value)
+        return struct.pack("!I", int(value) & 0xFFFFFFFF)
+    if data_type == "ipaddr":
+        return ipaddress.IPv4Address(str(value).replace("\x00", "")).packed
+    if isinstance(value, bytes):
+        return value
+    return str(value).encode()
+
+
+def _encode_password(password: bytes, secret: bytes, authenticator: bytes) -> bytes:
+    # RFC 2865 5.2: pad to 16 bytes, XOR each block with MD5(secret + previous block)
+    padded = password.ljust(max(16, (len(password) + 15) // 16 * 16), b"\x00")
+    result = b""
+    previous = authenticator
+    for i in range(0, len(padded), 16):
+        digest = hashlib.md5(secret + previous).digest()
+        block = bytes(p ^ d for p, d in zip(padded[i:i + 16], digest))
+        result += block
+        previous = block
+    return result
+
+
+def encode_attributes(attributes: List[Attribute], secret: bytes, authenticator: bytes) -> bytes:
+    out = bytearray()
+    for name, value in attributes:
+        if name in OSS_ATTRIBUTES:
+            data = struct.pack("!IBBI", OSS_VENDOR_ID, OSS_ATTRIBUTES[name], 6, int(value))
+            out += struct.pack("!BB", VENDOR_SPECIFIC, len(data) + 2) + data
+            continue
+
+        if name not in ATTRIBUTES:
+            raise RadiusPacketError(f"unknown RADIUS attribute: {name}")
+        attr_type, data_type = ATTRIBUTES[name]
+
+        if data_type == "password":
+            data = _encode_password(str(value).encode(), secret, authenticator)
+        else:
+            data = _encode_value(name, data_type, value)
+
+        if len(data) > 253:
+            raise RadiusPacketError(f"RADIUS attribute too long: {name}")
+        out += struct.pack("!BB", attr_type, len(data) + 2) + data
+    return bytes(out)
+
+
+def encode_request(code: int, identifier: int, attributes: List[Attribute], secret: bytes) -> Tuple[bytes, bytes]:
+    """
+    Builds an Access-Request or Accounting-Request.
+    returns: wire bytes, request authenticator (needed to verify the reply)
+    """
+    if code == ACCESS_REQUEST:
+        authenticator = os.urandom(16)
+        body = encode_attributes(attributes, secret, authenticator)
+        length = RADIUS_HEADER_LEN + len(body)
+        packet = struct.pack("!BBH", code, identifier, length) + authenticator + body
+    else:
+        # RFC 2866 3: MD5(code + id + length + 16 zero octets + attributes + secret)
+        body = encode_attributes(attributes, secret, b"\x00" * 16)
+        length = RADIUS_HEADER_LEN + len(body)
+        header = struct.pack("!BBH", code, identifier, length)
+        authenticator = hashlib.md5(header + b"\x00" * 16 + body + secret).digest()
+        packet = header + authenticator + body
+
+    if length > RADIUS_MAX_PACKET_LEN:
+        raise RadiusPacketError(f"RADIUS packet too long: {length}")
+    return packet, authenticator
+
+
+def _decode_value(data_type: str, data: bytes) -> Any:
+    if data_type == "integer" and len(data) == 4:
+        return struct.unpack("!I", data)[0]
+    if data_type == "ipaddr" and len(data) == 4:
+        return str(ipaddress.IPv4Address(data))
+    if data_type == "string":
+        return data.decode(errors="replace")
+    return data
+
+
+def decode_reply(data: bytes, secret: bytes, request_authenticator: bytes) -> RadiusPacket:
+    """Parses and authenticates a reply to a request sent with `request_authenticator`."""
+    if len(data) < RADIUS_HEADER_LEN:
+        raise RadiusPacketError("RADIUS reply shorter than header")
+
+    code, identifier, length = struct.unpack("!BBH", data[:4])
+    if length < RADIUS_HEADER_LEN or length > len(data):
+        raise RadiusPacketError(f"RADIUS reply length mismatch: {length}")
+    data = data[:length]
+
+    authenticator = data[4:20]
+    expected = hashlib.md5(data[:4] + request_authenticator + data[20:] + secret).digest()
+    if authenticator != expected:
+        raise RadiusPacketError("RADIUS reply authenticator mismatch")
+
+    packet = RadiusPacket(code=code, identifier=identifier, authenticator=authenticator)
+    pos = RADIUS_HEADER_LEN
+    while pos < length:
+        if pos + 2 > length:
+            raise RadiusPacketError("truncated RADIUS attribute")
+        attr_type, attr_len = data[pos], data[pos + 1]
+        if attr_len < 2 or pos + attr_len > length:
+            raise RadiusPacketError(f"bad RADIUS attribute length: {attr_len}")
+        value = data[pos + 2:pos + attr_len]
+        pos += attr_len
+
+        if attr_type == VENDOR_SPECIFIC and len(value) >= 6:
+            vendor_id = struct.unpack("!I", value[:4])[0]
+            if vendor_id == OSS_VENDOR_ID:
+                _decode_oss_vsa(packet, value[4:])
+                continue
+
+        if attr_type in _ATTRIBUTES_BY_TYPE:
+            name, data_type = _ATTRIBUTES_BY_TYPE[attr_type]
+            packet.attributes.append((name, _decode_value(data_type, value)))
+        else:
+            packet.attributes.append((f"Attr-{attr_type}", value))
+
+    return packet
+
+
+def _decode_oss_vsa(packet: RadiusPacket, data: bytes) -> None:
+    # One Vendor-Specific attribute may carry several sub-attributes
+    pos = 0
+    while pos + 2 <= len(data):
+        vendor_type, vendor_len = data[pos], data[pos + 1]
+        if vendor_len < 2 or pos + vendor_len > len(data):
+            return
+        value = data[pos + 2:pos + vendor_len]
+        pos += vendor_len
+
+        name = _OSS_ATTRIBUTES_BY_TYPE.get(vendor_type)
+        if name is not None and len(value) == 4:
+            packet.vendor_attributes[name] = struct.unpack("!I", value)[0]
@@ -1,49 +1,42 @@
 # COMMENT: All packet builders AI-generated because I didn't want to bother myself
 
-import asyncio
 import time
-import shlex
+from typing import List
 
+from lib.constants import RADIUS_CLIENT_POOL_SIZE, RADIUS_CLIENT_RETRIES, RADIUS_CLIENT_TIMEOUT_SECONDS
+from lib.radius.client import get_radius_client
+from lib.radius.packet import ACCESS_REQUEST, ACCOUNTING_REQUEST, Attribute, RadiusPacket
 from lib.radius.session import DHCPSession
 from lib.radius.utils import split_bytes_to_gigawords_octets
 from lib.secrets import __RADIUS_SECRET
 
-# Future: Move to somewhere so that this can be reused
+def _radius_client(server_ip: str, port: int, secret: str):
+    return get_radius_client(
+        server_ip,
+        port,
+        secret,
+        pool_size=RADIUS_CLIENT_POOL_SIZE,
+        timeout=RADIUS_CLIENT_TIMEOUT_SECONDS,
+        retries=RADIUS_CLIENT_RETRIES,
+    )
+
 async def rad_acct_send_from_bng(
-    packet: str,
+    packet: List[Attribute],
     server_ip: str,
     port: int = 1813,
     secret: str = __RADIUS_SECRET,
-    timeout: int = 1,
-):
-    pkt_q = shlex.quote(packet)
-    secret_q = shlex.quote(secret)
-    cmd = f"printf %s {pkt_q} | radclient -x -t {timeout} {server_ip}:{port} acct {secret_q}"
-    proc = await asyncio.create_subprocess_shell(
-        cmd,
-        stdout=asyncio.subprocess.PIPE,
-        stderr=asyncio.subprocess.STDOUT,
-    )
-    stdout, _ = await proc.communicate()
-    return stdout.decode() if stdout else ""
+) -> RadiusPacket | None:
+    """returns: the Accounting-Response, or None if the server never answered"""
+    return await _radius_client(server_ip, port, secret).request(ACCOUNTING_REQUEST, packet)
 
 async def rad_auth_send_from_bng(
-    packet: str,
+    packet: List[Attribute],
     server_ip: str,
     port: int = 1812,
     secret: str = __RADIUS_SECRET,
-    timeout: int = 1,
-):
-    pkt_q = shlex.quote(packet)
-    secret_q = shlex.quote(secret)
-    cmd = f"printf %s {pkt_q} | radclient -x -t {timeout} {server_ip}:{port} auth {secret_q}"
-    proc = await asyncio.create_subprocess_shell(
-        cmd,
-        stdout=asyncio.subprocess.PIPE,
-        stderr=asyncio.subprocess.STDOUT,
-    )
-    stdout, _ = await proc.communicate()
-    return stdout.decode() if stdout else ""
+) -> RadiusPacket | None:
+    """returns: the Access-Accept/Reject, or None if the server never answered"""
+    return await _radius_client(server_ip, port, secret).request(ACCESS_REQUEST, packet)
 
 def acct_session_id(session_id: str) -> str:
     return f"{session_id}"
@@ -55,20 +48,19 @@ def acct_user_name(s: DHCPSession) -> str:
     # Keep RADIUS User-Name consistent with SQL escaping (escape '|' and ':')
     return user.replace("|", "=7C")
 
-def build_acct_start(s: DHCPSession, nas_ip="192.0.2.1", nas_port_id="eth0") -> str:
+def build_acct_start(s: DHCPSession, nas_ip="192.0.2.1", nas_port_id="eth0") -> List[Attribute]:
     now = int(time.time())
-    return "\n".join([
-        "Acct-Status-Type = Start",
-        f'User-Name = "{acct_user_name(s)}"',
-        f'Acct-Session-Id = "{acct_session_id(s.session_id)}"',
-        f"Framed-IP-Address = {s.ip}",
-        f'Calling-Station-Id = "{s.mac.lower()}"',
-        f"NAS-IP-Address = {nas_ip}",
-        f'NAS-Port-Id = "{nas_port_id}"',
-        "NAS-Port-Type = Ethernet",
-        f"Event-Timestamp = {now}",
-        "",
-    ])
+    return [
+        ("Acct-Status-Type", "Start"),
+        ("User-Name", acct_user_name(s)),
+        ("Acct-Session-Id", acct_session_id(s.session_id)),
+        ("Framed-IP-Address", s.ip),
+        ("Calling-Station-Id", s.mac.lower()),
+        ("NAS-IP-Address", nas_ip),
+        ("NAS-Port-Id", nas_port_id),
+        ("NAS-Port-Type", "Ethernet"),
+        ("Event-Timestamp", now),
+    ]
 
 def build_acct_stop(
     s: "DHCPSession",
@@ -79,37 +71,36 @@ def build_acct_stop(
     nas_ip: str = "192.0.2.1",
     nas_port_id: str = "eth0",
     cause: str = "User-Request",
-) -> str:
+) -> List[Attribute]:
     now = int(time.time())
     duration = max(0, int(time.time() - s.first_seen))
 
     in_gw, in_oct = split_bytes_to_gigawords_octets(input_bytes)
     out_gw, out_oct = split_bytes_to_gigawords_octets(output_bytes)
 
-    return "\n".join([
-        "Acct-Status-Type = Stop",
-        f'User-Name = "{acct_user_name(s)}"',
-        f'Acct-Session-Id = "{acct_session_id(s.session_id)}"',
-        f"Framed-IP-Address = {s.ip}",
-        f'Calling-Station-Id = "{s.mac.lower()}"',
-        f"NAS-IP-Address = {nas_ip}",
-        f'NAS-Port-Id = "{nas_port_id}"',
-        "NAS-Port-Type = Ethernet",
-        f"Acct-Session-Time = {duration}",
-        f'Acct-Terminate-Cause = "{cause}"',
-        f"Event-Timestamp = {now}",
+    return [
+        ("Acct-Status-Type", "Stop"),
+        ("User-Name", acct_user_name(s)),
+        ("Acct-Session-Id", acct_session_id(s.session_id)),
+        ("Framed-IP-Address", s.ip),
+        ("Calling-Station-Id", s.mac.lower()),
+        ("NAS-IP-Address", nas_ip),
+        ("NAS-Port-Id", nas_port_id),
+        ("NAS-Port-Type", "Ethernet"),
+        ("Acct-Session-Time", duration),
+        ("Acct-Terminate-Cause", cause), # BNG-internal causes are mapped to RFC 2866 values on encode
+        ("Event-Timestamp", now),
 
         # Bytes (64-bit via octets+gigawords)
-        f"Acct-Input-Octets = {in_oct}",
-        f"Acct-Input-Gigawords = {in_gw}",
-        f"Acct-Output-Octets = {out_oct}",
-        f"Acct-Output-Gigawords = {out_gw}",
+        ("Acct-Input-Octets", in_oct),
+        ("Acct-Input-Gigawords", in_gw),
+        ("Acct-Output-Octets", out_oct),
+        ("Acct-Output-Gigawords", out_gw),
 
         # Packets (32-bit best-effort; no standard gigawords field)
-        f"Acct-Input-Packets = {max(0, int(input_pkts))}",
-        f"Acct-Output-Packets = {max(0, int(output_pkts))}",
-        "",
-    ])
+        ("Acct-Input-Packets", max(0, int(input_pkts))),
+        ("Acct-Output-Packets", max(0, int(output_pkts))),
+    ]
 
 
 def build_acct_interim(
@@ -120,62 +111,59 @@ def build_acct_interim(
     output_pkts: int,
     nas_ip: str = "192.0.2.1",
     nas_port_id: str = "eth0",
-) -> str:
+) -> List[Attribute]:
     now = int(time.time())
     session_time = max(0, int(time.time() - s.first_seen))
 
     in_gw, in_oct = split_bytes_to_gigawords_octets(input_bytes)
     out_gw, out_oct = split_bytes_to_gigawords_octets(output_bytes)
 
-    return "\n".join([
-        "Acct-Status-Type = Interim-Update",
-        f'User-Name = "{acct_user_name(s)}"',
-        f'Acct-Session-Id = "{acct_session_id(s.session_id)}"',
-        f"Framed-IP-Address = {s.ip}",
-        f'Calling-Station-Id = "{s.mac.lower()}"',
-        f"NAS-IP-Address = {nas_ip}",
-        f'NAS-Port-Id = "{nas_port_id}"',
-        "NAS-Port-Type = Ethernet",
-        f"Acct-Session-Time = {session_time}",
-        f"Event-Timestamp = {now}",
+    return [
+        ("Acct-Status-Type", "Interim-Update"),
+        ("User-Name", acct_user_name(s)),
+        ("Acct-Session-Id", acct_session_id(s.session_id)),
+        ("Framed-IP-Address", s.ip),
+        ("Calling-Station-Id", s.mac.lower()),
+        ("NAS-IP-Address", nas_ip),
+        ("NAS-Port-Id", nas_port_id),
+        ("NAS-Port-Type", "Ethernet"),
+        ("Acct-Session-Time", session_time),
+        ("Event-Timestamp", now),
 
         # Bytes (64-bit via octets+gigawords)
-        f"Acct-Input-Octets = {in_oct}",
-        f"Acct-Input-Gigawords = {in_gw}",
-        f"Acct-Output-Octets = {out_oct}",
-        f"Acct-Output-Gigawords = {out_gw}",
+        ("Acct-Input-Octets", in_oct),
+        ("Acct-Input-Gigawords", in_gw),
+        ("Acct-Output-Octets", out_oct),
+        ("Acct-Output-Gigawords", out_gw),
 
         # Packets (32-bit best-effort)
-        f"Acct-Input-Packets = {max(0, int(input_pkts))}",
-        f"Acct-Output-Packets = {max(0, int(output_pkts))}",
-        "",
-    ])
+        ("Acct-Input-Packets", max(0, int(input_pkts))),
+        ("Acct-Output-Packets", max(0, int(output_pkts))),
+    ]
 
 def build_access_request(
     s: DHCPSession,
     user_password: str = "testing123",
     nas_ip: str = "192.0.2.1",
     nas_port_id: str = "eth0",
-) -> str:
+) -> List[Attribute]:
     """
-    Returns a radclient-compatible Access-Request attribute list.
-    Use with: radclient -x <radius_ip> auth <secret>
+    Returns an Access-Request attribute list.
+    Use with: rad_auth_send_from_bng
     """
     now = int(time.time())
     mac = s.mac.lower()
 
     print(f"Building Access-Request for User-Name: {acct_user_name(s)}, MAC: {mac}, IP: {s.ip}")
 
-    return "\n".join([
-        # RADIUS auth type implied by radclient 'auth' (Access-Request)
-        f'User-Name = "{acct_user_name(s)}"',
-        f'User-Password = "{user_password}"',          # lab-simple PAP
-        f'Calling-Station-Id = "{mac}"',               # who is calling (subscriber MAC)
-        f'Called-Station-Id = "{nas_port_id}"',        # optional; can be iface or BNG id
-        f"Framed-IP-Address = {s.ip}",                 # IP the subscriber got via DHCP
-        f"NAS-IP-Address = {nas_ip}",
-        f'NAS-Port-Id = "{nas_port_id}"',
-        "NAS-Port-Type = Ethernet",
-        f"Event-Timestamp = {now}",
-        "",
-    ])
+    return [
+        ("User-Name", acct_user_name(s)),
+        ("User-Password", user_password),          # lab-simple PAP
+        ("Calling-Station-Id", mac),               # who is calling (subscriber MAC)
+        ("Called-Station-Id", nas_port_id),        # optional; can be iface or BNG id
+        ("Framed-IP-Address", s.ip),               # IP the subscriber got via DHCP
+        ("NAS-IP-Address", nas_ip),
+        ("NAS-Port-Id", nas_port_id),
+        ("NAS-Port-Type", "Ethernet"),
+        ("Event-Timestamp", now),
+    ]
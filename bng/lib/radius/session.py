@@ -1,53 +1,268 @@
-from typing import Literal
-from dataclasses import dataclass, field
+import socket
+import sys
 import uuid
+from typing import Any, Literal
+
+# Sessions are the BNG's bulk memory, so a session packs what it can: IPs and MACs as ints, the
+# session id as a 128-bit int, option-82 identifiers interned (shared with the SessionStore keys).
+# Values that don't round-trip exactly are kept as given, so readers always get back what was set.
+
+
+def pack_ip(ip: str | None) -> int | str | None:
+    if ip is None:
+        return None
+    try:
+        packed = int.from_bytes(socket.inet_aton(ip), "big")
+    except (OSError, TypeError, ValueError):
+        return ip
+    return packed if unpack_ip(packed) == ip else ip
+
+
+def unpack_ip(packed: int | str | None) -> str | None:
+    if isinstance(packed, int):
+        return socket.inet_ntoa(packed.to_bytes(4, "big"))
+    return packed
+
+
+def pack_mac(mac: str | None) -> int | str | None:
+    if mac is None or len(mac) != 17:
+        return mac
+    try:
+        packed = int(mac.replace(":", ""), 16)
+    except ValueError:
+        return mac
+    return packed if unpack_mac(packed) == mac else mac
+
+
+def unpack_mac(packed: int | str | None) -> str | None:
+    if isinstance(packed, int):
+        return packed.to_bytes(6, "big").hex(":")
+    return packed
+
+
+def pack_session_id(session_id: str) -> int | str:
+    try:
+        packed = uuid.UUID(session_id)
+    except (ValueError, AttributeError, TypeError):
+        return session_id
+    # Only canonical lowercase UUIDs round-trip exactly
+    return packed.int if str(packed) == session_id else session_id
+
+
+def unpack_session_id(packed: int | str) -> str:
+    if isinstance(packed, int):
+        # Same as str(uuid.UUID(int=packed)), without building the UUID
+        h = f"{packed:032x}"
+        return f"{h[:8]}-{h[8:12]}-{h[12:16]}-{h[16:20]}-{h[20:]}"
+    return packed
+
+
+def _intern(value: str | None) -> str | None:
+    return sys.intern(value) if isinstance(value, str) else value
+
 
-@dataclass
 class DHCPSession:
-    mac: str | None
-    ip: str | None
-    first_seen: float
-    last_seen: float
-    expiry: int | None
-    iface: str
-    hostname: str | None
-    last_interim: float | None # For Interim-Update tracking
-
-    # opt82
-    relay_id: str
-    remote_id: str
-    circuit_id: str
-
-    # Unique session ID for event tracking
-    session_id: str = field(default_factory=lambda: str(uuid.uuid4()))
-
-    # QoS parameters
-    qos_download_kbit: int | None = None
-    qos_upload_kbit: int | None = None
-    qos_download_burst_kbit: int | None = None
-    qos_upload_burst_kbit: int | None = None
-
-    # nftables related data
-    nft_up_handle: int | None = None
-    nft_down_handle: int | None = None
-
-    base_up_bytes: int = 0
-    base_down_bytes: int = 0
-    base_up_pkts: int = 0
-    base_down_pkts: int = 0
-
-    # None if no data yet
-    last_up_bytes: int | None = None
-    last_down_bytes: int | None = None
-    last_traffic_seen_ts: float | None = None
-    last_idle_ts: float | None = None
-
-    status: Literal["ACTIVE", "IDLE", "EXPIRED", "PENDING"] = "PENDING"
-    auth_state: Literal["PENDING_AUTH", "AUTHORIZED", "REJECTED"] = "PENDING_AUTH"
-    last_status_change_ts: float | None = None
-
-
-    dhcp_nak_count: int = 0
+    __slots__ = (
+        "_mac",
+        "_ip",
+        "first_seen",
+        "last_seen",
+        "_expiry",
+        "iface",
+        "hostname",
+        "last_interim",
+        "relay_id",
+        "remote_id",
+        "circuit_id",
+        "_session_id",
+        "qos_download_kbit",
+        "qos_upload_kbit",
+        "qos_download_burst_kbit",
+        "qos_upload_burst_kbit",
+        "tc_classid",
+        "nft_up_handle",
+        "nft_down_handle",
+        "base_up_bytes",
+        "base_down_bytes",
+        "base_up_pkts",
+        "base_down_pkts",
+        "last_up_bytes",
+        "last_down_bytes",
+        "last_traffic_seen_ts",
+        "last_idle_ts",
+        "_status",
+        "_auth_state",
+        "auth_retry_attempts",
+        "last_status_change_ts",
+        "dhcp_nak_count",
+        "_index",
+    )
+
+    def __init__(
+        self,
+        mac: str | None,
+        ip: str | None,
+        first_seen: float,
+        last_seen: float,
+        expiry: int | None,
+        iface: str,
+        hostname: str | None,
+        last_interim: float | None, # For Interim-Update tracking
+
+        # opt82
+        relay_id: str,
+        remote_id: str,
+        circuit_id: str,
+
+        # Unique session ID for event tracking
+        session_id: str | None = None,
+
+        # QoS parameters
+        qos_download_kbit: int | None = None,
+        qos_upload_kbit: int | None = None,
+        qos_download_burst_kbit: int | None = None,
+        qos_upload_burst_kbit: int | None = None,
+        # HTB minor id allocated for this subscriber, None if not shaped
+        tc_classid: int | None = None,
+
+        # nftables related data
+        nft_up_handle: int | None = None,
+        nft_down_handle: int | None = None,
+
+        base_up_bytes: int = 0,
+        base_down_bytes: int = 0,
+        base_up_pkts: int = 0,
+        base_down_pkts: int = 0,
+
+        # None if no data yet
+        last_up_bytes: int | None = None,
+        last_down_bytes: int | None = None,
+        last_traffic_seen_ts: float | None = None,
+        last_idle_ts: float | None = None,
+
+        status: Literal["ACTIVE", "IDLE", "EXPIRED", "PENDING"] = "PENDING",
+        auth_state: Literal["PENDING_AUTH", "AUTHORIZED", "REJECTED"] = "PENDING_AUTH",
+        auth_retry_attempts: int = 0, # Consecutive failed Access-Requests, drives the auth-retry backoff
+        last_status_change_ts: float | None = None,
+
+        dhcp_nak_count: int = 0,
+    ) -> None:
+        # (SessionStore, key) while the session is held by a store
+        self._index: Any = None
+
+        self._mac = pack_mac(mac)
+        self._ip = pack_ip(ip)
+        self.first_seen = first_seen
+        self.last_seen = last_seen
+        self._expiry = expiry
+        self.iface = _intern(iface)
+        self.hostname = hostname
+        self.last_interim = last_interim
+
+        self.relay_id = _intern(relay_id)
+        self.remote_id = _intern(remote_id)
+        self.circuit_id = _intern(circuit_id)
+
+        self._session_id = pack_session_id(session_id if session_id is not None else str(uuid.uuid4()))
+
+        self.qos_download_kbit = qos_download_kbit
+        self.qos_upload_kbit = qos_upload_kbit
+        self.qos_download_burst_kbit = qos_download_burst_kbit
+        self.qos_upload_burst_kbit = qos_upload_burst_kbit
+        self.tc_classid = tc_classid
+
+        self.nft_up_handle = nft_up_handle
+        self.nft_down_handle = nft_down_handle
+
+        self.base_up_bytes = base_up_bytes
+        self.base_down_bytes = base_down_bytes
+        self.base_up_pkts = base_up_pkts
+        self.base_down_pkts = base_down_pkts
+
+        self.last_up_bytes = last_up_bytes
+        self.last_down_bytes = last_down_bytes
+        self.last_traffic_seen_ts = last_traffic_seen_ts
+        self.last_idle_ts = last_idle_ts
+
+        self._status = sys.intern(status)
+        self._auth_state = sys.intern(auth_state)
+        self.auth_retry_attempts = auth_retry_attempts
+        self.last_status_change_ts = last_status_change_ts
+
+        self.dhcp_nak_count = dhcp_nak_count
+
+    @property
+    def mac(self) -> str | None:
+        return unpack_mac(self._mac)
+
+    @mac.setter
+    def mac(self, value: str | None) -> None:
+        self._mac = pack_mac(value)
+        if self._index is not None:
+            self._index[0].touch(self._index[1])
+
+    @property
+    def ip(self) -> str | None:
+        return unpack_ip(self._ip)
+
+    @ip.setter
+    def ip(self, value: str | None) -> None:
+        self._ip = pack_ip(value)
+        if self._index is not None:
+            self._index[0].touch(self._index[1])
+
+    @property
+    def session_id(self) -> str:
+        return unpack_session_id(self._session_id)
+
+    @session_id.setter
+    def session_id(self, value: str) -> None:
+        self._session_id = pack_session_id(value)
+        if self._index is not None:
+            self._index[0].touch(self._index[1])
+
+    # status, auth_state and expiry are indexed by the SessionStore holding the session; they and the
+    # identity fields above also mark the session touched for replication
+
+    @property
+    def status(self) -> Literal["ACTIVE", "IDLE", "EXPIRED", "PENDING"]:
+        return self._status # type: ignore[return-value]
+
+    @status.setter
+    def status(self, value: str) -> None:
+        old = self._status
+        self._status = sys.intern(value)
+        if self._index is not None and old != value:
+            self._index[0]._reindex(self._index[1], "status", old, value)
+
+    @property
+    def auth_state(self) -> Literal["PENDING_AUTH", "AUTHORIZED", "REJECTED"]:
+        return self._auth_state # type: ignore[return-value]
+
+    @auth_state.setter
+    def auth_state(self, value: str) -> None:
+        old = self._auth_state
+        self._auth_state = sys.intern(value)
+        if self._index is not None and old != value:
+            self._index[0]._reindex(self._index[1], "auth_state", old, value)
+
+    @property
+    def expiry(self) -> int | None:
+        return self._expiry
+
+    @expiry.setter
+    def expiry(self, value: int | None) -> None:
+        old = self._expiry
+        self._expiry = value
+        if self._index is not None and old != value:
+            self._index[0]._reindex(self._index[1], "expiry", old, value)
+
+    def __repr__(self) -> str:
+        return (
+            f"DHCPSession(session_id={self.session_id!r}, mac={self.mac!r}, ip={self.ip!r}, "
+            f"relay_id={self.relay_id!r}, circuit_id={self.circuit_id!r}, remote_id={self.remote_id!r}, "
+            f"status={self.status!r}, auth_state={self.auth_state!r}, expiry={self.expiry!r})"
+        )
 
     def access_key(self) -> str:
         """Generate a unique key for this session based on MAC, IP, and first seen timestamp."""
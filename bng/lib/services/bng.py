@@ -2,7 +2,8 @@
 Compatibility entrypoint for the BNG runtime.
 
 The implementation is split across focused modules:
-- bng_loop.py: runtime orchestration and single-writer command loop
+- bng_loop.py: runtime orchestration, event routing and the command loop
+- session_shard.py: per-shard session state and its single-writer loop
 - bng_dhcp.py: DHCP event handling and lease reconciliation
 - bng_session.py: session/radius/nftables primitives
 - bng_coad.py: CoA IPC bridge
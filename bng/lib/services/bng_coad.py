@@ -2,11 +2,13 @@ import asyncio
 import json
 from typing import Any
 
+from lib.mailbox import MailboxChannel
+
 
 async def handle_coad_connection(
     reader: asyncio.StreamReader,
     writer: asyncio.StreamWriter,
-    command_queue: asyncio.Queue[tuple[str, dict[str, Any]]],
+    command_queue: MailboxChannel,
 ) -> None:
     """Bridge CoA IPC requests into the single-writer command queue."""
     try:
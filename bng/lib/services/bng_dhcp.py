@@ -3,20 +3,19 @@ import os
 import time
 import uuid
 from dataclasses import dataclass
-from typing import Awaitable, Callable
+from typing import Awaitable, Callable, List, Set
 
-from lib.constants import (
-    DHCP_NAK_TERMINATE_COUNT_THRESHOLD,
-    TOMBSTONE_EXPIRY_GRACE_SECONDS,
-    TOMBSTONE_TTL_SECONDS,
-)
+from lib.constants import DHCP_NAK_TERMINATE_COUNT_THRESHOLD, KEA_LEASE_PAGE_SIZE, KEA_SUBNET_IDS
+from lib.dhcp.lease import DHCPLease
+from lib.dhcp.lease_cache import EXPIRY_TOLERANCE_SECONDS, SniffedLeaseCache
+from lib.dhcp.lease_events import LEASE_EVENT_ADD, LEASE_EVENT_RELEASE, LEASE_EVENT_UPDATE, LeaseEvent
 from lib.dhcp.lease_service import KeaClient, KeaLeaseService
 from lib.dhcp.utils import format_mac
-from lib.nftables.helpers import nft_delete_rule_by_handle, nft_list_chain_rules, nft_remove_ip
+from lib.nftables.helpers import nft_delete_subscriber_rules, nft_get_counter_snapshot, nft_remove_ip
 from lib.radius.session import DHCPSession
 from lib.secrets import __KEA_CTRL_AGENT_PASSWORD, __RADIUS_SECRET
 from lib.services.bng_session import (
-    SessionMap,
+    SessionKey,
     SessionsByIPMap,
     SessionsBySessionIDMap,
     Tombstone,
@@ -25,20 +24,41 @@ from lib.services.bng_session import (
     decode_bytes,
     get_counters_for_session,
     install_rules_and_baseline,
+    refresh_authed_ip,
+    session_shard_index,
     terminate_session,
 )
+from lib.services.bng_metrics import get_metrics
+from lib.services.session_bringup import bring_up_session, bring_up_sessions
+from lib.services.session_store import SessionStore
 from lib.services.event_dispatcher import BNGEventDispatcher
 from lib.services.traffic_shaper import BNGTrafficShaper
 
 
 @dataclass
 class DHCPRuntimeState:
-    reconcile_handler: Callable[[], Awaitable[None]]
-    sessions: SessionMap
+    reconcile_handler: Callable[[Set[SessionKey] | None], Awaitable[None]]
+    sessions: SessionStore
     sessions_by_ip: SessionsByIPMap
     sessions_by_session_id: SessionsBySessionIDMap
     tombstones: TombstoneMap
     handle_dhcp_event: Callable[[dict], Awaitable[None]]
+    expire_sessions: Callable[[List[SessionKey]], Awaitable[None]]
+    kea_anti_entropy: Callable[[List[DHCPLease] | None], Awaitable[None]]
+    handle_lease_event: Callable[[LeaseEvent], Awaitable[None]]
+    warm_restart: Callable[[List[DHCPSession], List[DHCPSession]], Awaitable[None]]
+
+
+def new_kea_lease_service(bng_id: str, kea_ctrl_agent_auth_key: str = __KEA_CTRL_AGENT_PASSWORD) -> KeaLeaseService:
+    """returns: a lease service for this BNG's relay_id, over the Kea control agent at BNG_KEA_CTRL_URL"""
+    kea_ctrl_url = os.getenv("BNG_KEA_CTRL_URL", "http://198.18.0.3:6772")
+    kea_client = KeaClient(base_url=kea_ctrl_url, auth_key=kea_ctrl_agent_auth_key)
+    return KeaLeaseService(
+        kea_client,
+        bng_relay_id=bng_id,
+        subnets=KEA_SUBNET_IDS,
+        page_size=KEA_LEASE_PAGE_SIZE,
+    )
 
 
 def dhcp_lease_handler(
@@ -52,16 +72,21 @@ def dhcp_lease_handler(
     nas_ip: str = "198.18.0.1",
     nas_port_id: str = "eth0",
     kea_ctrl_agent_auth_key: str = __KEA_CTRL_AGENT_PASSWORD,
+    kea_lease_service: KeaLeaseService | None = None, # Shared between shards; a runtime of its own otherwise
+    shard: int = 0,
+    shards: int = 1, # Sessions of the other shards are left to their own runtimes
 ) -> DHCPRuntimeState:
     _ = bng_instance_id
-    sessions: SessionMap = {}
-    sessions_by_ip: SessionsByIPMap = {}
-    sessions_by_session_id: SessionsBySessionIDMap = {}
+    sessions = SessionStore()
+    sessions_by_ip: SessionsByIPMap = sessions.by_ip
+    sessions_by_session_id: SessionsBySessionIDMap = sessions.by_session_id
     tombstones: TombstoneMap = {}
 
-    kea_ctrl_url = os.getenv("BNG_KEA_CTRL_URL", "http://198.18.0.3:6772")
-    kea_client = KeaClient(base_url=kea_ctrl_url, auth_key=kea_ctrl_agent_auth_key)
-    kea_lease_service = KeaLeaseService(kea_client, bng_relay_id=bng_id)
+    if kea_lease_service is None:
+        kea_lease_service = new_kea_lease_service(bng_id, kea_ctrl_agent_auth_key)
+    # Authoritative lease state for the reconciler, fed by sniffed ACK/RELEASE; Kea is only anti-entropy
+    lease_cache = SniffedLeaseCache(relay_id=bng_id)
+    metrics = get_metrics()
 
     async def handle_dhcp_request(circuit_id: str, remote_id: str, chaddr: str, event: dict):
         # Creates an initial session so that we can correlated to corresponding DHCP ACK/NAK
@@ -125,6 +150,9 @@ def dhcp_lease_handler(
             if chaddr is None or not isinstance(chaddr, str):
                 raise RuntimeError("DHCP ACK missing chaddr")
 
+            if leased_ip != "0.0.0.0":
+                lease_cache.on_ack(circuit_id, remote_id, leased_ip, format_mac(chaddr), expiry, now)
+
             s = sessions.get(key)
             if s:
                 tombstones.pop(key, None)
@@ -150,15 +178,13 @@ def dhcp_lease_handler(
                     s.last_status_change_ts = now
                     s.last_idle_ts = None
                     s.last_traffic_seen_ts = None
+                    await refresh_authed_ip(s)
                     return
 
                 if s.ip is not None and s.auth_state == "AUTHORIZED":
                     # IP change for an active authed session - terminated and recreate
                     
-                    if s.nft_up_handle is not None:
-                        await nft_delete_rule_by_handle(s.nft_up_handle)
-                    if s.nft_down_handle is not None:
-                        await nft_delete_rule_by_handle(s.nft_down_handle)
+                    await nft_delete_subscriber_rules(s.ip, s.nft_up_handle, s.nft_down_handle)
 
                     await terminate_session(
                         s,
@@ -182,31 +208,28 @@ def dhcp_lease_handler(
                 s.status = "ACTIVE"
                 s.last_status_change_ts = now
                 sessions_by_ip[s.ip] = s
-                await event_dispatcher.dispatch_session_start(s)
 
                 print(f"DHCP SESSION START mac={s.mac} ip={s.ip} iface={iface} hostname={s.hostname}")
 
                 try:
                     # Authentication for both new session and renewed session with diff IP
-                    result = await authorize_session(
+                    result = await bring_up_session(
                         s,
-                        leased_ip,
-                        s.mac,
-                        iface,
-                        radius_server_ip,
-                        radius_secret,
-                        nas_ip,
-                        nas_port_id,
-                        ensure_rules=True,
+                        iface=iface,
+                        radius_server_ip=radius_server_ip,
+                        radius_secret=radius_secret,
+                        nas_ip=nas_ip,
+                        nas_port_id=nas_port_id,
                         traffic_shaper=traffic_shaper,
+                        event_dispatcher=event_dispatcher,
+                        received_at=event.get("received_at"),
                     )
                     if result == "REJECTED":
                         print(f"RADIUS Access-Reject received for mac={s.mac} ip={s.ip}")
                     elif result == "AUTHORIZED":
                         print(f"RADIUS Access-Accept received for mac={s.mac} ip={s.ip}")
-                    await event_dispatcher.dispatch_policy_apply(s)
                 except Exception as e:
-                    print(f"RADIUS Acct-Start failed for mac={s.mac} ip={s.ip}: {e}")
+                    print(f"RADIUS Access-Request failed for mac={s.mac} ip={s.ip}: {e}")
             else:
                 print("Found DHCP ACK for unknown session")
         except Exception as e:
@@ -223,7 +246,8 @@ def dhcp_lease_handler(
 
     async def handle_dhcp_release(ip: str):
         now = time.time()
-        nftables_snapshot = await nft_list_chain_rules()
+        lease_cache.on_release(ip)
+        nftables_snapshot = await nft_get_counter_snapshot()
 
         s = sessions_by_ip.pop(ip, None)
         if s is None:
@@ -300,20 +324,42 @@ def dhcp_lease_handler(
                 f"circuit_id={circuit_id} remote_id={remote_id} chaddr={chaddr}"
             )
 
-    async def reconcile_handler():
+    async def handle_lease_event(event: LeaseEvent):
+        # Lease change pushed by Kea; the sniffer has usually seen the same exchange already
+        if event.relay_id != bng_id:
+            return
+        key = (bng_id, event.circuit_id, event.remote_id)
+        cached = lease_cache.get(key)
+
+        if event.kind in (LEASE_EVENT_ADD, LEASE_EVENT_UPDATE):
+            if cached is not None and cached.ip == event.ip and cached.expiry >= event.expiry - EXPIRY_TOLERANCE_SECONDS:
+                return
+            print(f"Lease event: {event.kind} ip={event.ip} circuit: {event.circuit_id} not seen by the sniffer")
+            lease_cache.on_ack(event.circuit_id, event.remote_id, event.ip, format_mac(event.mac), event.expiry)
+            return
+
+        # expire/release: ignore if the subscriber already moved on to another IP or renewed since
+        if cached is None or cached.ip != event.ip or cached.expiry > event.expiry + EXPIRY_TOLERANCE_SECONDS:
+            return
+        lease_cache.on_release(event.ip)
+
+        s = sessions_by_ip.get(event.ip)
+        if event.kind == LEASE_EVENT_RELEASE and s is not None and (s.circuit_id, s.remote_id) == key[1:]:
+            print(f"Lease event: release ip={event.ip} circuit: {event.circuit_id} not seen by the sniffer")
+            await handle_dhcp_release(event.ip)
+
+    async def reconcile_handler(scope: Set[SessionKey] | None = None):
+        # scope: only reconcile these session keys, None for everything
         now = time.time()
-        leases = await kea_lease_service.get_all_leases()
+        leases = await lease_cache.get_all_leases()
         current = {(bng_id, l.circuit_id, l.remote_id): l for l in leases}
+        if scope is not None:
+            current = {key: l for key, l in current.items() if key in scope}
 
-        for key, t in list(tombstones.items()):
-            expired_by_lease = (
-                t.latest_state_update_ts_at_stop
-                and now >= (t.latest_state_update_ts_at_stop + TOMBSTONE_EXPIRY_GRACE_SECONDS)
-            )
-            expired_by_ttl = now - t.stopped_at >= TOMBSTONE_TTL_SECONDS
-            if expired_by_lease or expired_by_ttl:
-                tombstones.pop(key, None)
+        # New sessions are brought up together after the walk, see bring_up_sessions
+        discovered: List[DHCPSession] = []
 
+        # Tombstone expiry is driven by the loop's session timers
         for key, l in current.items():
             tombstone = tombstones.get(key)
             if tombstone is not None:
@@ -341,31 +387,8 @@ def dhcp_lease_handler(
                     sessions[key] = s
                     sessions_by_ip[l.ip] = s
                     sessions_by_session_id[s.session_id] = s
-
-                    await install_rules_and_baseline(s, l.ip, l.mac, iface)
-                    await event_dispatcher.dispatch_session_start(s)
+                    discovered.append(s)
                     print(f"Reconciler: DHCP SESSION START mac={l.mac} ip={l.ip} iface={iface} hostname={l.hostname}")
-
-                    try:
-                        result = await authorize_session(
-                            s,
-                            l.ip,
-                            l.mac,
-                            iface,
-                            radius_server_ip,
-                            radius_secret,
-                            nas_ip,
-                            nas_port_id,
-                            ensure_rules=True,
-                            traffic_shaper=traffic_shaper,
-                        )
-                        if result == "REJECTED":
-                            print(f"RADIUS Access-Reject received for mac={l.mac} ip={l.ip}")
-                        elif result == "AUTHORIZED":
-                            print(f"RADIUS Access-Accept received for mac={l.mac} ip={l.ip}")
-                        await event_dispatcher.dispatch_policy_apply(s)
-                    except Exception as e:
-                        print(f"Reconciler: RADIUS Acct-Start failed for mac={l.mac} ip={l.ip}: {e}")
                 except Exception as e:
                     print(f"Reconciler: Failed to create DHCP session for mac={l.mac} ip={l.ip}: {e}")
             else:
@@ -413,6 +436,7 @@ def dhcp_lease_handler(
 
                 if s.expiry is not None and s.expiry != l.expiry:
                     s.expiry = l.expiry
+                    await refresh_authed_ip(s)
 
                 s.last_seen = now
 
@@ -458,7 +482,7 @@ def dhcp_lease_handler(
                             last_traffic_seen_ts=s.last_traffic_seen_ts,
                         )
 
-                        nftables_snapshot = await nft_list_chain_rules()
+                        nftables_snapshot = await nft_get_counter_snapshot()
                         old_in, old_out, old_in_pkts, old_out_pkts = await get_counters_for_session(
                             old_session, nftables_snapshot
                         )
@@ -510,19 +534,32 @@ def dhcp_lease_handler(
                         print(f"RADIUS Access-Accept received for mac={s.mac} new_ip={s.ip}")
                     await event_dispatcher.dispatch_policy_apply(s)
 
-        ended = []
-        for key, s in list(sessions.items()):
-            l = current.get(key)
-            if l is None:
-                if s.expiry is not None and now >= s.expiry:
-                    ended.append(key)
-            elif l._kea_state != 0:
-                ended.append(key)
+        if discovered:
+            await bring_up_sessions(
+                discovered,
+                iface=iface,
+                radius_server_ip=radius_server_ip,
+                radius_secret=radius_secret,
+                nas_ip=nas_ip,
+                nas_port_id=nas_port_id,
+                traffic_shaper=traffic_shaper,
+                event_dispatcher=event_dispatcher,
+            )
+
+        # Only sessions already past their expiry can have silently lost their lease
+        ended = [
+            key for key in sessions.expired_keys(now)
+            if (scope is None or key in scope) and key not in current
+        ]
+        ended += [key for key, l in current.items() if l._kea_state != 0 and key in sessions]
+
+        await end_sessions(ended, now)
 
+    async def end_sessions(ended: List[SessionKey], now: float):
         nftables_snapshot = None
         if ended:
             try:
-                nftables_snapshot = await nft_list_chain_rules()
+                nftables_snapshot = await nft_get_counter_snapshot()
             except Exception as e:
                 print(f"Failed to get nftables snapshot for Acct-Stop: {e}")
 
@@ -548,6 +585,78 @@ def dhcp_lease_handler(
             ):
                 print(f"RADIUS Acct-Stop sent for mac={s.mac} ip={s.ip}")
 
+    async def kea_anti_entropy(kea_leases: List[DHCPLease] | None = None):
+        # Slow pass against Kea: report where the sniffed cache diverged and adopt Kea's view there.
+        # `kea_leases` is this shard's part of a dump the caller already made; without it Kea is asked here
+        if kea_leases is None:
+            kea_leases = await kea_lease_service.get_all_leases()
+            metrics.incr("kea_leases_changed", kea_lease_service.last_sync_changed)
+            if shards > 1:
+                kea_leases = [l for l in kea_leases if session_shard_index(l.circuit_id, l.remote_id, shards) == shard]
+        metrics.incr("kea_leases_synced", len(kea_leases))
+
+        lease_cache.prune()
+        divergences = lease_cache.diff(kea_leases)
+        for d in divergences:
+            metrics.incr(f"lease_divergence_{d.kind}")
+            print(
+                f"Lease anti-entropy: {d.kind} key={d.key} "
+                f"cached={(d.cached.ip, d.cached.expiry) if d.cached else None} "
+                f"kea={(d.kea.ip, d.kea.expiry) if d.kea else None}"
+            )
+        lease_cache.apply(divergences)
+        print(f"Lease anti-entropy: {len(kea_leases)} Kea leases, {len(divergences)} divergences")
+
+    async def expire_sessions(keys: List[SessionKey]):
+        # Lease-expiry timers: end sessions whose lease ran out without a renew being seen
+        now = time.time()
+        await end_sessions(
+            [key for key in keys if key in sessions and sessions[key].expiry is not None and now >= sessions[key].expiry],
+            now,
+        )
+
+    async def warm_restart(adopted: List[DHCPSession], diverged: List[DHCPSession]):
+        # Checkpointed sessions sorted by session_checkpoint.match_data_plane: adopt or tear down
+        now = time.time()
+        for s in adopted:
+            key = (bng_id, s.circuit_id, s.remote_id)
+            sessions[key] = s
+            sessions_by_ip[s.ip] = s
+            sessions_by_session_id[s.session_id] = s
+            lease_cache.on_ack(s.circuit_id, s.remote_id, s.ip, s.mac, s.expiry, now)
+            # Same Acct-Session-Id, same rules and class; only the authed_ips timeout is re-armed
+            await refresh_authed_ip(s)
+
+        nftables_snapshot = None
+        if diverged:
+            try:
+                nftables_snapshot = await nft_get_counter_snapshot()
+            except Exception as e:
+                print(f"Failed to get nftables snapshot for warm restart: {e}")
+
+        for s in diverged:
+            if not s.ip:
+                continue
+            # Closes the accounting session the previous process opened; the reconciler brings
+            # the subscriber back up from its lease like any other new session
+            if s.expiry is not None and s.expiry > now and s.mac:
+                lease_cache.on_ack(s.circuit_id, s.remote_id, s.ip, s.mac, s.expiry, now)
+            print(f"Warm restart: diverged session mac={s.mac} ip={s.ip} auth_state={s.auth_state}")
+            await terminate_session(
+                s,
+                cause="NAS-Reboot",
+                radius_server_ip=radius_server_ip,
+                radius_secret=radius_secret,
+                nas_ip=nas_ip,
+                nas_port_id=nas_port_id,
+                nftables_snapshot=nftables_snapshot,
+                event_dispatcher=event_dispatcher,
+                traffic_shaper=traffic_shaper,
+            )
+
+        metrics.incr("warm_restart_adopted", len(adopted))
+        metrics.incr("warm_restart_diverged", len(diverged))
+
     return DHCPRuntimeState(
         reconcile_handler=reconcile_handler,
         sessions=sessions,
@@ -555,4 +664,8 @@ def dhcp_lease_handler(
         sessions_by_session_id=sessions_by_session_id,
         tombstones=tombstones,
         handle_dhcp_event=handle_dhcp_event,
+        expire_sessions=expire_sessions,
+        kea_anti_entropy=kea_anti_entropy,
+        handle_lease_event=handle_lease_event,
+        warm_restart=warm_restart,
     )
@@ -2,6 +2,7 @@ import asyncio
 import os
 import psutil
 
+from lib.services.bng_metrics import get_metrics
 from lib.services.event_dispatcher import BNGEventDispatcher
 
 def _read_cgroup_memory():
@@ -72,6 +73,7 @@ class BNGHealthTracker:
             cpu_usage=cpu_usage,
             mem_usage=mem_usage,
             mem_max=mem_max,
+            metrics=get_metrics().export(),
         )
 
     async def check_and_dispatch(self):
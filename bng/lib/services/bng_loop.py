@@ -1,43 +1,71 @@
 import asyncio
 import contextlib
+import itertools
 import os
 import time
-from typing import Any
+from typing import Any, Iterator
 
 import redis.asyncio as aioredis
 
-from lib.constants import ENABLE_IDLE_DISCONNECT, MARK_DISCONNECT_GRACE_SECONDS
-from lib.nftables.helpers import nft_list_chain_rules
-from lib.radius.handlers import radius_handle_interim_updates
+from lib.constants import (
+    DHCP_REQUEST_COALESCE_SECONDS,
+    DHCP_SHED_HIGH_WATERMARK,
+    DHCP_SHED_LOW_WATERMARK,
+    KEA_ANTI_ENTROPY_INTERVAL_SECONDS,
+    KEA_LEASE_EVENTS_ENABLED,
+    MAILBOX_DRAIN_MAX,
+    SESSION_CHECKPOINT_INTERVAL_SECONDS,
+    SESSION_REPLICATION_ENABLED,
+    SESSION_SHARDS,
+    WARM_RESTART_ENABLED,
+)
+from lib.dhcp.lease import DHCPLease
+from lib.dhcp.lease_events import LeaseEvent, consume_lease_events
+from lib.dhcp.overload import DHCPOverloadPolicy
+from lib.mailbox import COMMAND_PRIORITY, MailboxChannel
+from lib.nftables.helpers import nft_flush_authed_ips, nft_setup_accounting
+from lib.radius.session import DHCPSession
 from lib.secrets import __RADIUS_SECRET
 from lib.services.bng_coad import handle_coad_connection
-from lib.services.bng_dhcp import dhcp_lease_handler
+from lib.services.bng_dhcp import new_kea_lease_service
 from lib.services.bng_health_tracker import BNGHealthTracker
-from lib.services.bng_session import (
-    Tombstone,
-    authorize_session,
-    remove_session_from_maps,
-    terminate_session,
-)
+from lib.services.bng_metrics import get_metrics
+from lib.services.bng_session import decode_bytes, session_shard_index
 from lib.services.event_dispatcher import BNGEventDispatcher, BNGEventDispatcherConfig
 from lib.services.traffic_shaper import BNGTrafficShaper, BNGTrafficShaperConfig
+from lib.services.session_checkpoint import SessionCheckpoint, match_data_plane
+from lib.services.session_replication import (
+    SessionJournal,
+    SessionReplica,
+    carry_over_counters,
+    hold_ownership,
+    install_accounting,
+    install_shaping,
+    release_ownership,
+    takeover_candidates,
+)
 from lib.services.router_tracker import RouterTracker
+from lib.services.session_shard import SessionShard, session_shard
 
 COA_IPC_SOCKET = os.getenv("COA_IPC_SOCKET", "/tmp/coad.sock")
 
 # Remove OSS API URL. BNG should not be calling OSS.
 OSS_API_URL = os.getenv("OSS_API_URL", "http://198.18.0.21:8000")
 
+TC_CLASSID_STATE_PATH = os.getenv("BNG_TC_CLASSID_STATE_PATH", "/var/lib/aether/tc_classids.json")
+# Comma-separated subscriber pools the traffic shaper accepts IPs from, empty accepts any IPv4 address
+SUBSCRIBER_PREFIXES = [p.strip() for p in os.getenv("BNG_SUBSCRIBER_PREFIXES", "").split(",") if p.strip()]
+SESSION_CHECKPOINT_PATH = os.getenv("BNG_SESSION_CHECKPOINT_PATH", "/var/lib/aether/sessions.json")
+
 
 async def bng_event_loop(
-    event_queue: asyncio.PriorityQueue,
+    event_queue: MailboxChannel,
     *,
     redis_conn: aioredis.Redis | None = None,
     iface: str = "eth1",
     uplink_iface: str = "eth2",
     interim_interval: int = 30,
     auth_retry_interval: int = 10,
-    disconnection_check_interval: int = 5,
     reconciler_interval: int = 15,
     router_ping_interval: int = 30,
     bng_health_check_interval: int = 5,
@@ -48,7 +76,17 @@ async def bng_event_loop(
     bng_id: str = "bng-default",
     bng_instance_id: str = "",
     oss_api_url: str = OSS_API_URL,
+    event_seq: Iterator[int] | None = None, # Shared with every other priority-1 producer on event_queue
+    replica: SessionReplica | None = None, # Set when this instance took over from a standby position
+    shards: int = SESSION_SHARDS,
 ) -> None:
+    event_seq = event_seq if event_seq is not None else itertools.count()
+
+    if shards > 1 and (SESSION_REPLICATION_ENABLED or replica is not None):
+        # The journal replicates one session table
+        print(f"BNG session replication needs a single session shard, ignoring shards={shards}")
+        shards = 1
+
     event_dispatcher = BNGEventDispatcher(
         config=BNGEventDispatcherConfig(
             bng_id=bng_id,
@@ -67,26 +105,99 @@ async def bng_event_loop(
             subscriber_facing_interface=iface,
             uplink_interface=uplink_iface,
             debug_mode=True,
+            subscriber_prefixes=SUBSCRIBER_PREFIXES,
+            classid_state_path=TC_CLASSID_STATE_PATH,
         )
     )
 
+    await nft_setup_accounting(iface)
+
     router_tracker = RouterTracker(bng_id=bng_id, event_dispatcher=event_dispatcher, oss_api_url=oss_api_url)
     router_tracker.load_routers()
 
     bng_health_tracker = BNGHealthTracker(bng_id=bng_id, event_dispatcher=event_dispatcher)
     await bng_health_tracker.check_and_dispatch()
 
-    dhcp_runtime = dhcp_lease_handler(
-        bng_id,
-        bng_instance_id,
-        iface=iface,
-        radius_server_ip=radius_server_ip,
-        radius_secret=radius_secret,
-        nas_ip=nas_ip,
-        nas_port_id=nas_port_id,
-        event_dispatcher=event_dispatcher,
-        traffic_shaper=traffic_shaper,
-    )
+    # One Kea client for the instance; its lease dump is split between the shards
+    kea_lease_service = new_kea_lease_service(bng_id)
+
+    session_shards = [
+        session_shard(
+            index,
+            shards,
+            bng_id=bng_id,
+            bng_instance_id=bng_instance_id,
+            iface=iface,
+            interim_interval=interim_interval,
+            auth_retry_interval=auth_retry_interval,
+            reconciler_interval=reconciler_interval,
+            radius_server_ip=radius_server_ip,
+            radius_secret=radius_secret,
+            nas_ip=nas_ip,
+            nas_port_id=nas_port_id,
+            event_dispatcher=event_dispatcher,
+            traffic_shaper=traffic_shaper,
+            kea_lease_service=kea_lease_service,
+            # Each shard's backlog is held to the bound of this loop's queue
+            event_queue_maxsize=event_queue.maxsize,
+        )
+        for index in range(shards)
+    ]
+
+    def shard_for(circuit_id: str, remote_id: str) -> SessionShard:
+        return session_shards[session_shard_index(circuit_id, remote_id, shards)]
+
+    def all_sessions() -> Iterator[DHCPSession]:
+        for shard in session_shards:
+            yield from shard.dhcp_runtime.sessions.values()
+
+    session_checkpoint = SessionCheckpoint(SESSION_CHECKPOINT_PATH, bng_id)
+    if replica is not None or WARM_RESTART_ENABLED:
+        # Take over the previous process's (or the failed active BNG's) sessions before anything else
+        # touches nft or tc
+        started = time.perf_counter()
+        installed: list[DHCPSession] = []
+        try:
+            if replica is not None:
+                previous = list(replica.sessions.values())
+            else:
+                previous = session_checkpoint.load()
+            adopted, diverged = await match_data_plane(previous, traffic_shaper)
+            if replica is not None:
+                # The active BNG's data plane isn't on this box: install it in bulk, without RADIUS
+                installed, failed = await install_accounting(takeover_candidates(diverged), iface)
+                taken = {id(s) for s in installed}
+                diverged = [s for s in diverged if id(s) not in taken]
+                for s in diverged:
+                    # Their Acct-Stop reports what the previous BNG had counted, not zero
+                    carry_over_counters(s)
+                print(f"Takeover: {len(installed)} replicated sessions installed, {len(failed)} failed")
+            for shard in session_shards:
+                await shard.dhcp_runtime.warm_restart(
+                    [s for s in adopted + installed if shard_for(s.circuit_id, s.remote_id) is shard],
+                    [s for s in diverged if shard_for(s.circuit_id, s.remote_id) is shard],
+                )
+            await nft_flush_authed_ips()
+        except Exception as e:
+            print(f"BNG warm restart error: {e}")
+        takeover_ms = (time.perf_counter() - started) * 1000
+        get_metrics().observe("session_takeover_ms", takeover_ms)
+        taken_over = sum(len(shard.dhcp_runtime.sessions) for shard in session_shards)
+        print(f"BNG took over {taken_over} sessions in {takeover_ms:.0f} ms")
+
+        if installed:
+            # Subscribers already forward through the default class; shaping lands after them
+            started = time.perf_counter()
+            try:
+                await install_shaping(installed, traffic_shaper)
+            except Exception as e:
+                print(f"BNG takeover shaping error: {e}")
+            print(f"Takeover: shaping for {len(installed)} sessions applied in {time.perf_counter() - started:.1f}s")
+
+    session_journal: SessionJournal | None = None
+    if SESSION_REPLICATION_ENABLED and redis_conn is not None:
+        session_shards[0].dhcp_runtime.sessions.track_changes()
+        session_journal = SessionJournal(redis_conn, bng_id, bng_instance_id)
 
     socket_path = COA_IPC_SOCKET
     try:
@@ -94,139 +205,50 @@ async def bng_event_loop(
     except FileNotFoundError:
         pass
 
-    command_queue: asyncio.Queue[tuple[str, dict[str, Any]]] = asyncio.Queue(maxsize=2048)
+    # BNG-wide commands; session work is queued to the shards' own command queues
+    mailbox = event_queue.mailbox
+    command_queue = mailbox.channel(maxsize=2048, priority=COMMAND_PRIORITY)
 
     async def periodic_enqueue(command: str, interval: int) -> None:
         while True:
             await asyncio.sleep(interval)
             await command_queue.put((command, {}))
 
-    async def handle_coad_request(request: dict[str, Any]) -> dict[str, Any]:
-        action = request.get("action")
-        session_id = request.get("session_id")
-
-        if not session_id:
-            return {"success": False, "error": "missing session_id"}
-
-        session = dhcp_runtime.sessions_by_session_id.get(session_id)
-        if session is None:
-            return {"success": False, "error": f"session not found: {session_id}"}
-
-        if action == "disconnect":
-            ok = await terminate_session(
-                session,
-                cause="Admin-Reset",
-                radius_server_ip=radius_server_ip,
-                radius_secret=radius_secret,
-                nas_ip=nas_ip,
-                nas_port_id=nas_port_id,
-                event_dispatcher=event_dispatcher,
-                traffic_shaper=traffic_shaper,
-            )
-            if ok:
-                remove_session_from_maps(
-                    session,
-                    dhcp_runtime.sessions,
-                    dhcp_runtime.sessions_by_ip,
-                    dhcp_runtime.sessions_by_session_id,
-                    dhcp_runtime.tombstones,
-                    bng_id,
-                    reason="Admin-Reset",
-                )
-            return {"success": ok}
-
-        if action == "policy_change":
-            filter_id = request.get("filter_id", "")
-            print(f"CoA policy_change received for session={session_id} filter_id={filter_id}")
-            return {"success": True}
-
-        return {"success": False, "error": f"unknown action: {action}"}
+    metrics = get_metrics()
 
     async def handle_command(command: str, payload: dict[str, Any]) -> None:
-        if command == "interim":
+        if command == "kea_anti_entropy":
+            # One Kea dump for the instance, each lease handed to the shard owning its subscriber
+            parts: list[list[DHCPLease] | None] = [None] * shards
             try:
-                await radius_handle_interim_updates(
-                    dhcp_runtime.sessions,
-                    radius_server_ip=radius_server_ip,
-                    radius_secret=radius_secret,
-                    nas_ip=nas_ip,
-                    nas_port_id=nas_port_id,
-                    event_dispatcher=event_dispatcher,
-                )
+                leases = await kea_lease_service.get_all_leases()
+                metrics.incr("kea_leases_changed", kea_lease_service.last_sync_changed)
+                parts = [[] for _ in session_shards]
+                for lease in leases:
+                    parts[session_shard_index(lease.circuit_id, lease.remote_id, shards)].append(lease)
             except Exception as e:
-                print(f"BNG Interim-Update error: {e}")
+                print(f"BNG Kea anti-entropy error: {e}")
+            for shard in session_shards:
+                await shard.command_queue.put((command, {"leases": parts[shard.index]}))
             return
 
-        if command == "reconcile":
-            try:
-                await dhcp_runtime.reconcile_handler()
-            except Exception as e:
-                print(f"BNG Reconcile error: {e}")
-            return
-
-        if command == "auth_retry":
-            try:
-                for s in dhcp_runtime.sessions.values():
-                    if s.auth_state != "PENDING_AUTH" or s.status == "PENDING" or s.ip is None:
-                        continue
-                    await authorize_session(
-                        s,
-                        s.ip,
-                        s.mac,
-                        iface,
-                        radius_server_ip,
-                        radius_secret,
-                        nas_ip,
-                        nas_port_id,
-                        ensure_rules=True,
-                        traffic_shaper=traffic_shaper,
-                    )
-            except Exception as e:
-                print(f"BNG Auth-Retry error: {e}")
+        if command == "coad_request":
+            # Handed to the shard holding the session, which answers the response future
+            session_id = payload.get("request", {}).get("session_id")
+            owner = next(
+                (shard for shard in session_shards if session_id in shard.dhcp_runtime.sessions_by_session_id),
+                session_shards[0],
+            )
+            await owner.command_queue.put((command, payload))
             return
 
-        if command == "disconnection_check":
-            if not ENABLE_IDLE_DISCONNECT:
-                return
+        if command == "session_checkpoint":
+            started = time.perf_counter()
             try:
-                nftables_snapshot = None
-                if dhcp_runtime.sessions:
-                    try:
-                        nftables_snapshot = await nft_list_chain_rules()
-                    except Exception as e:
-                        print(f"Failed to get nftables snapshot for IDLE disconnect: {e}")
-                        nftables_snapshot = None
-
-                for key, s in list(dhcp_runtime.sessions.items()):
-                    if s.status == "IDLE" and s.last_idle_ts is not None:
-                        idle_duration = time.time() - s.last_idle_ts
-                        if idle_duration >= MARK_DISCONNECT_GRACE_SECONDS:
-                            print(
-                                f"DHCP IDLE SESSION DISCONNECT mac={s.mac} ip={s.ip} "
-                                f"iface={s.iface} hostname={s.hostname} idle_duration={int(idle_duration)}s"
-                            )
-                            await terminate_session(
-                                s,
-                                cause="Idle-Timeout",
-                                radius_server_ip=radius_server_ip,
-                                radius_secret=radius_secret,
-                                nas_ip=nas_ip,
-                                nas_port_id=nas_port_id,
-                                nftables_snapshot=nftables_snapshot,
-                                event_dispatcher=event_dispatcher,
-                                traffic_shaper=traffic_shaper,
-                            )
-                            dhcp_runtime.tombstones[key] = Tombstone(
-                                ip_at_stop=s.ip or "",
-                                latest_state_update_ts_at_stop=s.expiry or int(time.time()),
-                                stopped_at=time.time(),
-                                reason="Idle-Timeout",
-                                missing_seen=False,
-                            )
-                            dhcp_runtime.sessions_by_session_id.pop(s.session_id, None)
-                            dhcp_runtime.sessions.pop(key)
+                session_checkpoint.save(all_sessions())
             except Exception as e:
-                print(f"BNG Disconnection check error: {e}")
+                print(f"BNG session checkpoint error: {e}")
+            metrics.observe("session_checkpoint_ms", (time.perf_counter() - started) * 1000)
             return
 
         if command == "router_config_refresh":
@@ -244,22 +266,16 @@ async def bng_event_loop(
             return
 
         if command == "bng_health":
+            metrics.observe("event_queue_backlog", event_queue.qsize())
+            if shards > 1:
+                for shard in session_shards:
+                    metrics.observe(f"session_shard_{shard.index}_backlog", shard.event_queue.qsize())
             try:
                 await bng_health_tracker.check_and_dispatch()
             except Exception as e:
                 print(f"BNG BNG-Health check error: {e}")
             return
 
-        if command == "coad_request":
-            response_future = payload.get("response_future")
-            try:
-                response = await handle_coad_request(payload.get("request", {}))
-            except Exception as e:
-                response = {"success": False, "error": str(e)}
-            if response_future is not None and not response_future.done():
-                response_future.set_result(response)
-            return
-
         print(f"Unknown command received: {command}")
 
     coad_server = await asyncio.start_unix_server(
@@ -268,50 +284,151 @@ async def bng_event_loop(
     )
     print(f"Coad IPC server listening on {socket_path}")
 
+    async def enqueue_lease_event(lease_event: LeaseEvent) -> None:
+        # Same priority as sniffer events, FIFO with them through the shared sequence
+        await event_queue.put((1, next(event_seq), {"event": "lease", "lease": lease_event}))
+
+    async def request_kea_resync() -> None:
+        await command_queue.put(("kea_anti_entropy", {}))
+
     periodic_tasks = [
-        asyncio.create_task(periodic_enqueue("interim", interim_interval)),
-        asyncio.create_task(periodic_enqueue("reconcile", reconciler_interval)),
-        asyncio.create_task(periodic_enqueue("auth_retry", auth_retry_interval)),
-        asyncio.create_task(periodic_enqueue("disconnection_check", disconnection_check_interval)),
         asyncio.create_task(periodic_enqueue("router_config_refresh", 60)),
         asyncio.create_task(periodic_enqueue("router_ping", router_ping_interval)),
         asyncio.create_task(periodic_enqueue("bng_health", bng_health_check_interval)),
     ]
+    if SESSION_CHECKPOINT_INTERVAL_SECONDS > 0:
+        periodic_tasks.append(
+            asyncio.create_task(periodic_enqueue("session_checkpoint", SESSION_CHECKPOINT_INTERVAL_SECONDS))
+        )
 
-    async def process_event_item(event: tuple[Any, Any, Any]) -> None:
-        _, _, event_dict = event
-        if isinstance(event_dict, dict) and event_dict.get("event") == "dhcp":
-            try:
-                await dhcp_runtime.handle_dhcp_event(event_dict)
-                await router_tracker.on_dhcp_event(event_dict)
-                await command_queue.put(("reconcile", {"reason": "dhcp_event"}))
-            except Exception as e:
-                print(f"BNG DHCP event processing error: {e}")
-
-    try:
-        while True:
-            event_get = asyncio.create_task(event_queue.get())
-            command_get = asyncio.create_task(command_queue.get())
+    if not KEA_LEASE_EVENTS_ENABLED:
+        periodic_tasks.append(
+            asyncio.create_task(periodic_enqueue("kea_anti_entropy", KEA_ANTI_ENTROPY_INTERVAL_SECONDS))
+        )
 
-            done, pending = await asyncio.wait(
-                {event_get, command_get},
-                return_when=asyncio.FIRST_COMPLETED,
+    if KEA_LEASE_EVENTS_ENABLED and redis_conn is not None:
+        # Kea pushes lease changes; no reconcile or anti-entropy polling in steady state
+        print(f"Consuming Kea lease events for relay_id={bng_id}")
+        periodic_tasks.append(
+            asyncio.create_task(
+                consume_lease_events(redis_conn, bng_id, enqueue_lease_event, on_resync=request_kea_resync)
             )
+        )
 
-            for task in pending:
-                task.cancel()
-                with contextlib.suppress(asyncio.CancelledError):
-                    await task
+    ownership_task: asyncio.Task | None = None
+    if session_journal is not None and redis_conn is not None:
+        ownership_task = asyncio.create_task(hold_ownership(redis_conn, bng_id, bng_instance_id))
+
+    shard_tasks = {
+        asyncio.create_task(shard.run(session_journal if shard.index == 0 else None)): shard
+        for shard in session_shards
+    }
+    task_of_shard = {shard.index: task for task, shard in shard_tasks.items()}
+    # A finished shard or ownership task is read from the mailbox ahead of everything else
+    stopped = mailbox.channel(priority=0)
+    for task in [*shard_tasks, *([ownership_task] if ownership_task is not None else [])]:
+        task.add_done_callback(stopped.put_nowait)
+    if shards > 1:
+        print(f"BNG running {shards} session shards")
+
+    # Events are handed on to a shard as soon as they arrive, so a backlog builds up in the shard's queue;
+    # the sniffer's shedding only sees this loop's queue. Each shard sheds against its own backlog the same way.
+    shard_overload = [
+        DHCPOverloadPolicy(
+            event_queue.maxsize,
+            low_watermark=DHCP_SHED_LOW_WATERMARK,
+            high_watermark=DHCP_SHED_HIGH_WATERMARK,
+            coalesce_seconds=DHCP_REQUEST_COALESCE_SECONDS,
+        )
+        for _ in session_shards
+    ]
 
-            if command_get in done:
-                command, payload = command_get.result()
-                await handle_command(command, payload)
+    def route_event(event_dict: Any) -> list[SessionShard]:
+        # The shard(s) an event from event_queue belongs to
+        if isinstance(event_dict, dict) and event_dict.get("event") == "lease":
+            lease_event: LeaseEvent = event_dict["lease"]
+            return [shard_for(lease_event.circuit_id, lease_event.remote_id)]
 
-            if event_get in done:
-                await process_event_item(event_get.result())
+        if isinstance(event_dict, dict) and event_dict.get("event") == "dhcp":
+            circuit_id = decode_bytes(event_dict.get("circuit_id"))
+            remote_id = decode_bytes(event_dict.get("remote_id"))
+            if circuit_id and remote_id:
+                return [shard_for(circuit_id, remote_id)]
+            # RELEASE only carries the IP: the shard holding it, or every shard's lease cache if none does
+            ip = decode_bytes(event_dict.get("ip")) or ""
+            holders = [shard for shard in session_shards if ip in shard.dhcp_runtime.sessions_by_ip]
+            return holders[:1] or session_shards
+
+        return session_shards[:1]
+
+    async def hand_to_shard(shard: SessionShard, item: Any) -> None:
+        if not shard.event_queue.full():
+            shard.event_queue.put_nowait(item)
+            return
+        # Wait for room, and this loop's queue fills behind it, unless the shard stops first;
+        # its stop notice is then read from the mailbox as usual
+        put = asyncio.create_task(shard.event_queue.put(item))
+        done, _ = await asyncio.wait({put, task_of_shard[shard.index]}, return_when=asyncio.FIRST_COMPLETED)
+        if put not in done:
+            put.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await put
+
+    # Seed the shards' lease caches from Kea so sessions from before a restart are recovered
+    await command_queue.put(("kea_anti_entropy", {}))
+
+    try:
+        while True:
+            for channel, item in await mailbox.get_batch(MAILBOX_DRAIN_MAX):
+                if channel is stopped:
+                    if item is ownership_task:
+                        # A standby holds, or can take, the owner key and installs these sessions; stop before both serve them
+                        raise RuntimeError(f"BNG lost ownership of bng_id={bng_id}")
+                    # A shard's loop only ends by failing; its sessions would go unserved
+                    raise RuntimeError(f"BNG session shard {shard_tasks[item].index} stopped: {item.exception()!r}")
+
+                if channel is command_queue:
+                    command, payload = item
+                    await handle_command(command, payload)
+                    continue
+
+                event_dict = item[2]
+                is_dhcp = isinstance(event_dict, dict) and event_dict.get("event") == "dhcp"
+                for shard in route_event(event_dict):
+                    if is_dhcp and not shard_overload[shard.index].admit(event_dict, shard.event_queue.qsize()):
+                        continue
+                    await hand_to_shard(shard, item)
+                if is_dhcp:
+                    try:
+                        await router_tracker.on_dhcp_event(event_dict)
+                    except Exception as e:
+                        print(f"BNG router tracking error: {e}")
     finally:
+        for task in shard_tasks:
+            task.cancel()
+        for task in shard_tasks:
+            with contextlib.suppress(asyncio.CancelledError, Exception):
+                await task
+        if SESSION_CHECKPOINT_INTERVAL_SECONDS > 0:
+            try:
+                session_checkpoint.save_now(all_sessions())
+            except Exception as e:
+                print(f"BNG session checkpoint error: {e}")
+        if ownership_task is not None and session_journal is not None and redis_conn is not None:
+            still_owner = not ownership_task.done()
+            ownership_task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await ownership_task
+            if still_owner:
+                # The standby gets the last changes before it can take the owner key
+                try:
+                    await session_journal.flush(session_shards[0].dhcp_runtime.sessions)
+                    await release_ownership(redis_conn, bng_id, bng_instance_id)
+                except Exception as e:
+                    print(f"BNG ownership release error: {e}")
         coad_server.close()
         await coad_server.wait_closed()
+        traffic_shaper.close()
         for task in periodic_tasks:
             task.cancel()
         for task in periodic_tasks:
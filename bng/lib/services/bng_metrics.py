@@ -0,0 +1,81 @@
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Deque, Dict, List
+
+# Observations kept per export window for the percentiles, the most recent win
+_WINDOW_SAMPLES = 4096
+
+
+@dataclass
+class _Observation:
+    count: int = 0
+    total: float = 0.0
+    last: float = 0.0
+    max: float = 0.0
+    window: Deque[float] = field(default_factory=lambda: deque(maxlen=_WINDOW_SAMPLES))
+
+
+def _percentile(ordered: List[float], q: float) -> float:
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+class BNGMetrics:
+    """
+    In-process counters and observations, exported as extra fields on BNG_HEALTH_UPDATE.
+    Counters are reported as running totals plus their per-second rate since the previous export.
+    Observations are reported as last/avg over the process lifetime, and max/p50/p99 over the export window.
+    """
+
+    def __init__(self) -> None:
+        self._counters: Dict[str, int] = {}
+        self._observations: Dict[str, _Observation] = {}
+        self._exported_counters: Dict[str, int] = {}
+        self._exported_at = time.monotonic()
+
+    def incr(self, name: str, n: int = 1) -> None:
+        self._counters[name] = self._counters.get(name, 0) + n
+
+    def observe(self, name: str, value: float) -> None:
+        obs = self._observations.setdefault(name, _Observation())
+        obs.count += 1
+        obs.total += value
+        obs.last = value
+        obs.max = max(obs.max, value)
+        obs.window.append(value)
+
+    def export(self) -> Dict[str, str]:
+        """returns: flat string fields for a Redis stream entry"""
+        now = time.monotonic()
+        elapsed = max(1e-9, now - self._exported_at)
+        fields: Dict[str, str] = {}
+
+        for name, value in self._counters.items():
+            fields[f"{name}_total"] = str(value)
+            fields[f"{name}_per_sec"] = f"{(value - self._exported_counters.get(name, 0)) / elapsed:.3f}"
+
+        for name, obs in self._observations.items():
+            fields[f"{name}_last"] = f"{obs.last:.3f}"
+            fields[f"{name}_avg"] = f"{obs.total / obs.count:.3f}" if obs.count else "0"
+            fields[f"{name}_max"] = f"{obs.max:.3f}"
+            if obs.window:
+                ordered = sorted(obs.window)
+                fields[f"{name}_p50"] = f"{_percentile(ordered, 0.50):.3f}"
+                fields[f"{name}_p99"] = f"{_percentile(ordered, 0.99):.3f}"
+            # Max and percentiles are per export window
+            obs.max = 0.0
+            obs.window.clear()
+
+        self._exported_counters = dict(self._counters)
+        self._exported_at = now
+        return fields
+
+
+_metrics: BNGMetrics | None = None
+
+
+def get_metrics() -> BNGMetrics:
+    global _metrics
+    if _metrics is None:
+        _metrics = BNGMetrics()
+    return _metrics
@@ -1,18 +1,20 @@
 import ipaddress
-import re
 import time
+import zlib
 from dataclasses import dataclass
-from typing import Dict, Tuple
+from typing import Dict, MutableMapping, Tuple
 
+from lib.constants import DHCP_GRACE_SECONDS
 from lib.services.traffic_shaper import BNGTrafficShaper
 from lib.nftables.helpers import (
-    nft_add_subscriber_rules,
+    nft_add_subscriber_rules_batched,
     nft_allow_ip,
-    nft_delete_rule_by_handle,
-    nft_get_counter_by_handle,
-    nft_list_chain_rules,
+    nft_delete_subscriber_rules,
+    NftCounterSnapshot,
+    nft_get_counter_snapshot,
     nft_remove_ip,
 )
+from lib.radius.packet import ACCESS_ACCEPT, ACCESS_REJECT, RadiusPacket
 from lib.radius.packet_builders import (
     build_access_request,
     build_acct_start,
@@ -24,9 +26,9 @@ from lib.radius.session import DHCPSession
 from lib.services.event_dispatcher import BNGEventDispatcher
 
 SessionKey = Tuple[str, str, str]
-SessionMap = Dict[SessionKey, DHCPSession]
-SessionsByIPMap = Dict[str, DHCPSession]
-SessionsBySessionIDMap = Dict[str, DHCPSession]
+SessionMap = MutableMapping[SessionKey, DHCPSession]
+SessionsByIPMap = MutableMapping[str, DHCPSession]
+SessionsBySessionIDMap = MutableMapping[str, DHCPSession]
 
 
 @dataclass
@@ -46,74 +48,22 @@ class RadiusReplyResult:
 
 TombstoneMap = Dict[SessionKey, Tombstone]
 
-_OSS_VSA_RE = re.compile(r"Attr-26\.43242\.(\d+)\s*=\s*([^\s]+)")
-_OSS_NAMED_RE = re.compile(r"OSS-(Download|Upload)-(Speed|Burst)\s*[:=]+\s*([^\s]+)", re.IGNORECASE)
+def session_shard_index(circuit_id: str, remote_id: str, shards: int) -> int:
+    """returns: the session shard owning the subscriber, stable across processes and restarts"""
+    if shards <= 1:
+        return 0
+    return zlib.crc32(f"{circuit_id}\x00{remote_id}".encode()) % shards
 
-def _parse_radius_int(token: str) -> int:
-    t = token.strip().strip('"')
-    if t.lower().startswith("0x"):
-        return int(t, 16)
-    return int(t, 10)
-
-
-def parse_radius_reply_result(response_text: str) -> RadiusReplyResult | None:
+def parse_radius_reply_result(reply: RadiusPacket) -> RadiusReplyResult | None:
     """
-    Parse speed AVPs from radius output text.
-    Supports:
-      - Attr-26.43242.1 = 0x000186a0   (download)
-      - Attr-26.43242.2 = 0x00007530   (upload)
-      - OSS-Download-Speed := 100000
-      - OSS-Upload-Speed := 30000
-      - OSS-Download-Burst := 500
-      - OSS-Upload-Burst := 150
-
-        I later learned that a RADIUS library like pyrad would parse this automatically given that the
-        dictionary.oss is provided. This is what I am parsing in the code below.
-
-        Attr-26.43242.1 = 0x00002710
-        Attr-26.43242.2 = 0x00001388
-        Attr-26.43242.3 = 0x000001f4
-        Attr-26.43242.4 = 0x000000fa
+    Reads the plan speeds from the OSS vendor attributes (dictionary.oss) of an Access-Accept:
+      - OSS-Download-Speed (26.43242.1)
+      - OSS-Upload-Speed   (26.43242.2)
+      - OSS-Download-Burst (26.43242.3, optional)
+      - OSS-Upload-Burst   (26.43242.4, optional)
     """
-    download_kbit: int | None = None
-    upload_kbit: int | None = None
-    download_burst_kbit: int | None = None
-    upload_burst_kbit: int | None = None
-
-    for line in response_text.splitlines():
-        m_vsa = _OSS_VSA_RE.search(line)
-        if m_vsa:
-            attr_type = int(m_vsa.group(1))
-            try:
-                value = _parse_radius_int(m_vsa.group(2))
-            except Exception:
-                continue
-            if attr_type == 1:
-                download_kbit = value
-            elif attr_type == 2:
-                upload_kbit = value
-            elif attr_type == 3:
-                download_burst_kbit = value
-            elif attr_type == 4:
-                upload_burst_kbit = value
-            continue
-
-        m_named = _OSS_NAMED_RE.search(line)
-        if m_named:
-            direction = m_named.group(1).lower()
-            kind = m_named.group(2).lower()
-            try:
-                value = _parse_radius_int(m_named.group(3))
-            except Exception:
-                continue
-            if direction == "download" and kind == "speed":
-                download_kbit = value
-            elif direction == "upload" and kind == "speed":
-                upload_kbit = value
-            elif direction == "download" and kind == "burst":
-                download_burst_kbit = value
-            elif direction == "upload" and kind == "burst":
-                upload_burst_kbit = value
+    download_kbit = reply.vendor_attributes.get("OSS-Download-Speed")
+    upload_kbit = reply.vendor_attributes.get("OSS-Upload-Speed")
 
     if download_kbit is None or upload_kbit is None:
         return None
@@ -121,10 +71,29 @@ def parse_radius_reply_result(response_text: str) -> RadiusReplyResult | None:
     return RadiusReplyResult(
         download_speed_kbit=download_kbit,
         upload_speed_kbit=upload_kbit,
-        download_burst_kbit=download_burst_kbit or 0,
-        upload_burst_kbit=upload_burst_kbit or 0,
+        download_burst_kbit=reply.vendor_attributes.get("OSS-Download-Burst") or 0,
+        upload_burst_kbit=reply.vendor_attributes.get("OSS-Upload-Burst") or 0,
     )
 
+def authed_ip_timeout(s: DHCPSession) -> int | None:
+    """Remaining lease lifetime (plus grace) for the session's authed_ips element."""
+    if s.expiry is None:
+        return None
+    return max(1, int(s.expiry - time.time())) + DHCP_GRACE_SECONDS
+
+
+async def refresh_authed_ip(s: DHCPSession) -> None:
+    """Re-arms the authed_ips element timeout after a lease renew."""
+    if s.auth_state != "AUTHORIZED" or not s.ip:
+        return
+    try:
+        ip_clean = str(s.ip).replace("\x00", "")
+        ipaddress.ip_address(ip_clean)
+        await nft_allow_ip(ip_clean, timeout_seconds=authed_ip_timeout(s))
+    except Exception:
+        print(f"Skip nft refresh: invalid ip={s.ip!r}")
+
+
 def decode_bytes(value):
     if value is None:
         return None
@@ -135,91 +104,114 @@ def decode_bytes(value):
 
 async def install_rules_and_baseline(s: DHCPSession, ip: str, mac: str, iface: str) -> None:
     try:
-        up_handle, down_handle = await nft_add_subscriber_rules(ip=ip, mac=mac, sub_if=iface)
+        # Shares its nft transaction with whatever other sessions are being installed right now
+        up_handle, down_handle = await nft_add_subscriber_rules_batched(ip=ip, mac=mac, sub_if=iface)
         s.nft_up_handle = up_handle
         s.nft_down_handle = down_handle
 
-        snapshot = await nft_list_chain_rules()
-        base_up_bytes, base_up_pkts = nft_get_counter_by_handle(snapshot, up_handle) or (0, 0)
-        base_down_bytes, base_down_pkts = nft_get_counter_by_handle(snapshot, down_handle) or (0, 0)
-        s.base_up_bytes = base_up_bytes
-        s.base_down_bytes = base_down_bytes
-        s.base_up_pkts = base_up_pkts
-        s.base_down_pkts = base_down_pkts
+        # New rules and elements count from zero
+        s.base_up_bytes = 0
+        s.base_down_bytes = 0
+        s.base_up_pkts = 0
+        s.base_down_pkts = 0
     except Exception as e:
         print(f"Failed to install nftables rules for mac={mac} ip={ip}: {e}")
 
 
-async def authorize_session(
+def record_session_policy(s: DHCPSession, policy: RadiusReplyResult) -> None:
+    s.qos_download_kbit = policy.download_speed_kbit
+    s.qos_upload_kbit = policy.upload_speed_kbit
+    s.qos_download_burst_kbit = policy.download_burst_kbit
+    s.qos_upload_burst_kbit = policy.upload_burst_kbit
+
+
+async def send_access_request(
     s: DHCPSession,
-    ip: str,
-    mac: str,
-    iface: str,
     radius_server_ip: str,
     radius_secret: str,
     nas_ip: str,
     nas_port_id: str,
-    ensure_rules: bool = False,
-    *,
-    traffic_shaper: BNGTrafficShaper,
-) -> str | None:
+) -> RadiusPacket:
+    """returns: the decoded Access-Accept/Reject, raises if RADIUS didn't answer"""
     access_request_pkt = build_access_request(s, nas_ip=nas_ip, nas_port_id=nas_port_id)
-    access_request_response = await rad_auth_send_from_bng(
+    reply = await rad_auth_send_from_bng(
         access_request_pkt, server_ip=radius_server_ip, secret=radius_secret
     )
 
-    if not access_request_response or not access_request_response.strip():
-        raise RuntimeError("RADIUS Access-Request returned empty response")
+    if reply is None:
+        raise RuntimeError("RADIUS Access-Request got no reply from server")
 
-    response_text = access_request_response.strip()
     print(
         f"RADIUS Access-Request response user={s.relay_id}/{s.remote_id}/{s.circuit_id}: "
-        f"{response_text}"
+        f"code={reply.code} attributes={reply.attributes} vendor={reply.vendor_attributes}"
     )
+    return reply
+
+
+async def shape_session(s: DHCPSession, reply: RadiusPacket, ip: str, mac: str, traffic_shaper: BNGTrafficShaper) -> None:
+    """Installs the `tc`-based traffic shaping for the plan speeds of an Access-Accept, if it carries any."""
+    parsed_policy = parse_radius_reply_result(reply)
+    if parsed_policy:
+        print(
+            f"Parsed RADIUS policy: download={parsed_policy.download_speed_kbit}kbit "
+            f"upload={parsed_policy.upload_speed_kbit}kbit "
+            f"download_burst={parsed_policy.download_burst_kbit}kbit "
+            f"upload_burst={parsed_policy.upload_burst_kbit}kbit"
+        )
 
-    if re.search(r"No reply from server", response_text, re.IGNORECASE):
-        raise RuntimeError("RADIUS Access-Request got no reply from server")
+        s.tc_classid = await traffic_shaper.add_traffic_shaping_rule(
+            ip=ip,
+            upload_speed_kbit=parsed_policy.upload_speed_kbit,
+            download_speed_kbit=parsed_policy.download_speed_kbit,
+            download_burst_kbit=parsed_policy.download_burst_kbit,
+            upload_burst_kbit=parsed_policy.upload_burst_kbit,
+        )
+
+        if s.tc_classid is None:
+            print(f"Failed to apply QoS for session mac={mac} ip={ip}")
+        else:
+            record_session_policy(s, parsed_policy)
+
+
+async def allow_session_ip(s: DHCPSession, ip: str) -> None:
+    """Queues the authorized IP into authed_ips, applied with the next nft_flush_authed_ips."""
+    if ip:
+        try:
+            ip_clean = str(ip).replace("\x00", "")
+            ipaddress.ip_address(ip_clean)
+            await nft_allow_ip(ip_clean, timeout_seconds=authed_ip_timeout(s))
+        except Exception:
+            print(f"Skip nft allow: invalid ip={ip!r}")
+
+
+async def authorize_session(
+    s: DHCPSession,
+    ip: str,
+    mac: str,
+    iface: str,
+    radius_server_ip: str,
+    radius_secret: str,
+    nas_ip: str,
+    nas_port_id: str,
+    ensure_rules: bool = False,
+    *,
+    traffic_shaper: BNGTrafficShaper,
+) -> str | None:
+    reply = await send_access_request(s, radius_server_ip, radius_secret, nas_ip, nas_port_id)
 
-    if re.search(r"Access-Reject", response_text):
+    if reply.code == ACCESS_REJECT:
         s.auth_state = "REJECTED"
         return "REJECTED"
 
-    if re.search(r"Access-Accept", response_text):
+    if reply.code == ACCESS_ACCEPT:
+        s.auth_retry_attempts = 0
         if ensure_rules and (s.nft_up_handle is None or s.nft_down_handle is None):
             await install_rules_and_baseline(s, ip, mac, iface)
 
-        # QoS
-        # Installs `tc`-based traffic shaping
-        parsed_policy = parse_radius_reply_result(response_text)
-        if parsed_policy:
-            print(
-                f"Parsed RADIUS policy: download={parsed_policy.download_speed_kbit}kbit "
-                f"upload={parsed_policy.upload_speed_kbit}kbit "
-                f"download_burst={parsed_policy.download_burst_kbit}kbit "
-                f"upload_burst={parsed_policy.upload_burst_kbit}kbit"
-            )
-
-            qos_success = await traffic_shaper.add_traffic_shaping_rule(
-                ip=ip,
-                upload_speed_kbit=parsed_policy.upload_speed_kbit,
-                download_speed_kbit=parsed_policy.download_speed_kbit,
-                download_burst_kbit=parsed_policy.download_burst_kbit,
-                upload_burst_kbit=parsed_policy.upload_burst_kbit,
-            )
-
-            if not qos_success:
-                print(f"Failed to apply QoS for session mac={mac} ip={ip}")
-
+        await shape_session(s, reply, ip, mac, traffic_shaper)
 
         s.auth_state = "AUTHORIZED"
-        if ip:
-            try:
-                # Install nftable rules
-                ip_clean = str(ip).replace("\x00", "")
-                ipaddress.ip_address(ip_clean)
-                await nft_allow_ip(ip_clean)
-            except Exception:
-                print(f"Skip nft allow: invalid ip={ip!r}")
+        await allow_session_ip(s, ip)
 
         acct_start_pkt = build_acct_start(s, nas_ip=nas_ip, nas_port_id=nas_port_id)
         await rad_acct_send_from_bng(acct_start_pkt, server_ip=radius_server_ip, secret=radius_secret)
@@ -227,20 +219,82 @@ async def authorize_session(
         print(f"RADIUS Acct-Start sent for mac={s.mac} ip={s.ip}")
         return "AUTHORIZED"
 
-    raise RuntimeError(f"RADIUS Access-Request unexpected response: {response_text}")
+    raise RuntimeError(f"RADIUS Access-Request unexpected response code: {reply.code}")
 
 
-async def get_counters_for_session(s: DHCPSession, nftables_snapshot=None) -> Tuple[int, int, int, int]:
-    if nftables_snapshot is None:
-        nftables_snapshot = await nft_list_chain_rules()
+async def change_session_policy(
+    s: DHCPSession,
+    radius_server_ip: str,
+    radius_secret: str,
+    nas_ip: str,
+    nas_port_id: str,
+    *,
+    filter_id: str = "",
+    traffic_shaper: BNGTrafficShaper,
+    event_dispatcher: BNGEventDispatcher,
+) -> Tuple[bool, str]:
+    """
+    Applies a CoA policy change to a live session without tearing it down.
+    The new rates are resolved from RADIUS (which the OSS updates before sending the CoA) and the
+    subscriber's existing HTB classes are retuned in place. nft rules and counter baselines are untouched.
+    returns: success, error
+    """
+    if s.auth_state != "AUTHORIZED" or not s.ip:
+        return False, f"session not authorized: {s.session_id}"
 
-    up_bytes, up_pkts = 0, 0
-    down_bytes, down_pkts = 0, 0
+    reply = await send_access_request(s, radius_server_ip, radius_secret, nas_ip, nas_port_id)
+    if reply.code != ACCESS_ACCEPT:
+        # Policy lookups never de-authorize a live session, that's what Disconnect-Request is for
+        return False, "RADIUS did not accept the policy lookup"
 
-    if s.nft_up_handle is not None:
-        up_bytes, up_pkts = nft_get_counter_by_handle(nftables_snapshot, s.nft_up_handle) or (0, 0)
-    if s.nft_down_handle is not None:
-        down_bytes, down_pkts = nft_get_counter_by_handle(nftables_snapshot, s.nft_down_handle) or (0, 0)
+    policy = parse_radius_reply_result(reply)
+    if policy is None:
+        return False, "RADIUS reply carries no rate policy"
+
+    print(
+        f"CoA policy_change session={s.session_id} filter_id={filter_id} "
+        f"download={policy.download_speed_kbit}kbit upload={policy.upload_speed_kbit}kbit "
+        f"download_burst={policy.download_burst_kbit}kbit upload_burst={policy.upload_burst_kbit}kbit"
+    )
+
+    if s.tc_classid is not None:
+        qos_success = await traffic_shaper.change_traffic_shaping_rule(
+            ip=s.ip,
+            classid=s.tc_classid,
+            upload_speed_kbit=policy.upload_speed_kbit,
+            download_speed_kbit=policy.download_speed_kbit,
+            download_burst_kbit=policy.download_burst_kbit,
+            upload_burst_kbit=policy.upload_burst_kbit,
+        )
+    else:
+        # Session was admitted without a policy (or shaping failed then), install it now
+        s.tc_classid = await traffic_shaper.add_traffic_shaping_rule(
+            ip=s.ip,
+            upload_speed_kbit=policy.upload_speed_kbit,
+            download_speed_kbit=policy.download_speed_kbit,
+            download_burst_kbit=policy.download_burst_kbit,
+            upload_burst_kbit=policy.upload_burst_kbit,
+        )
+        qos_success = s.tc_classid is not None
+
+    if not qos_success:
+        return False, "failed to apply QoS"
+
+    record_session_policy(s, policy)
+    await event_dispatcher.dispatch_policy_apply(s)
+    return True, ""
+
+
+async def get_counters_for_session(
+    s: DHCPSession,
+    nftables_snapshot: NftCounterSnapshot | None = None,
+) -> Tuple[int, int, int, int]:
+    if nftables_snapshot is None:
+        nftables_snapshot = await nft_get_counter_snapshot()
+
+    up_bytes, up_pkts, down_bytes, down_pkts = nftables_snapshot.subscriber_counters(
+        s.ip, s.nft_up_handle, s.nft_down_handle
+    )
 
     total_in_octets = max(0, up_bytes - s.base_up_bytes)
     total_out_octets = max(0, down_bytes - s.base_down_bytes)
@@ -258,13 +312,13 @@ async def terminate_session(
     nas_ip: str,
     nas_port_id: str,
     traffic_shaper: BNGTrafficShaper,
-    nftables_snapshot=None,
+    nftables_snapshot: NftCounterSnapshot | None = None,
     delete_rules: bool = True,
     event_dispatcher: BNGEventDispatcher | None = None,
 ) -> bool:
     try:
         if nftables_snapshot is None:
-            nftables_snapshot = await nft_list_chain_rules()
+            nftables_snapshot = await nft_get_counter_snapshot()
 
         total_in_octets, total_out_octets, total_in_pkts, total_out_pkts = await get_counters_for_session(
             s, nftables_snapshot
@@ -273,7 +327,8 @@ async def terminate_session(
         if s.auth_state == "AUTHORIZED":
             # Remove QoS
             if s.ip:
-                qos_success = await traffic_shaper.remove_traffic_shaping_rule( ip=s.ip )
+                qos_success = await traffic_shaper.remove_traffic_shaping_rule(ip=s.ip, classid=s.tc_classid)
+                s.tc_classid = None
 
                 if not qos_success:
                     print(f"Failed to remove QoS for session mac={s.mac} ip={s.ip}")
@@ -300,10 +355,7 @@ async def terminate_session(
                 print(f"Skip nft remove: invalid ip={s.ip!r}")
 
         if delete_rules:
-            if s.nft_up_handle is not None:
-                await nft_delete_rule_by_handle(s.nft_up_handle)
-            if s.nft_down_handle is not None:
-                await nft_delete_rule_by_handle(s.nft_down_handle)
+            await nft_delete_subscriber_rules(s.ip, s.nft_up_handle, s.nft_down_handle)
 
         if event_dispatcher is not None:
             await event_dispatcher.dispatch_session_stop(
@@ -1,7 +1,9 @@
 from enum import Enum
+import contextlib
 import time
 import redis.asyncio as aioredis
 from dataclasses import dataclass
+from typing import AsyncIterator, Dict, List
 
 from lib.radius.session import DHCPSession
 from lib.constants import EVENT_DISPATCHER_STREAM_ID
@@ -42,6 +44,8 @@ class BNGEventDispatcher:
     def __init__(self, config: BNGEventDispatcherConfig) -> None:
         self.config = config
         self.seq = 0
+        # Events held back by batched(), in dispatch order
+        self._batch: List[dict] | None = None
 
         if config.test_mode:
             print("BNGEventDispatcher initialized in test mode. Events will be printed to console.")
@@ -64,8 +68,33 @@ class BNGEventDispatcher:
 
         assert self.redis_conn is not None
 
+        if self._batch is not None:
+            self._batch.append(event_data)
+            return
+
         await self.redis_conn.xadd(EVENT_DISPATCHER_STREAM_ID, event_data)
 
+    @contextlib.asynccontextmanager
+    async def batched(self) -> AsyncIterator[None]:
+        """
+        Holds back the events dispatched inside the block and sends them as one pipelined round trip
+        when it ends, in order. Nested blocks flush with the outermost one.
+        """
+        if self._batch is not None:
+            yield
+            return
+
+        self._batch = []
+        try:
+            yield
+        finally:
+            batch, self._batch = self._batch, None
+            if batch and self.redis_conn is not None:
+                pipe = self.redis_conn.pipeline(transaction=False)
+                for event_data in batch:
+                    pipe.xadd(EVENT_DISPATCHER_STREAM_ID, event_data)
+                await pipe.execute()
+
     # Prepares common event data and dispatches to either stdout or streams
     async def _dispatch_event(self, event_type: BNGDispatcherEventType, s: DHCPSession,  event_data: dict) -> None:
         event_data["bng_id"] = self.config.bng_id
@@ -194,7 +223,14 @@ class BNGEventDispatcher:
         })
 
     # BNG Health
-    async def dispatch_bng_health_update(self, cpu_usage: float, mem_usage: float, mem_max: float, first_seen: bool = False) -> None:
+    async def dispatch_bng_health_update(
+        self,
+        cpu_usage: float,
+        mem_usage: float,
+        mem_max: float,
+        first_seen: bool = False,
+        metrics: Dict[str, str] | None = None,
+    ) -> None:
         event_data = {
             "bng_id": self.config.bng_id,
             "bng_instance_id": self.config.bng_instance_id,
@@ -209,6 +245,10 @@ class BNGEventDispatcher:
         if first_seen:
             event_data["first_seen"] = str(time.time());
 
+        # Control-plane metrics ride along as extra fields; consumers ignore what they don't know
+        if metrics:
+            event_data.update(metrics)
+
         if self.config.test_mode:
             print(f"Dispatching event: BNG_HEALTH_UPDATE data={event_data}")
         else:
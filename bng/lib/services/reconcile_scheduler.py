@@ -0,0 +1,70 @@
+import asyncio
+import time
+from typing import Any, Hashable, Set
+
+from lib.mailbox import MailboxChannel
+from lib.services.bng_metrics import get_metrics
+
+
+class ReconcileScheduler:
+    """
+    Coalesces reconcile requests into at most one queued `reconcile` command.
+
+    Requests only mark the reconciler dirty and record which session keys were touched. The first
+    request after a run queues the command, no sooner than `min_spacing` seconds after the previous
+    run started; requests arriving while it is queued are folded into it. A run covers only the
+    touched keys unless a full reconcile was asked for.
+    """
+
+    def __init__(self, command_queue: MailboxChannel, *, min_spacing: float) -> None:
+        self.command_queue = command_queue
+        self.min_spacing = min_spacing
+        self._full = False
+        self._keys: Set[Hashable] = set()
+        self._queued = False
+        self._last_run = float("-inf")
+        self._timer: asyncio.TimerHandle | None = None
+        self._metrics = get_metrics()
+
+    @property
+    def dirty(self) -> bool:
+        return self._full or bool(self._keys)
+
+    def request(self, key: Hashable | None = None, *, full: bool = False) -> None:
+        """Asks for a reconcile of `key`'s session, or of everything if `full` (or no key)."""
+        self._metrics.incr("reconcile_requests")
+        if full or key is None:
+            self._full = True
+        else:
+            self._keys.add(key)
+
+        if self._queued:
+            self._metrics.incr("reconcile_requests_coalesced")
+            return
+
+        self._queued = True
+        delay = self._last_run + self.min_spacing - time.monotonic()
+        if delay > 0:
+            self._timer = asyncio.get_running_loop().call_later(delay, self._enqueue)
+        else:
+            self._enqueue()
+
+    def _enqueue(self) -> None:
+        self._timer = None
+        item: tuple[str, dict[str, Any]] = ("reconcile", {})
+        try:
+            self.command_queue.put_nowait(item)
+        except asyncio.QueueFull:
+            asyncio.get_running_loop().create_task(self.command_queue.put(item))
+
+    def take(self) -> Set[Hashable] | None:
+        """
+        Claims the pending work for a run that is starting now.
+        returns: the session keys to reconcile, or None for a full reconcile
+        """
+        scope = None if self._full else self._keys
+        self._full = False
+        self._keys = set()
+        self._queued = False
+        self._last_run = time.monotonic()
+        return scope
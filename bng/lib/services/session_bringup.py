@@ -0,0 +1,287 @@
+import asyncio
+import ipaddress
+import time
+from typing import Dict, List, Tuple
+
+from lib.constants import SESSION_BRINGUP_BATCH, SESSION_BRINGUP_RADIUS_WINDOW
+from lib.nftables.helpers import nft_add_subscriber_rules_bulk, nft_allow_ip, nft_flush_authed_ips
+from lib.radius.packet import ACCESS_ACCEPT, ACCESS_REJECT, RadiusPacket
+from lib.radius.packet_builders import build_acct_start, rad_acct_send_from_bng
+from lib.radius.session import DHCPSession
+from lib.services.bng_metrics import get_metrics
+from lib.services.bng_session import (
+    allow_session_ip,
+    authed_ip_timeout,
+    install_rules_and_baseline,
+    parse_radius_reply_result,
+    record_session_policy,
+    send_access_request,
+    shape_session,
+)
+from lib.services.event_dispatcher import BNGEventDispatcher
+from lib.services.traffic_shaper import BNGTrafficShaper, TrafficShapingRule
+
+
+async def _in_window(semaphore: asyncio.Semaphore, coro):
+    async with semaphore:
+        return await coro
+
+
+async def _timed(stage: str, coro):
+    started = time.monotonic()
+    try:
+        return await coro
+    finally:
+        get_metrics().observe(f"ack_stage_{stage}_ms", (time.monotonic() - started) * 1000)
+
+
+async def _dispatch_batched(dispatch, sessions: List[DHCPSession], event_dispatcher: BNGEventDispatcher, name: str) -> None:
+    try:
+        async with event_dispatcher.batched():
+            for s in sessions:
+                try:
+                    await dispatch(s)
+                except Exception as e:
+                    print(f"Bulk bring-up: {name} failed for mac={s.mac} ip={s.ip}: {e}")
+    except Exception as e:
+        print(f"Bulk bring-up: failed to dispatch {name} events for {len(sessions)} sessions: {e}")
+
+
+async def bring_up_session(
+    s: DHCPSession,
+    *,
+    iface: str,
+    radius_server_ip: str,
+    radius_secret: str,
+    nas_ip: str,
+    nas_port_id: str,
+    traffic_shaper: BNGTrafficShaper,
+    event_dispatcher: BNGEventDispatcher,
+    received_at: float | None = None,
+) -> str | None:
+    """
+    Brings one session online from its DHCP ACK, running the stages that don't depend on each other
+    side by side: SESSION_START, the Access-Request and the accounting rules go out together; tc and
+    the authed_ips flush follow an Accept; Acct-Start and POLICY_APPLY go out together once the
+    subscriber forwards. Rules are installed even if RADIUS then rejects, as on the reconciler's path.
+
+    Each stage is observed as `ack_stage_<stage>_ms`, and `ack_to_forwarding_ms` is the time from
+    `received_at` (time.monotonic() when the ACK was read off the sniffer) to the authed_ips flush.
+    returns: "AUTHORIZED" or "REJECTED", raises if RADIUS didn't answer
+    """
+    metrics = get_metrics()
+    started = time.monotonic()
+    if received_at is None:
+        received_at = started
+    else:
+        metrics.observe("ack_stage_queue_ms", (started - received_at) * 1000)
+
+    pending = [
+        # SESSION_START first, so its event is built before anything below changes the session
+        _timed("session_start", event_dispatcher.dispatch_session_start(s)),
+        _timed("radius_auth", send_access_request(s, radius_server_ip, radius_secret, nas_ip, nas_port_id)),
+    ]
+    if s.nft_up_handle is None or s.nft_down_handle is None:
+        pending.append(_timed("nft_rules", install_rules_and_baseline(s, s.ip, s.mac, iface)))
+    start_result, reply, *_ = await asyncio.gather(*pending, return_exceptions=True)
+
+    if isinstance(start_result, BaseException):
+        print(f"Failed to dispatch SESSION_START for mac={s.mac} ip={s.ip}: {start_result}")
+    if isinstance(reply, BaseException):
+        raise reply
+
+    if reply.code == ACCESS_REJECT:
+        s.auth_state = "REJECTED"
+        await event_dispatcher.dispatch_policy_apply(s)
+        return "REJECTED"
+
+    if reply.code != ACCESS_ACCEPT:
+        raise RuntimeError(f"RADIUS Access-Request unexpected response code: {reply.code}")
+
+    s.auth_retry_attempts = 0
+    await _timed("tc", shape_session(s, reply, s.ip, s.mac, traffic_shaper))
+
+    s.auth_state = "AUTHORIZED"
+    await allow_session_ip(s, s.ip)
+    # Not left to the loop's end-of-iteration flush, so forwarding doesn't wait for Acct-Start
+    await _timed("authed_ips", nft_flush_authed_ips())
+    metrics.observe("ack_to_forwarding_ms", (time.monotonic() - received_at) * 1000)
+
+    acct_result, policy_result = await asyncio.gather(
+        _timed(
+            "acct_start",
+            rad_acct_send_from_bng(
+                build_acct_start(s, nas_ip=nas_ip, nas_port_id=nas_port_id),
+                server_ip=radius_server_ip,
+                secret=radius_secret,
+            ),
+        ),
+        event_dispatcher.dispatch_policy_apply(s),
+        return_exceptions=True,
+    )
+    if isinstance(acct_result, BaseException):
+        print(f"RADIUS Acct-Start failed for mac={s.mac} ip={s.ip}: {acct_result}")
+    else:
+        print(f"RADIUS Acct-Start sent for mac={s.mac} ip={s.ip}")
+    if isinstance(policy_result, BaseException):
+        print(f"Failed to dispatch POLICY_APPLY for mac={s.mac} ip={s.ip}: {policy_result}")
+    return "AUTHORIZED"
+
+
+async def bring_up_sessions(
+    sessions: List[DHCPSession],
+    *,
+    iface: str,
+    radius_server_ip: str,
+    radius_secret: str,
+    nas_ip: str,
+    nas_port_id: str,
+    traffic_shaper: BNGTrafficShaper,
+    event_dispatcher: BNGEventDispatcher,
+    batch: int = SESSION_BRINGUP_BATCH,
+    window: int = SESSION_BRINGUP_RADIUS_WINDOW,
+) -> Dict[str, int]:
+    """
+    Brings many new sessions online the way authorize_session does one, a batch at a time:
+    one nft transaction for the batch's accounting rules, its Access-Requests `window` at a time,
+    one tc batch for the accepted sessions' shaping, then their Acct-Starts `window` at a time.
+    SESSION_START and POLICY_APPLY events go out pipelined, once per batch.
+
+    Only the RADIUS round trips run concurrently. Replies are applied to the sessions afterwards,
+    in order, by this coroutine alone, so the loop stays the sessions' only writer.
+    Sessions that got no answer stay PENDING_AUTH for the auth-retry timer.
+    returns: {"authorized": n, "rejected": n, "failed": n}
+    """
+    counts = {"authorized": 0, "rejected": 0, "failed": 0}
+    for start in range(0, len(sessions), max(1, batch)):
+        started = time.perf_counter()
+        for result, n in (await _bring_up_batch(
+            sessions[start:start + batch],
+            iface=iface,
+            radius_server_ip=radius_server_ip,
+            radius_secret=radius_secret,
+            nas_ip=nas_ip,
+            nas_port_id=nas_port_id,
+            traffic_shaper=traffic_shaper,
+            event_dispatcher=event_dispatcher,
+            window=window,
+        )).items():
+            counts[result] += n
+        get_metrics().observe("session_bringup_batch_ms", (time.perf_counter() - started) * 1000)
+
+    print(
+        f"Bulk bring-up: {len(sessions)} sessions, {counts['authorized']} authorized, "
+        f"{counts['rejected']} rejected, {counts['failed']} pending auth retry"
+    )
+    return counts
+
+
+async def _bring_up_batch(
+    sessions: List[DHCPSession],
+    *,
+    iface: str,
+    radius_server_ip: str,
+    radius_secret: str,
+    nas_ip: str,
+    nas_port_id: str,
+    traffic_shaper: BNGTrafficShaper,
+    event_dispatcher: BNGEventDispatcher,
+    window: int,
+) -> Dict[str, int]:
+    counts = {"authorized": 0, "rejected": 0, "failed": 0}
+    semaphore = asyncio.Semaphore(max(1, window))
+
+    # Accounting rules first, like install_rules_and_baseline; new counters start at zero.
+    # Sessions whose rules didn't go in get them from authorize_session (ensure_rules) on auth retry.
+    try:
+        handles = await nft_add_subscriber_rules_bulk([(s.ip, s.mac) for s in sessions], iface)
+    except Exception as e:
+        print(f"Bulk bring-up: failed to install nftables rules for {len(sessions)} sessions: {e}")
+        handles = {}
+    for s in sessions:
+        if s.ip in handles:
+            s.nft_up_handle, s.nft_down_handle = handles[s.ip]
+            s.base_up_bytes = s.base_down_bytes = s.base_up_pkts = s.base_down_pkts = 0
+
+    await _dispatch_batched(event_dispatcher.dispatch_session_start, sessions, event_dispatcher, "SESSION_START")
+
+    replies: List[RadiusPacket | BaseException] = await asyncio.gather(
+        *(
+            _in_window(semaphore, send_access_request(s, radius_server_ip, radius_secret, nas_ip, nas_port_id))
+            for s in sessions
+        ),
+        return_exceptions=True,
+    )
+
+    # Replies are applied here, sequentially
+    accepted: List[Tuple[DHCPSession, RadiusPacket]] = []
+    for s, reply in zip(sessions, replies):
+        if isinstance(reply, BaseException):
+            s.auth_retry_attempts += 1
+            counts["failed"] += 1
+            print(f"Bulk bring-up: Access-Request failed for mac={s.mac} ip={s.ip}: {reply}")
+        elif reply.code == ACCESS_REJECT:
+            s.auth_state = "REJECTED"
+            counts["rejected"] += 1
+            print(f"RADIUS Access-Reject received for mac={s.mac} ip={s.ip}")
+        elif reply.code == ACCESS_ACCEPT:
+            s.auth_retry_attempts = 0
+            accepted.append((s, reply))
+        else:
+            s.auth_retry_attempts += 1
+            counts["failed"] += 1
+            print(f"RADIUS Access-Request unexpected response code: {reply.code} for mac={s.mac} ip={s.ip}")
+
+    policies = [(s, parse_radius_reply_result(reply)) for s, reply in accepted]
+    shaped = [(s, policy) for s, policy in policies if policy is not None]
+    classids = await traffic_shaper.add_traffic_shaping_rules([
+        TrafficShapingRule(
+            ip=s.ip,
+            upload_speed_kbit=policy.upload_speed_kbit,
+            download_speed_kbit=policy.download_speed_kbit,
+            download_burst_kbit=policy.download_burst_kbit,
+            upload_burst_kbit=policy.upload_burst_kbit,
+        )
+        for s, policy in shaped
+    ])
+    for s, policy in shaped:
+        s.tc_classid = classids.get(s.ip)
+        if s.tc_classid is None:
+            print(f"Failed to apply QoS for session mac={s.mac} ip={s.ip}")
+        else:
+            record_session_policy(s, policy)
+
+    for s, _ in accepted:
+        s.auth_state = "AUTHORIZED"
+        counts["authorized"] += 1
+        try:
+            ip_clean = str(s.ip).replace("\x00", "")
+            ipaddress.ip_address(ip_clean)
+            await nft_allow_ip(ip_clean, timeout_seconds=authed_ip_timeout(s))
+        except Exception:
+            print(f"Skip nft allow: invalid ip={s.ip!r}")
+        print(f"RADIUS Access-Accept received for mac={s.mac} ip={s.ip}")
+
+    acct_replies = await asyncio.gather(
+        *(
+            _in_window(
+                semaphore,
+                rad_acct_send_from_bng(
+                    build_acct_start(s, nas_ip=nas_ip, nas_port_id=nas_port_id),
+                    server_ip=radius_server_ip,
+                    secret=radius_secret,
+                ),
+            )
+            for s, _ in accepted
+        ),
+        return_exceptions=True,
+    )
+    for (s, _), acct_reply in zip(accepted, acct_replies):
+        if isinstance(acct_reply, BaseException):
+            print(f"RADIUS Acct-Start failed for mac={s.mac} ip={s.ip}: {acct_reply}")
+        else:
+            print(f"RADIUS Acct-Start sent for mac={s.mac} ip={s.ip}")
+
+    await _dispatch_batched(event_dispatcher.dispatch_policy_apply, sessions, event_dispatcher, "POLICY_APPLY")
+
+    return counts
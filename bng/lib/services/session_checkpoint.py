@@ -0,0 +1,298 @@
+import asyncio
+import ipaddress
+import json
+import operator
+import os
+import threading
+import time
+from typing import Callable, Dict, Iterable, List, Sequence, Set, Tuple
+
+from lib.constants import NFT_ACCOUNTING_MODE
+from lib.nftables.helpers import (
+    ACCT_SET_DOWN,
+    ACCT_SET_UP,
+    NftCounterSnapshot,
+    nft_delete_rules_by_handle,
+    nft_delete_subscriber_rules,
+    nft_list_accounting,
+    nft_subscriber_comment,
+    nft_subscriber_rule_comments,
+)
+from lib.radius.session import DHCPSession
+from lib.services.traffic_shaper import BNGTrafficShaper
+
+CHECKPOINT_VERSION = 1
+
+# DHCPSession constructor arguments kept in a checkpoint, in row order
+CHECKPOINT_FIELDS = (
+    "session_id",
+    "mac",
+    "ip",
+    "first_seen",
+    "last_seen",
+    "expiry",
+    "iface",
+    "hostname",
+    "last_interim",
+    "relay_id",
+    "remote_id",
+    "circuit_id",
+    "qos_download_kbit",
+    "qos_upload_kbit",
+    "qos_download_burst_kbit",
+    "qos_upload_burst_kbit",
+    "tc_classid",
+    "nft_up_handle",
+    "nft_down_handle",
+    "base_up_bytes",
+    "base_down_bytes",
+    "base_up_pkts",
+    "base_down_pkts",
+    "last_up_bytes",
+    "last_down_bytes",
+    "last_traffic_seen_ts",
+    "last_idle_ts",
+    "status",
+    "auth_state",
+    "auth_retry_attempts",
+    "last_status_change_ts",
+    "dhcp_nak_count",
+)
+
+# Rows hold the session's own slots, so packed fields are written and read back without unpacking them.
+# session_row(s) returns the session as a JSON-encodable row of CHECKPOINT_FIELDS.
+_PACKED_SLOTS = {
+    "session_id": "_session_id",
+    "mac": "_mac",
+    "ip": "_ip",
+    "expiry": "_expiry",
+    "status": "_status",
+    "auth_state": "_auth_state",
+}
+session_row = operator.attrgetter(*(_PACKED_SLOTS.get(name, name) for name in CHECKPOINT_FIELDS))
+
+
+def row_decoder(fields: Sequence[str]) -> Callable[[Sequence], DHCPSession]:
+    """returns: a function building a DHCPSession from a row written with `fields`; raises on a bad row"""
+    known = [(i, name) for i, name in enumerate(fields) if name in CHECKPOINT_FIELDS and name not in _PACKED_SLOTS]
+    packed = [(i, _PACKED_SLOTS[name]) for i, name in enumerate(fields) if name in _PACKED_SLOTS]
+
+    def decode(row: Sequence) -> DHCPSession:
+        # Packed fields go straight back into the slots they were taken from, no unpack/repack
+        # ("" keeps the constructor from generating a session id that is overwritten anyway)
+        s = DHCPSession(mac=None, ip=None, expiry=None, session_id="", **{name: row[i] for i, name in known})
+        for i, slot in packed:
+            setattr(s, slot, row[i])
+        return s
+
+    return decode
+
+
+class SessionCheckpoint:
+    """
+    Periodic snapshot of the session table in a local file, read back on a warm restart.
+
+    Rows are taken on the event loop, so a checkpoint is always one consistent view of the table;
+    encoding and the write happen on a worker thread while the loop carries on. The file is JSON lines
+    (a header, then one row per session) and is replaced atomically, so a crash mid-write leaves the
+    previous checkpoint in place.
+    """
+
+    def __init__(self, path: str | None, bng_id: str) -> None:
+        self.path = path
+        self.bng_id = bng_id
+        self._writer: asyncio.Future | None = None
+        # Writes can overlap at shutdown; an older snapshot never replaces a newer one
+        self._write_lock = threading.Lock()
+        self._taken = 0
+        self._written = 0
+
+    def _snapshot(self, sessions: Iterable[DHCPSession]) -> Tuple[int, dict, List[tuple]]:
+        self._taken += 1
+        header = {
+            "version": CHECKPOINT_VERSION,
+            "bng_id": self.bng_id,
+            "saved_at": time.time(),
+            "fields": CHECKPOINT_FIELDS,
+        }
+        return self._taken, header, [session_row(s) for s in sessions]
+
+    def _write(self, seq: int, header: dict, rows: List[tuple]) -> None:
+        assert self.path is not None
+        with self._write_lock:
+            if seq < self._written:
+                return
+
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, "w") as f:
+                f.write(json.dumps(header))
+                for row in rows:
+                    f.write("\n")
+                    f.write(json.dumps(row, separators=(",", ":")))
+            os.replace(tmp_path, self.path)
+            self._written = seq
+
+    async def _write_in_background(self, seq: int, header: dict, rows: List[tuple]) -> None:
+        try:
+            await asyncio.to_thread(self._write, seq, header, rows)
+        except Exception as e:
+            print(f"SessionCheckpoint: failed to write {self.path}: {e}")
+
+    def save(self, sessions: Iterable[DHCPSession]) -> int:
+        """
+        Takes the rows now and writes them in the background. Skipped while the previous write is running.
+        returns: number of sessions taken
+        """
+        if not self.path or (self._writer is not None and not self._writer.done()):
+            return 0
+        seq, header, rows = self._snapshot(sessions)
+        self._writer = asyncio.ensure_future(self._write_in_background(seq, header, rows))
+        return len(rows)
+
+    def save_now(self, sessions: Iterable[DHCPSession]) -> int:
+        # Blocking variant for shutdown, when the loop may not run another task
+        if not self.path:
+            return 0
+        seq, header, rows = self._snapshot(sessions)
+        self._write(seq, header, rows)
+        return len(rows)
+
+    def load(self) -> List[DHCPSession]:
+        """returns: the checkpointed sessions, empty if there is no usable checkpoint"""
+        if not self.path or not os.path.exists(self.path):
+            return []
+
+        try:
+            with open(self.path) as f:
+                header = json.loads(f.readline() or "{}")
+                if header.get("version") != CHECKPOINT_VERSION or header.get("bng_id") != self.bng_id:
+                    print(
+                        f"SessionCheckpoint: ignoring checkpoint for bng_id={header.get('bng_id')} "
+                        f"version={header.get('version')}"
+                    )
+                    return []
+                rows = [json.loads(line) for line in f if line.strip()]
+        except (OSError, ValueError) as e:
+            print(f"SessionCheckpoint: ignoring unreadable checkpoint {self.path}: {e}")
+            return []
+
+        decode = row_decoder(header.get("fields", []))
+        sessions = []
+        skipped = 0
+        for row in rows:
+            try:
+                sessions.append(decode(row))
+            except (TypeError, ValueError, IndexError) as e:
+                if not skipped:
+                    print(f"SessionCheckpoint: skipping bad row {row!r}: {e}")
+                skipped += 1
+
+        age = int(time.time() - header.get("saved_at", 0))
+        print(f"SessionCheckpoint: loaded {len(sessions)} sessions from {self.path} (age {age}s, {skipped} bad rows)")
+        return sessions
+
+
+def _nft_rules_match(s: DHCPSession, comments: Dict[int, str], snapshot: NftCounterSnapshot) -> bool:
+    # The session's counter rules (or set elements) are still in the kernel, with counters past its baselines
+    if not s.ip or not s.mac or s.nft_up_handle is None or s.nft_down_handle is None:
+        return False
+
+    if NFT_ACCOUNTING_MODE == "set":
+        if s.nft_up_handle != int(ipaddress.IPv4Address(s.ip)) or s.nft_down_handle != s.nft_up_handle:
+            return False
+        up = snapshot.counter_by_element(ACCT_SET_UP, s.ip)
+        down = snapshot.counter_by_element(ACCT_SET_DOWN, s.ip)
+    else:
+        if comments.get(s.nft_up_handle) != nft_subscriber_comment(s.mac, s.ip, "up"):
+            return False
+        if comments.get(s.nft_down_handle) != nft_subscriber_comment(s.mac, s.ip, "down"):
+            return False
+        up = snapshot.counter_by_handle(s.nft_up_handle)
+        down = snapshot.counter_by_handle(s.nft_down_handle)
+
+    if up is None or down is None:
+        return False
+    # Counters below the baseline mean the rule was re-created since the checkpoint
+    return (
+        up[0] >= s.base_up_bytes and up[1] >= s.base_up_pkts
+        and down[0] >= s.base_down_bytes and down[1] >= s.base_down_pkts
+    )
+
+
+async def match_data_plane(
+    checkpointed: List[DHCPSession],
+    traffic_shaper: BNGTrafficShaper,
+    now: float | None = None,
+) -> Tuple[List[DHCPSession], List[DHCPSession]]:
+    """
+    Warm restart: sorts checkpointed sessions by whether the kernel still holds their data plane.
+
+    A session is adopted if it was AUTHORIZED, its lease hasn't run out, its nft counter rules are found
+    by handle and comment (or as set elements in set mode) and its HTB class still exists. Everything
+    else has diverged. A diverged session keeps only the nft handles that are really its own, so tearing
+    it down can't touch anyone else's state. Every class that wasn't adopted, and the subscriber rules
+    that belong to no checkpointed session, are removed here.
+    returns: adopted sessions, diverged sessions
+    """
+    now = time.time() if now is None else now
+    nft_json = await nft_list_accounting()
+    snapshot = NftCounterSnapshot(nft_json)
+    comments = nft_subscriber_rule_comments(nft_json)
+
+    candidates: List[DHCPSession] = []
+    diverged: List[DHCPSession] = []
+    for s in checkpointed:
+        if (
+            s.auth_state == "AUTHORIZED"
+            and s.expiry is not None and s.expiry > now
+            and _nft_rules_match(s, comments, snapshot)
+        ):
+            candidates.append(s)
+        else:
+            diverged.append(s)
+
+    shaped = await traffic_shaper.adopt_traffic_shaping_rules(
+        {s.ip: s.tc_classid for s in candidates if s.tc_classid is not None}
+    )
+    adopted = [s for s in candidates if s.tc_classid is None or shaped.get(s.ip)]
+    diverged += [s for s in candidates if s.tc_classid is not None and not shaped.get(s.ip)]
+
+    # An IP can only be held by one session; a stale row for an adopted IP is dropped, not torn down
+    adopted_ips = {s.ip for s in adopted}
+    diverged = [s for s in diverged if s.ip not in adopted_ips]
+
+    kept_handles: Set[int] = {h for s in adopted for h in (s.nft_up_handle, s.nft_down_handle)}
+    for s in diverged:
+        # Their classes go with the orphans below, through the allocator's own ip -> classid table
+        s.tc_classid = None
+        if NFT_ACCOUNTING_MODE != "set" and s.ip and s.mac:
+            if comments.get(s.nft_up_handle) != nft_subscriber_comment(s.mac, s.ip, "up"):
+                s.nft_up_handle = None
+            if comments.get(s.nft_down_handle) != nft_subscriber_comment(s.mac, s.ip, "down"):
+                s.nft_down_handle = None
+        kept_handles.update(h for h in (s.nft_up_handle, s.nft_down_handle) if h is not None)
+
+    known_ips = adopted_ips | {s.ip for s in diverged if s.ip}
+    if NFT_ACCOUNTING_MODE == "set":
+        orphan_ips = (set(snapshot.element_ips(ACCT_SET_UP)) | set(snapshot.element_ips(ACCT_SET_DOWN))) - known_ips
+        for ip in orphan_ips:
+            await nft_delete_subscriber_rules(ip, None, None)
+        orphans = len(orphan_ips)
+    else:
+        orphan_handles = [h for h in comments if h not in kept_handles]
+        await nft_delete_rules_by_handle(orphan_handles)
+        orphans = len(orphan_handles)
+
+    orphan_classes = [ip for ip in traffic_shaper.shaped_ips() if ip not in adopted_ips]
+    if orphan_classes:
+        await traffic_shaper.remove_traffic_shaping_rules(orphan_classes)
+
+    print(
+        f"Warm restart: {len(adopted)} sessions adopted, {len(diverged)} diverged, "
+        f"{orphans} orphan nft entries and {len(orphan_classes)} unadopted tc classes removed"
+    )
+    return adopted, diverged
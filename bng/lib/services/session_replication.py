@@ -0,0 +1,424 @@
+import asyncio
+import json
+import time
+from typing import Dict, List, Sequence, Tuple
+
+import redis.asyncio as aioredis
+
+from lib.constants import SESSION_JOURNAL_MAXLEN, SESSION_JOURNAL_PREFIX, SESSION_OWNER_TTL_SECONDS
+from lib.nftables.helpers import nft_add_subscriber_rules_bulk
+from lib.radius.session import DHCPSession
+from lib.services.bng_session import SessionKey
+from lib.services.session_checkpoint import CHECKPOINT_FIELDS, row_decoder, session_row
+from lib.services.session_store import SessionStore
+from lib.services.traffic_shaper import BNGTrafficShaper, TrafficShapingRule
+
+# Journal entry ops. "reset" means the table was rewritten from scratch (a new active instance)
+JOURNAL_OP_SET = "set"
+JOURNAL_OP_DEL = "del"
+JOURNAL_OP_RESET = "reset"
+
+# Hash field holding the row layout next to the rows themselves
+_FIELDS_FIELD = "__fields__"
+
+# Fields that change on every interim or reconcile pass without changing what a standby would install
+_VOLATILE_FIELDS = {"last_seen", "last_interim", "last_traffic_seen_ts", "last_idle_ts"}
+_STABLE_POSITIONS = tuple(i for i, name in enumerate(CHECKPOINT_FIELDS) if name not in _VOLATILE_FIELDS)
+
+# Extends the owner key only while it still holds our instance id
+_RENEW_OWNER_SCRIPT = "if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('pexpire', KEYS[1], ARGV[2]) else return 0 end"
+_RELEASE_OWNER_SCRIPT = "if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('del', KEYS[1]) else return 0 end"
+
+
+def session_journal_stream(bng_id: str) -> str:
+    return f"{SESSION_JOURNAL_PREFIX}:{bng_id}"
+
+
+def session_journal_table(bng_id: str) -> str:
+    return f"{SESSION_JOURNAL_PREFIX}:{bng_id}:sessions"
+
+
+def session_owner_key(bng_id: str) -> str:
+    return f"{SESSION_JOURNAL_PREFIX}:{bng_id}:owner"
+
+
+def _encode_key(key: SessionKey) -> str:
+    return json.dumps(list(key))
+
+
+def _encode_row(row: Sequence) -> str:
+    return json.dumps(row, separators=(",", ":"))
+
+
+def _fingerprint(row: Sequence) -> int:
+    return hash(tuple(row[i] for i in _STABLE_POSITIONS))
+
+
+def _text(value) -> str:
+    return value.decode() if isinstance(value, bytes) else str(value)
+
+
+class SessionJournal:
+    """
+    Active side of session replication.
+
+    Every session the SessionStore saw touched is written as a full row (the checkpoint row format)
+    to this BNG's Redis hash, the current table, and appended to its journal stream, the changes for
+    standbys to tail, in one transaction per flush. Sessions whose replicated fields didn't change are
+    skipped. Entries carry the writer's instance id and a sequence number, so a standby can tell when
+    it missed entries (trimmed away, or written by an instance it never saw start).
+    """
+
+    def __init__(
+        self,
+        redis_conn: aioredis.Redis,
+        bng_id: str,
+        instance_id: str,
+        maxlen: int = SESSION_JOURNAL_MAXLEN,
+        batch: int = 2000,
+    ) -> None:
+        self.redis_conn = redis_conn
+        self.instance_id = instance_id
+        self.maxlen = maxlen
+        # Sessions per transaction; the loop's other tasks (sniffer, CoA socket) get a turn in between
+        self.batch = batch
+        self._stream = session_journal_stream(bng_id)
+        self._table = session_journal_table(bng_id)
+        self._fingerprints: Dict[SessionKey, int] = {}
+        self._seq = 0
+        self._needs_reset = True
+
+    def _entry(self, op: str, **fields: str) -> Dict[str, str]:
+        self._seq += 1
+        return {"instance": self.instance_id, "seq": str(self._seq), "op": op, **fields}
+
+    async def _reset(self, sessions: SessionStore) -> int:
+        sessions.take_touched() # All covered by the rewrite
+        rows: Dict[str, str] = {}
+        fingerprints: Dict[SessionKey, int] = {}
+        for key, s in sessions.items():
+            row = session_row(s)
+            rows[_encode_key(key)] = _encode_row(row)
+            fingerprints[key] = _fingerprint(row)
+
+        pipe = self.redis_conn.pipeline(transaction=True)
+        pipe.delete(self._table)
+        pipe.hset(self._table, _FIELDS_FIELD, json.dumps(CHECKPOINT_FIELDS))
+        items = list(rows.items())
+        for start in range(0, len(items), 1000):
+            pipe.hset(self._table, mapping=dict(items[start:start + 1000]))
+        pipe.xadd(self._stream, self._entry(JOURNAL_OP_RESET), maxlen=self.maxlen, approximate=True)
+        await pipe.execute()
+
+        self._fingerprints = fingerprints
+        self._needs_reset = False
+        return len(rows)
+
+    async def flush(self, sessions: SessionStore) -> int:
+        """
+        Journals the sessions touched since the last flush, `batch` sessions per transaction. The first
+        flush, and the one after a failed flush, rewrites the whole table instead.
+        returns: number of sessions written
+        """
+        if self._needs_reset:
+            try:
+                return await self._reset(sessions)
+            except Exception:
+                self._seq = 0
+                raise
+
+        touched = list(sessions.take_touched())
+        written = 0
+        for start in range(0, len(touched), self.batch):
+            written += await self._flush_keys(sessions, touched[start:start + self.batch])
+        return written
+
+    async def _flush_keys(self, sessions: SessionStore, keys: List[SessionKey]) -> int:
+        pipe = self.redis_conn.pipeline(transaction=True)
+        written = 0
+        for key in keys:
+            s = sessions.get(key)
+            if s is None:
+                if self._fingerprints.pop(key, None) is None:
+                    continue # Never journaled
+                pipe.hdel(self._table, _encode_key(key))
+                pipe.xadd(
+                    self._stream,
+                    self._entry(JOURNAL_OP_DEL, key=_encode_key(key)),
+                    maxlen=self.maxlen,
+                    approximate=True,
+                )
+            else:
+                row = session_row(s)
+                fingerprint = _fingerprint(row)
+                if self._fingerprints.get(key) == fingerprint:
+                    continue
+                self._fingerprints[key] = fingerprint
+                encoded = _encode_row(row)
+                pipe.hset(self._table, _encode_key(key), encoded)
+                pipe.xadd(
+                    self._stream,
+                    self._entry(JOURNAL_OP_SET, key=_encode_key(key), row=encoded),
+                    maxlen=self.maxlen,
+                    approximate=True,
+                )
+            written += 1
+
+        if not written:
+            return 0
+        try:
+            await pipe.execute()
+        except Exception:
+            # What was lost is unknown; standbys see the sequence restart with a reset entry
+            self._needs_reset = True
+            self._seq = 0
+            raise
+        return written
+
+
+class SessionReplica:
+    """
+    Standby side of session replication: a ready-to-serve copy of the active BNG's session table.
+
+    The copy starts from the table hash and follows the journal stream. Rows are decoded into
+    DHCPSession objects as they arrive, so a takeover starts from sessions, not from Redis.
+    Any sign of missed entries (a sequence gap, a new writer without a reset) triggers a resync.
+    """
+
+    def __init__(self, redis_conn: aioredis.Redis, bng_id: str) -> None:
+        self.redis_conn = redis_conn
+        self.bng_id = bng_id
+        self.sessions: Dict[SessionKey, DHCPSession] = {}
+        self.resyncs = 0
+        self.applied = 0
+        self._stream = session_journal_stream(bng_id)
+        self._table = session_journal_table(bng_id)
+        self._decode = row_decoder(CHECKPOINT_FIELDS)
+        self._last_id: str | None = None
+        self._instance: str | None = None
+        self._seq = 0
+
+    def _position(self, fields: dict) -> Tuple[str, int]:
+        return _text(fields.get(b"instance", fields.get("instance", ""))), int(fields.get(b"seq", fields.get("seq", 0)))
+
+    async def resync(self) -> None:
+        # Stream position and table from one transaction, so no entry falls between them
+        pipe = self.redis_conn.pipeline(transaction=True)
+        pipe.xrevrange(self._stream, count=1)
+        pipe.hgetall(self._table)
+        latest, table = await pipe.execute()
+
+        if latest:
+            entry_id, fields = latest[0]
+            self._last_id = _text(entry_id)
+            self._instance, self._seq = self._position(fields)
+        else:
+            self._last_id, self._instance, self._seq = "0-0", None, 0
+
+        layout = table.pop(_FIELDS_FIELD.encode(), None) or table.pop(_FIELDS_FIELD, None)
+        self._decode = row_decoder(json.loads(layout) if layout else CHECKPOINT_FIELDS)
+
+        sessions: Dict[SessionKey, DHCPSession] = {}
+        for raw_key, raw_row in table.items():
+            try:
+                key = tuple(json.loads(raw_key))
+                sessions[key] = self._decode(json.loads(raw_row)) # type: ignore[index]
+            except (TypeError, ValueError, IndexError) as e:
+                print(f"SessionReplica: skipping bad row for {raw_key!r}: {e}")
+        self.sessions = sessions
+        self.resyncs += 1
+        print(f"SessionReplica: resynced {len(sessions)} sessions for bng_id={self.bng_id} at {self._last_id}")
+
+    def _apply(self, fields: dict) -> bool:
+        """returns: False if the entry shows entries were missed"""
+        instance, seq = self._position(fields)
+        op = _text(fields.get(b"op", fields.get("op", "")))
+
+        if op == JOURNAL_OP_RESET:
+            # The table was rewritten; the rows are in the hash, not in the stream
+            return False
+        if instance != self._instance or seq != self._seq + 1:
+            return False
+        self._seq = seq
+
+        key = tuple(json.loads(_text(fields.get(b"key", fields.get("key", "[]")))))
+        if op == JOURNAL_OP_DEL:
+            self.sessions.pop(key, None) # type: ignore[arg-type]
+        elif op == JOURNAL_OP_SET:
+            self.sessions[key] = self._decode(json.loads(_text(fields.get(b"row", fields.get("row"))))) # type: ignore[index]
+        self.applied += 1
+        return True
+
+    async def follow(self, block_ms: int | None = None, batch: int = 1024) -> int:
+        """
+        Applies the journal entries after the current position, waiting up to `block_ms` for the first.
+        returns: number of entries read
+        """
+        if self._last_id is None:
+            await self.resync()
+
+        reply = await self.redis_conn.xread({self._stream: self._last_id}, count=batch, block=block_ms)
+        read = 0
+        for _, entries in reply or []:
+            for entry_id, fields in entries:
+                read += 1
+                self._last_id = _text(entry_id)
+                try:
+                    in_order = self._apply(fields)
+                except (TypeError, ValueError, IndexError) as e:
+                    print(f"SessionReplica: bad journal entry {self._last_id}: {e}")
+                    in_order = False
+                if not in_order:
+                    await self.resync()
+                    return read
+        return read
+
+
+async def acquire_ownership(
+    redis_conn: aioredis.Redis,
+    bng_id: str,
+    instance_id: str,
+    replica: SessionReplica,
+    poll_seconds: float = SESSION_OWNER_TTL_SECONDS / 3,
+) -> None:
+    """
+    Waits as a standby until this instance holds the bng_id's owner key, following the journal meanwhile.
+    Returns once ownership is taken and the replica has caught up with everything the last owner wrote.
+    """
+    owner_key = session_owner_key(bng_id)
+    ttl_ms = int(SESSION_OWNER_TTL_SECONDS * 1000)
+    announced = False
+
+    while True:
+        try:
+            if await redis_conn.set(owner_key, instance_id, nx=True, px=ttl_ms):
+                while await replica.follow():
+                    pass
+                return
+
+            if not announced:
+                owner = await redis_conn.get(owner_key)
+                print(f"BNG standby for bng_id={bng_id}, active instance={_text(owner) if owner else None}")
+                announced = True
+            await replica.follow(block_ms=int(poll_seconds * 1000))
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"SessionReplica: journal error: {e}, resyncing in {poll_seconds:.1f}s")
+            replica._last_id = None
+            await asyncio.sleep(poll_seconds)
+
+
+async def hold_ownership(redis_conn: aioredis.Redis, bng_id: str, instance_id: str) -> None:
+    """
+    Keeps renewing the owner key. Returns if another instance holds it, i.e. a standby took over, or if no
+    renew has succeeded for long enough that the key may have lapsed and a standby may be taking over.
+    """
+    owner_key = session_owner_key(bng_id)
+    ttl_ms = int(SESSION_OWNER_TTL_SECONDS * 1000)
+    interval = SESSION_OWNER_TTL_SECONDS / 3
+    # The key lives at least TTL past the start of the last successful renew; step down one interval before that
+    step_down_after = SESSION_OWNER_TTL_SECONDS - interval
+    renewed_at = time.monotonic()
+
+    while True:
+        remaining = renewed_at + step_down_after - time.monotonic()
+        if remaining <= 0:
+            print(f"BNG owner key of bng_id={bng_id} not renewed for {step_down_after:.1f}s, stepping down")
+            return
+        await asyncio.sleep(min(interval, remaining))
+
+        started = time.monotonic()
+        # A hung call must not outlive the deadline
+        timeout = renewed_at + step_down_after - started
+        if timeout <= 0:
+            continue
+        try:
+            renewed = await asyncio.wait_for(
+                redis_conn.eval(_RENEW_OWNER_SCRIPT, 1, owner_key, instance_id, ttl_ms),
+                timeout=min(interval, timeout),
+            )
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"BNG owner key renew failed: {e!r}")
+            continue
+        if not renewed:
+            print(f"BNG lost ownership of bng_id={bng_id} to another instance")
+            return
+        renewed_at = started
+
+
+async def release_ownership(redis_conn: aioredis.Redis, bng_id: str, instance_id: str) -> None:
+    # Clean shutdown: a standby takes over right away instead of waiting out the TTL
+    await redis_conn.eval(_RELEASE_OWNER_SCRIPT, 1, session_owner_key(bng_id), instance_id)
+
+
+def carry_over_counters(s: DHCPSession) -> None:
+    # Moves the byte baselines below zero by what the previous BNG reported, for counters starting at zero here
+    s.base_up_bytes = -(s.last_up_bytes or 0)
+    s.base_down_bytes = -(s.last_down_bytes or 0)
+    s.base_up_pkts = 0
+    s.base_down_pkts = 0
+
+
+async def install_accounting(
+    sessions: List[DHCPSession],
+    iface: str,
+) -> Tuple[List[DHCPSession], List[DHCPSession]]:
+    """
+    Takeover: installs replicated sessions' nft counter rules (or set elements) in bulk, without RADIUS.
+
+    Counters on this box start from zero, so byte baselines are carried over (carry_over_counters):
+    Interim-Update and Acct-Stop totals go on from where the previous BNG left them. Packet totals restart.
+    returns: installed sessions, failed sessions
+    """
+    handles = await nft_add_subscriber_rules_bulk([(s.ip, s.mac) for s in sessions], iface)
+
+    installed: List[DHCPSession] = []
+    failed: List[DHCPSession] = []
+    for s in sessions:
+        if s.ip not in handles:
+            failed.append(s)
+            continue
+        s.nft_up_handle, s.nft_down_handle = handles[s.ip]
+        s.tc_classid = None
+        carry_over_counters(s)
+        installed.append(s)
+    return installed, failed
+
+
+async def install_shaping(sessions: List[DHCPSession], traffic_shaper: BNGTrafficShaper) -> int:
+    """
+    Takeover: re-creates the HTB classes of sessions with a QoS policy in one tc batch.
+    Until then their traffic goes through the default class.
+    returns: number of sessions that couldn't be shaped
+    """
+    shaped = [s for s in sessions if s.qos_download_kbit is not None and s.qos_upload_kbit is not None]
+    classids = await traffic_shaper.add_traffic_shaping_rules([
+        TrafficShapingRule(
+            ip=s.ip,
+            upload_speed_kbit=s.qos_upload_kbit,
+            download_speed_kbit=s.qos_download_kbit,
+            download_burst_kbit=s.qos_download_burst_kbit or 0,
+            upload_burst_kbit=s.qos_upload_burst_kbit or 0,
+        )
+        for s in shaped
+    ])
+
+    failed = 0
+    for s in shaped:
+        s.tc_classid = classids.get(s.ip)
+        if s.tc_classid is None:
+            failed += 1
+            print(f"Takeover: failed to apply QoS for session mac={s.mac} ip={s.ip}")
+    return failed
+
+
+def takeover_candidates(sessions: List[DHCPSession], now: float | None = None) -> List[DHCPSession]:
+    """returns: the sessions a takeover installs: authorized, with an IP and a lease that hasn't run out"""
+    now = time.time() if now is None else now
+    return [
+        s for s in sessions
+        if s.auth_state == "AUTHORIZED" and s.ip and s.mac and s.expiry is not None and s.expiry > now
+    ]
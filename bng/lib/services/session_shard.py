@@ -0,0 +1,485 @@
+import asyncio
+import contextlib
+import itertools
+import sys
+import time
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable
+
+from lib.constants import (
+    ENABLE_IDLE_DISCONNECT,
+    KEA_LEASE_EVENTS_ENABLED,
+    MAILBOX_DRAIN_MAX,
+    MARK_DISCONNECT_GRACE_SECONDS,
+    RADIUS_CLIENT_TIMEOUT_SECONDS,
+    RADIUS_INTERIM_BUDGET_FRACTION,
+    RECONCILE_MIN_SPACING_SECONDS,
+)
+from lib.dhcp.lease_events import LeaseEvent
+from lib.dhcp.lease_service import KeaLeaseService
+from lib.mailbox import COMMAND_PRIORITY, Mailbox, MailboxChannel
+from lib.nftables.helpers import nft_flush_authed_ips, nft_get_counter_snapshot
+from lib.radius.handlers import radius_handle_interim_updates
+from lib.radius.session import DHCPSession
+from lib.services.bng_dhcp import DHCPRuntimeState, dhcp_lease_handler
+from lib.services.bng_metrics import get_metrics
+from lib.services.bng_session import (
+    authorize_session,
+    change_session_policy,
+    decode_bytes,
+    remove_session_from_maps,
+    terminate_session,
+)
+from lib.services.event_dispatcher import BNGEventDispatcher
+from lib.services.reconcile_scheduler import ReconcileScheduler
+from lib.services.session_replication import SessionJournal
+from lib.services.session_timers import (
+    TIMER_AUTH_RETRY,
+    TIMER_IDLE_CHECK,
+    TIMER_INTERIM,
+    TIMER_LEASE_EXPIRY,
+    TIMER_PRIORITIES,
+    TIMER_TOMBSTONE_EXPIRY,
+    SessionTimers,
+)
+from lib.services.traffic_shaper import BNGTrafficShaper
+
+
+# Marks "no run of session events in progress"; None is a real key for an unknown IP's RELEASE
+_NO_RUN = object()
+
+
+@dataclass
+class SessionShard:
+    """
+    One slice of the BNG's sessions and the single writer that owns it.
+
+    `event_queue` takes DHCP and lease events routed to this shard. It is bounded, so a shard that falls
+    behind holds up the supervisor's routing and, through it, the sniffer's queue.
+    `command_queue` takes the shard's reconcile and Kea anti-entropy runs and CoA requests for its sessions.
+    Both feed the shard's one mailbox, as do its own session timers on a channel of their own.
+    `run` is the shard's loop; it returns only when cancelled.
+    """
+
+    index: int
+    dhcp_runtime: DHCPRuntimeState
+    session_timers: SessionTimers
+    event_queue: MailboxChannel
+    command_queue: MailboxChannel
+    run: Callable[[SessionJournal | None], Awaitable[None]]
+
+
+def session_shard(
+    index: int,
+    shards: int,
+    *,
+    bng_id: str,
+    bng_instance_id: str,
+    iface: str,
+    interim_interval: int,
+    auth_retry_interval: int,
+    reconciler_interval: int,
+    radius_server_ip: str,
+    radius_secret: str,
+    nas_ip: str,
+    nas_port_id: str,
+    event_dispatcher: BNGEventDispatcher,
+    traffic_shaper: BNGTrafficShaper,
+    kea_lease_service: KeaLeaseService | None = None,
+    event_queue_maxsize: int = 0,
+) -> SessionShard:
+    dhcp_runtime = dhcp_lease_handler(
+        bng_id,
+        bng_instance_id,
+        iface=iface,
+        radius_server_ip=radius_server_ip,
+        radius_secret=radius_secret,
+        nas_ip=nas_ip,
+        nas_port_id=nas_port_id,
+        event_dispatcher=event_dispatcher,
+        traffic_shaper=traffic_shaper,
+        kea_lease_service=kea_lease_service,
+        shard=index,
+        shards=shards,
+    )
+
+    # Per-session deadlines (interim, auth retry, idle check, lease and tombstone expiry)
+    session_timers = SessionTimers(
+        dhcp_runtime.sessions,
+        dhcp_runtime.tombstones,
+        interim_interval=interim_interval,
+        auth_retry_interval=auth_retry_interval,
+    )
+    timer_seq = itertools.count()
+    # Interims run inline in the shard loop, so with RADIUS down a batch must not hold it for the whole interval
+    interim_budget = min(interim_interval, max(RADIUS_CLIENT_TIMEOUT_SECONDS, interim_interval * RADIUS_INTERIM_BUDGET_FRACTION))
+
+    mailbox = Mailbox()
+    event_queue = mailbox.channel(maxsize=event_queue_maxsize)
+    # Unbounded, so the timer task never waits behind a DHCP backlog
+    timer_queue = mailbox.channel()
+    command_queue = mailbox.channel(maxsize=2048, priority=COMMAND_PRIORITY)
+
+    metrics = get_metrics()
+    reconcile_scheduler = ReconcileScheduler(command_queue, min_spacing=RECONCILE_MIN_SPACING_SECONDS)
+
+    async def periodic_full_reconcile(interval: int) -> None:
+        while True:
+            await asyncio.sleep(interval)
+            reconcile_scheduler.request(full=True)
+
+    async def handle_coad_request(request: dict[str, Any]) -> dict[str, Any]:
+        action = request.get("action")
+        session_id = request.get("session_id")
+
+        if not session_id:
+            return {"success": False, "error": "missing session_id"}
+
+        session = dhcp_runtime.sessions_by_session_id.get(session_id)
+        if session is None:
+            return {"success": False, "error": f"session not found: {session_id}"}
+
+        try:
+            return await handle_coad_action(action, session, request)
+        finally:
+            session_timers.sync((bng_id, session.circuit_id, session.remote_id))
+            dhcp_runtime.sessions.touch((bng_id, session.circuit_id, session.remote_id))
+
+    async def handle_coad_action(action: Any, session: DHCPSession, request: dict[str, Any]) -> dict[str, Any]:
+        session_id = session.session_id
+
+        if action == "disconnect":
+            ok = await terminate_session(
+                session,
+                cause="Admin-Reset",
+                radius_server_ip=radius_server_ip,
+                radius_secret=radius_secret,
+                nas_ip=nas_ip,
+                nas_port_id=nas_port_id,
+                event_dispatcher=event_dispatcher,
+                traffic_shaper=traffic_shaper,
+            )
+            if ok:
+                remove_session_from_maps(
+                    session,
+                    dhcp_runtime.sessions,
+                    dhcp_runtime.sessions_by_ip,
+                    dhcp_runtime.sessions_by_session_id,
+                    dhcp_runtime.tombstones,
+                    bng_id,
+                    reason="Admin-Reset",
+                )
+            return {"success": ok}
+
+        if action == "policy_change":
+            filter_id = request.get("filter_id", "")
+            print(f"CoA policy_change received for session={session_id} filter_id={filter_id}")
+            ok, error = await change_session_policy(
+                session,
+                radius_server_ip,
+                radius_secret,
+                nas_ip,
+                nas_port_id,
+                filter_id=filter_id,
+                traffic_shaper=traffic_shaper,
+                event_dispatcher=event_dispatcher,
+            )
+            if not ok:
+                return {"success": False, "error": error}
+            return {"success": True}
+
+        return {"success": False, "error": f"unknown action: {action}"}
+
+    async def handle_timers(kind: str, timers: list[tuple[Any, float]]) -> None:
+        now = time.time()
+        keys = [key for key, _ in timers]
+
+        sessions = dhcp_runtime.sessions
+
+        if kind == TIMER_INTERIM:
+            authorized = sessions.with_auth_state("AUTHORIZED")
+            due_sessions = {key: sessions[key] for key in keys if key in authorized}
+            try:
+                await radius_handle_interim_updates(
+                    due_sessions,
+                    radius_server_ip=radius_server_ip,
+                    radius_secret=radius_secret,
+                    nas_ip=nas_ip,
+                    nas_port_id=nas_port_id,
+                    event_dispatcher=event_dispatcher,
+                    time_budget=interim_budget,
+                )
+            except Exception as e:
+                print(f"BNG Interim-Update error: {e}")
+            for key, deadline in timers:
+                session_timers.done(kind, key)
+                if key in sessions:
+                    session_timers.reschedule_interim(key, deadline, now)
+            return
+
+        if kind == TIMER_AUTH_RETRY:
+            pending_auth = sessions.with_auth_state("PENDING_AUTH")
+            for key in [key for key in keys if key in pending_auth]:
+                s = sessions[key]
+                if s.status == "PENDING" or s.ip is None:
+                    continue
+                try:
+                    await authorize_session(
+                        s,
+                        s.ip,
+                        s.mac,
+                        iface,
+                        radius_server_ip,
+                        radius_secret,
+                        nas_ip,
+                        nas_port_id,
+                        ensure_rules=True,
+                        traffic_shaper=traffic_shaper,
+                    )
+                except Exception as e:
+                    s.auth_retry_attempts += 1
+                    print(f"BNG Auth-Retry error for mac={s.mac} ip={s.ip} attempt={s.auth_retry_attempts}: {e}")
+            return
+
+        if kind == TIMER_IDLE_CHECK:
+            if not ENABLE_IDLE_DISCONNECT:
+                return
+            idle_keys = sessions.with_status("IDLE")
+            idle = [
+                s for key in keys
+                if key in idle_keys and (s := sessions[key]).last_idle_ts is not None
+                and now - s.last_idle_ts >= MARK_DISCONNECT_GRACE_SECONDS
+            ]
+            if not idle:
+                return
+
+            try:
+                nftables_snapshot = await nft_get_counter_snapshot()
+            except Exception as e:
+                print(f"Failed to get nftables snapshot for IDLE disconnect: {e}")
+                nftables_snapshot = None
+
+            for s in idle:
+                try:
+                    idle_duration = now - s.last_idle_ts
+                    print(
+                        f"DHCP IDLE SESSION DISCONNECT mac={s.mac} ip={s.ip} "
+                        f"iface={s.iface} hostname={s.hostname} idle_duration={int(idle_duration)}s"
+                    )
+                    await terminate_session(
+                        s,
+                        cause="Idle-Timeout",
+                        radius_server_ip=radius_server_ip,
+                        radius_secret=radius_secret,
+                        nas_ip=nas_ip,
+                        nas_port_id=nas_port_id,
+                        nftables_snapshot=nftables_snapshot,
+                        event_dispatcher=event_dispatcher,
+                        traffic_shaper=traffic_shaper,
+                    )
+                    remove_session_from_maps(
+                        s,
+                        dhcp_runtime.sessions,
+                        dhcp_runtime.sessions_by_ip,
+                        dhcp_runtime.sessions_by_session_id,
+                        dhcp_runtime.tombstones,
+                        bng_id,
+                        reason="Idle-Timeout",
+                    )
+                except Exception as e:
+                    print(f"BNG Disconnection check error for mac={s.mac} ip={s.ip}: {e}")
+            return
+
+        if kind == TIMER_LEASE_EXPIRY:
+            try:
+                await dhcp_runtime.expire_sessions(keys)
+            except Exception as e:
+                print(f"BNG Lease-Expiry error: {e}")
+            return
+
+        if kind == TIMER_TOMBSTONE_EXPIRY:
+            for key, deadline in timers:
+                t = dhcp_runtime.tombstones.get(key)
+                if t is not None and now >= deadline:
+                    dhcp_runtime.tombstones.pop(key, None)
+            return
+
+        print(f"Unknown timer kind: {kind}")
+
+    async def run_session_timers() -> None:
+        # Due timers go into the shard's mailbox, one batch per kind, behind DHCP events
+        while True:
+            await asyncio.sleep(session_timers.wheel.tick_seconds)
+            for kind, timers in session_timers.due().items():
+                timer_queue.put_nowait(
+                    (TIMER_PRIORITIES[kind], next(timer_seq), {"event": "timer", "kind": kind, "timers": timers})
+                )
+
+    async def handle_command(command: str, payload: dict[str, Any]) -> None:
+        if command == "kea_anti_entropy":
+            # `leases` is this shard's part of the supervisor's Kea dump, None if the dump failed
+            leases = payload.get("leases")
+            if leases is not None:
+                try:
+                    await dhcp_runtime.kea_anti_entropy(leases)
+                except Exception as e:
+                    print(f"BNG Kea anti-entropy error: {e}")
+            reconcile_scheduler.request(full=True)
+            return
+
+        if command == "reconcile":
+            if not reconcile_scheduler.dirty:
+                return
+            scope = reconcile_scheduler.take()
+            started = time.perf_counter()
+            try:
+                await dhcp_runtime.reconcile_handler(scope)
+            except Exception as e:
+                metrics.incr("reconcile_errors")
+                print(f"BNG Reconcile error: {e}")
+            finally:
+                metrics.incr("reconcile_runs")
+                if scope is not None:
+                    metrics.incr("reconcile_scoped_runs")
+                metrics.observe("reconcile_latency_ms", (time.perf_counter() - started) * 1000)
+                if scope is None:
+                    session_timers.sync_all()
+                    dhcp_runtime.sessions.touch_all()
+                else:
+                    for key in scope:
+                        session_timers.sync(key)
+                        dhcp_runtime.sessions.touch(key)
+            return
+
+        if command == "coad_request":
+            response_future = payload.get("response_future")
+            try:
+                response = await handle_coad_request(payload.get("request", {}))
+            except Exception as e:
+                response = {"success": False, "error": str(e)}
+            if response_future is not None and not response_future.done():
+                response_future.set_result(response)
+            return
+
+        print(f"Unknown command received: {command}")
+
+    def dhcp_event_session_key(event_dict: dict[str, Any]) -> Any:
+        # The session a DHCP event touches; RELEASE only carries the IP
+        circuit_id = decode_bytes(event_dict.get("circuit_id"))
+        remote_id = decode_bytes(event_dict.get("remote_id"))
+        if circuit_id and remote_id:
+            # Interned like the SessionStore's keys, so timer keys don't hold their own copies
+            return (bng_id, sys.intern(circuit_id), sys.intern(remote_id))
+        s = dhcp_runtime.sessions_by_ip.get(decode_bytes(event_dict.get("ip")) or "")
+        if s is not None:
+            return (bng_id, s.circuit_id, s.remote_id)
+        return None
+
+    def end_session_run(key: Any, handled: bool) -> None:
+        if handled:
+            # Coalesced with every other reconcile request until the next run
+            reconcile_scheduler.request(key)
+        if key is not None:
+            session_timers.sync(key)
+            dhcp_runtime.sessions.touch(key)
+
+    async def handle_session_event(event_dict: dict[str, Any]) -> bool:
+        """returns: whether the DHCP or lease event was handled without error"""
+        if event_dict["event"] == "lease":
+            try:
+                await dhcp_runtime.handle_lease_event(event_dict["lease"])
+            except Exception as e:
+                print(f"BNG lease event processing error: {e}")
+                return False
+            return True
+
+        try:
+            await dhcp_runtime.handle_dhcp_event(event_dict)
+        except Exception as e:
+            print(f"BNG DHCP event processing error: {e}")
+            return False
+        return True
+
+    async def handle_timer_event(event_dict: dict[str, Any]) -> None:
+        kind = event_dict["kind"]
+        timers = event_dict["timers"]
+        try:
+            await handle_timers(kind, timers)
+        except Exception as e:
+            print(f"BNG {kind} timer error: {e}")
+        finally:
+            for key, _ in timers:
+                session_timers.done(kind, key)
+                session_timers.sync(key)
+                dhcp_runtime.sessions.touch(key)
+
+    async def process_batch(batch: list[tuple[MailboxChannel, Any]]) -> None:
+        # A run of consecutive events for one session is handled back to back; its timers are synced and
+        # its reconcile requested once, after the run
+        run_key: Any = _NO_RUN
+        run_handled = False
+        for channel, item in batch:
+            event_dict = item[2] if channel is not command_queue else None
+            kind = event_dict.get("event") if isinstance(event_dict, dict) else None
+
+            key = _NO_RUN
+            if kind == "lease":
+                lease_event: LeaseEvent = event_dict["lease"]
+                key = (bng_id, sys.intern(lease_event.circuit_id), sys.intern(lease_event.remote_id))
+            elif kind == "dhcp":
+                key = dhcp_event_session_key(event_dict)
+
+            if run_key is not _NO_RUN and (key != run_key or key is None):
+                end_session_run(run_key, run_handled)
+                run_key, run_handled = _NO_RUN, False
+
+            if channel is command_queue:
+                command, payload = item
+                await handle_command(command, payload)
+            elif kind == "timer":
+                await handle_timer_event(event_dict)
+            elif key is not _NO_RUN:
+                run_key = key
+                run_handled = await handle_session_event(event_dict) or run_handled
+
+        if run_key is not _NO_RUN:
+            end_session_run(run_key, run_handled)
+
+    async def run(session_journal: SessionJournal | None = None) -> None:
+        session_timers.sync_all()
+
+        periodic_tasks = [asyncio.create_task(run_session_timers())]
+        if not KEA_LEASE_EVENTS_ENABLED:
+            periodic_tasks.append(asyncio.create_task(periodic_full_reconcile(reconciler_interval)))
+
+        try:
+            while True:
+                await process_batch(await mailbox.get_batch(MAILBOX_DRAIN_MAX))
+
+                # authed_ips changes queued during this batch go out as one nft transaction
+                try:
+                    await nft_flush_authed_ips()
+                except Exception as e:
+                    print(f"BNG authed_ips flush error: {e}")
+
+                if session_journal is not None:
+                    # Sessions changed during this batch go to the standby as one Redis transaction
+                    try:
+                        await session_journal.flush(dhcp_runtime.sessions)
+                    except Exception as e:
+                        print(f"BNG session journal error: {e}")
+        finally:
+            for task in periodic_tasks:
+                task.cancel()
+            for task in periodic_tasks:
+                with contextlib.suppress(asyncio.CancelledError):
+                    await task
+
+    return SessionShard(
+        index=index,
+        dhcp_runtime=dhcp_runtime,
+        session_timers=session_timers,
+        event_queue=event_queue,
+        command_queue=command_queue,
+        run=run,
+    )
@@ -0,0 +1,183 @@
+import heapq
+import sys
+from collections.abc import MutableMapping
+from typing import AbstractSet, Callable, Dict, Iterator, List, Set, Tuple
+
+from lib.radius.session import DHCPSession, pack_ip, pack_session_id, unpack_ip, unpack_session_id
+from lib.services.bng_session import SessionKey
+
+
+class PackedKeyMap(MutableMapping):
+    """
+    Session lookup map keyed by the packed form of a string key (IP, session id).
+    Read and written with the usual strings; only the packed ints are held.
+    """
+
+    def __init__(self, pack: Callable[[str], int | str], unpack: Callable[[int | str], str]) -> None:
+        self._pack = pack
+        self._unpack = unpack
+        self._data: Dict[int | str, DHCPSession] = {}
+
+    def __getitem__(self, key: str) -> DHCPSession:
+        return self._data[self._pack(key)]
+
+    def get(self, key: str, default: DHCPSession | None = None) -> DHCPSession | None:
+        return self._data.get(self._pack(key), default)
+
+    def __contains__(self, key: object) -> bool:
+        return isinstance(key, str) and self._pack(key) in self._data
+
+    def __setitem__(self, key: str, s: DHCPSession) -> None:
+        self._data[self._pack(key)] = s
+
+    def __delitem__(self, key: str) -> None:
+        del self._data[self._pack(key)]
+
+    def pop(self, key: str, *default):
+        return self._data.pop(self._pack(key), *default)
+
+    def __iter__(self) -> Iterator[str]:
+        return (self._unpack(key) for key in self._data)
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+class SessionStore(MutableMapping):
+    """
+    The BNG's sessions by (relay_id, circuit_id, remote_id), with the lookup maps and secondary indexes.
+
+    `by_ip` and `by_session_id` are kept up to date by the callers that move a session's IP or
+    session id, as before. The auth_state and status indexes and the expiry heap are maintained
+    here: adding or removing a session updates them, and so does assigning `status`, `auth_state`
+    or `expiry` on a session the store holds (see DHCPSession's setters). Jobs that only care
+    about some sessions ask the indexes instead of walking the whole map.
+
+    With track_changes() the store also records which keys were added, removed or changed, for
+    replication to pick up in batches.
+
+    `by_ip` and `by_session_id` hold packed keys (see PackedKeyMap), like the sessions themselves.
+    """
+
+    def __init__(self) -> None:
+        self._sessions: Dict[SessionKey, DHCPSession] = {}
+        self.by_ip = PackedKeyMap(pack_ip, unpack_ip)
+        self.by_session_id = PackedKeyMap(pack_session_id, unpack_session_id)
+        self._by_auth_state: Dict[str, Set[SessionKey]] = {}
+        self._by_status: Dict[str, Set[SessionKey]] = {}
+        # (expiry, key), lazily invalidated: an entry counts only while it matches the session's expiry
+        self._expiry_heap: List[Tuple[int, SessionKey]] = []
+        # Keys added, removed or changed since the last take_touched(), None until track_changes()
+        self._touched: Set[SessionKey] | None = None
+
+    def __getitem__(self, key: SessionKey) -> DHCPSession:
+        return self._sessions[key]
+
+    def get(self, key: SessionKey, default: DHCPSession | None = None) -> DHCPSession | None:
+        return self._sessions.get(key, default)
+
+    def __contains__(self, key: object) -> bool:
+        return key in self._sessions
+
+    def __iter__(self) -> Iterator[SessionKey]:
+        return iter(self._sessions)
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+    def __setitem__(self, key: SessionKey, s: DHCPSession) -> None:
+        # Interned, so the key shares its strings with the session's option-82 fields
+        key = tuple(sys.intern(part) for part in key) # type: ignore[assignment]
+        old = self._sessions.get(key)
+        if old is s:
+            return
+        if old is not None:
+            self._unindex(key, old)
+        self._sessions[key] = s
+        self._index(key, s)
+        self.touch(key)
+
+    def __delitem__(self, key: SessionKey) -> None:
+        s = self._sessions.pop(key)
+        self._unindex(key, s)
+        self.touch(key)
+
+    def track_changes(self) -> None:
+        """Starts recording touched keys for take_touched(), e.g. for the session journal."""
+        if self._touched is None:
+            self._touched = set()
+
+    def touch(self, key: SessionKey) -> None:
+        # Also called for changes the store can't see itself, see DHCPSession's ip/mac/session_id setters
+        if self._touched is not None:
+            self._touched.add(key)
+
+    def touch_all(self) -> None:
+        if self._touched is not None:
+            self._touched.update(self._sessions)
+
+    def take_touched(self) -> Set[SessionKey]:
+        """returns: keys touched since the last call (present or since removed)"""
+        if self._touched is None:
+            return set()
+        touched, self._touched = self._touched, set()
+        return touched
+
+    def _index(self, key: SessionKey, s: DHCPSession) -> None:
+        s._index = (self, key)
+        self._by_auth_state.setdefault(s.auth_state, set()).add(key)
+        self._by_status.setdefault(s.status, set()).add(key)
+        if s.expiry is not None:
+            self._push_expiry(s.expiry, key)
+
+    def _unindex(self, key: SessionKey, s: DHCPSession) -> None:
+        s._index = None
+        self._by_auth_state.get(s.auth_state, set()).discard(key)
+        self._by_status.get(s.status, set()).discard(key)
+        # Its heap entries go stale and are dropped when they surface
+
+    def _reindex(self, key: SessionKey, name: str, old, new) -> None:
+        self.touch(key)
+        if name == "auth_state":
+            self._by_auth_state.get(old, set()).discard(key)
+            self._by_auth_state.setdefault(new, set()).add(key)
+        elif name == "status":
+            self._by_status.get(old, set()).discard(key)
+            self._by_status.setdefault(new, set()).add(key)
+        elif name == "expiry" and new is not None:
+            self._push_expiry(new, key)
+
+    def _push_expiry(self, expiry: int, key: SessionKey) -> None:
+        heapq.heappush(self._expiry_heap, (expiry, key))
+        # Every renew leaves a stale entry behind; rebuild before they dominate the heap
+        if len(self._expiry_heap) > 2 * len(self._sessions) + 64:
+            self._expiry_heap = [
+                (s.expiry, key) for key, s in self._sessions.items() if s.expiry is not None
+            ]
+            heapq.heapify(self._expiry_heap)
+
+    def _live(self, expiry: int, key: SessionKey) -> bool:
+        s = self._sessions.get(key)
+        return s is not None and s.expiry == expiry
+
+    def with_auth_state(self, auth_state: str) -> AbstractSet[SessionKey]:
+        """returns: live view of the keys in `auth_state`; copy it before awaiting anything"""
+        return self._by_auth_state.get(auth_state, frozenset())
+
+    def with_status(self, status: str) -> AbstractSet[SessionKey]:
+        """returns: live view of the keys in `status`; copy it before awaiting anything"""
+        return self._by_status.get(status, frozenset())
+
+    def expired_keys(self, now: float) -> List[SessionKey]:
+        """returns: keys of sessions whose expiry is at or before `now`, soonest first"""
+        expired: List[Tuple[int, SessionKey]] = []
+        seen: Set[SessionKey] = set()
+        while self._expiry_heap and self._expiry_heap[0][0] <= now:
+            expiry, key = heapq.heappop(self._expiry_heap)
+            if key not in seen and self._live(expiry, key):
+                seen.add(key)
+                expired.append((expiry, key))
+        # Still-live entries stay indexed until the session goes or its expiry moves
+        for entry in expired:
+            heapq.heappush(self._expiry_heap, entry)
+        return [key for _, key in expired]
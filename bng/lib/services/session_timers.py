@@ -0,0 +1,251 @@
+import random
+import time
+from typing import Dict, Hashable, List, Set, Tuple
+
+from lib.constants import (
+    DHCP_GRACE_SECONDS,
+    MARK_DISCONNECT_GRACE_SECONDS,
+    TOMBSTONE_EXPIRY_GRACE_SECONDS,
+    TOMBSTONE_TTL_SECONDS,
+)
+from lib.radius.session import DHCPSession
+from lib.services.bng_session import SessionKey, SessionMap, TombstoneMap
+
+# Per-session deadline kinds
+TIMER_LEASE_EXPIRY = "lease_expiry"
+TIMER_INTERIM = "interim"
+TIMER_AUTH_RETRY = "auth_retry"
+TIMER_IDLE_CHECK = "idle_check"
+TIMER_TOMBSTONE_EXPIRY = "tombstone_expiry"
+
+# event_queue priorities for due timers (DHCP events are 1, DISCOVER/INFORM 5; lower runs first)
+TIMER_PRIORITIES = {
+    TIMER_LEASE_EXPIRY: 2,
+    TIMER_TOMBSTONE_EXPIRY: 2,
+    TIMER_AUTH_RETRY: 3,
+    TIMER_IDLE_CHECK: 3,
+    TIMER_INTERIM: 4,
+}
+
+AUTH_RETRY_MAX_BACKOFF_SECONDS = 300
+
+TimerKey = Tuple[str, SessionKey]
+
+
+class TimerWheel:
+    """
+    Hierarchical hashed timer wheel.
+
+    Level 0 has one slot per tick, each higher level one slot per full turn of the level below.
+    Scheduling and cancelling are O(1); advancing costs one slot visit per elapsed tick plus the
+    timers that actually fire (and the occasional cascade of a higher-level slot into lower ones).
+    Deadlines past the top level's span are parked in its farthest slot and re-placed on cascade.
+    """
+
+    def __init__(self, tick_seconds: float = 1.0, slot_bits: int = 6, levels: int = 4, now: float | None = None) -> None:
+        self.tick_seconds = tick_seconds
+        self._bits = slot_bits
+        self._mask = (1 << slot_bits) - 1
+        self._levels = levels
+        self._slots: List[List[Set[Hashable]]] = [[set() for _ in range(1 << slot_bits)] for _ in range(levels)]
+        # key -> (deadline, expires_tick, level, slot); level -1 means already due
+        self._entries: Dict[Hashable, Tuple[float, int, int, int]] = {}
+        self._due: Set[Hashable] = set()
+        self._current_tick = self._tick_of(time.time() if now is None else now)
+
+    def _tick_of(self, ts: float) -> int:
+        return int(ts / self.tick_seconds)
+
+    def _place(self, key: Hashable, deadline: float, expires_tick: int) -> None:
+        delta = expires_tick - self._current_tick
+        if delta <= 0:
+            self._due.add(key)
+            self._entries[key] = (deadline, expires_tick, -1, 0)
+            return
+
+        for level in range(self._levels):
+            if delta < 1 << (self._bits * (level + 1)) or level == self._levels - 1:
+                if level == self._levels - 1:
+                    # Farthest slot of the top level, gets re-placed when it cascades
+                    expires_at_level = min(expires_tick, self._current_tick + (1 << (self._bits * self._levels)) - 1)
+                else:
+                    expires_at_level = expires_tick
+                slot = (expires_at_level >> (self._bits * level)) & self._mask
+                self._slots[level][slot].add(key)
+                self._entries[key] = (deadline, expires_tick, level, slot)
+                return
+
+    def schedule(self, key: Hashable, deadline: float) -> None:
+        """(Re)arms `key` to fire at `deadline` (unix time)."""
+        self.cancel(key)
+        self._place(key, deadline, self._tick_of(deadline))
+
+    def cancel(self, key: Hashable) -> bool:
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return False
+        _, _, level, slot = entry
+        if level < 0:
+            self._due.discard(key)
+        else:
+            self._slots[level][slot].discard(key)
+        return True
+
+    def deadline(self, key: Hashable) -> float | None:
+        entry = self._entries.get(key)
+        return entry[0] if entry else None
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._entries
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _cascade(self, level: int) -> None:
+        slot = (self._current_tick >> (self._bits * level)) & self._mask
+        keys = self._slots[level][slot]
+        self._slots[level][slot] = set()
+        for key in keys:
+            deadline, expires_tick, _, _ = self._entries.pop(key)
+            self._place(key, deadline, expires_tick)
+
+    def advance(self, now: float | None = None) -> List[Tuple[Hashable, float]]:
+        """
+        Moves the wheel up to `now`.
+        returns: [(key, deadline)] for every timer that fired, removed from the wheel
+        """
+        target_tick = self._tick_of(time.time() if now is None else now)
+        fired: List[Tuple[Hashable, float]] = []
+
+        def fire(keys) -> None:
+            for key in keys:
+                deadline, _, _, _ = self._entries.pop(key)
+                fired.append((key, deadline))
+
+        fire(self._due)
+        self._due = set()
+
+        while self._current_tick < target_tick:
+            self._current_tick += 1
+
+            # Entering a new turn of a level pulls the matching slot of the level above down
+            for level in range(1, self._levels):
+                if (self._current_tick >> (self._bits * (level - 1))) & self._mask:
+                    break
+                self._cascade(level)
+
+            slot = self._current_tick & self._mask
+            keys = self._slots[0][slot]
+            self._slots[0][slot] = set()
+            fire(keys)
+
+            # Cascades can land timers exactly on the current tick
+            fire(self._due)
+            self._due = set()
+
+        return fired
+
+
+class SessionTimers:
+    """
+    Per-session deadlines for the BNG event loop: lease expiry, next interim, auth-retry backoff,
+    idle-disconnect check and tombstone expiry.
+
+    Owned by the single-writer loop. After anything changes a session (or its tombstone), the loop
+    calls `sync(key)` and the session's deadlines are re-derived from its state. Timers handed out
+    by `due()` stay "in flight" until the loop calls `done()`, so a sync in between doesn't arm a
+    second copy of a timer whose handler hasn't run yet.
+    """
+
+    def __init__(
+        self,
+        sessions: SessionMap,
+        tombstones: TombstoneMap,
+        *,
+        interim_interval: int,
+        auth_retry_interval: int,
+        tick_seconds: float = 1.0,
+    ) -> None:
+        self.sessions = sessions
+        self.tombstones = tombstones
+        self.interim_interval = interim_interval
+        self.auth_retry_interval = auth_retry_interval
+        self.wheel = TimerWheel(tick_seconds=tick_seconds)
+        self._inflight: Set[TimerKey] = set()
+
+    def _armed(self, timer_key: TimerKey) -> bool:
+        return timer_key in self.wheel or timer_key in self._inflight
+
+    def _arm_once(self, timer_key: TimerKey, deadline: float) -> None:
+        # Arms only if not already pending, so repeated syncs don't push the deadline back
+        if not self._armed(timer_key):
+            self.wheel.schedule(timer_key, deadline)
+
+    def _set(self, timer_key: TimerKey, deadline: float | None) -> None:
+        # Tracks a deadline that is fully determined by session state
+        if deadline is None:
+            self.wheel.cancel(timer_key)
+        elif self.wheel.deadline(timer_key) != deadline and timer_key not in self._inflight:
+            self.wheel.schedule(timer_key, deadline)
+
+    def auth_retry_backoff(self, s: DHCPSession) -> float:
+        return min(AUTH_RETRY_MAX_BACKOFF_SECONDS, self.auth_retry_interval * (2 ** min(s.auth_retry_attempts, 16)))
+
+    def sync(self, key: SessionKey, now: float | None = None) -> None:
+        now = time.time() if now is None else now
+        s = self.sessions.get(key)
+
+        if s is None:
+            for kind in (TIMER_LEASE_EXPIRY, TIMER_INTERIM, TIMER_AUTH_RETRY, TIMER_IDLE_CHECK):
+                self.wheel.cancel((kind, key))
+        else:
+            self._set((TIMER_LEASE_EXPIRY, key), s.expiry + DHCP_GRACE_SECONDS if s.expiry else None)
+
+            if s.auth_state == "AUTHORIZED" and s.status != "EXPIRED":
+                # First interim lands at a random phase so sessions admitted together don't tick together
+                self._arm_once((TIMER_INTERIM, key), now + random.uniform(0, self.interim_interval))
+            else:
+                self.wheel.cancel((TIMER_INTERIM, key))
+
+            if s.auth_state == "PENDING_AUTH" and s.status != "PENDING" and s.ip is not None:
+                self._arm_once((TIMER_AUTH_RETRY, key), now + self.auth_retry_backoff(s))
+            else:
+                self.wheel.cancel((TIMER_AUTH_RETRY, key))
+
+            if s.status == "IDLE" and s.last_idle_ts is not None:
+                self._set((TIMER_IDLE_CHECK, key), s.last_idle_ts + MARK_DISCONNECT_GRACE_SECONDS)
+            else:
+                self.wheel.cancel((TIMER_IDLE_CHECK, key))
+
+        t = self.tombstones.get(key)
+        if t is None:
+            self.wheel.cancel((TIMER_TOMBSTONE_EXPIRY, key))
+        else:
+            deadline = t.stopped_at + TOMBSTONE_TTL_SECONDS
+            if t.latest_state_update_ts_at_stop:
+                deadline = min(deadline, t.latest_state_update_ts_at_stop + TOMBSTONE_EXPIRY_GRACE_SECONDS)
+            self._set((TIMER_TOMBSTONE_EXPIRY, key), deadline)
+
+    def sync_all(self, now: float | None = None) -> None:
+        for key in set(self.sessions) | set(self.tombstones):
+            self.sync(key, now)
+
+    def reschedule_interim(self, key: SessionKey, previous_deadline: float, now: float | None = None) -> None:
+        # Keeps each session on its own fixed phase instead of drifting by handler latency
+        now = time.time() if now is None else now
+        deadline = previous_deadline + self.interim_interval
+        if deadline <= now:
+            deadline = now + self.interim_interval
+        self.wheel.schedule((TIMER_INTERIM, key), deadline)
+
+    def due(self, now: float | None = None) -> Dict[str, List[Tuple[SessionKey, float]]]:
+        """returns: {kind: [(session key, deadline)]} for every timer that fired, marked in flight"""
+        grouped: Dict[str, List[Tuple[SessionKey, float]]] = {}
+        for timer_key, deadline in self.wheel.advance(now):
+            kind, key = timer_key
+            self._inflight.add(timer_key)
+            grouped.setdefault(kind, []).append((key, deadline))
+        return grouped
+
+    def done(self, kind: str, key: SessionKey) -> None:
+        self._inflight.discard((kind, key))
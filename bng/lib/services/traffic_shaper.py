@@ -1,6 +1,12 @@
-from typing import Tuple
-from dataclasses import dataclass
+from typing import Dict, List, Set, Tuple
 import asyncio
+from dataclasses import dataclass, field
+import ipaddress
+import time
+
+from lib.group_commit import GroupCommit
+from lib.tc.classid_allocator import TcClassidAllocator
+from lib.tc.client import TcBatchClient, tc_list_classids
 
 @dataclass
 class BNGTrafficShaperConfig:
@@ -10,46 +16,279 @@ class BNGTrafficShaperConfig:
     subscriber_facing_interface: str
     uplink_interface: str
     debug_mode: bool = False
+    debug_log_limit_per_sec: int = 20
+    tc_batch_timeout: float = 5.0
+    # Subscriber pools served by this BNG, any number of prefixes. Empty means accept any IPv4 address.
+    subscriber_prefixes: List[str] = field(default_factory=list)
+    # Where the ip -> classid table is kept across restarts. None disables persistence.
+    classid_state_path: str | None = None
+
+# How long classid changes are collected before the table is written out
+CLASSID_SAVE_DELAY_SECONDS = 1.0
+
+# Classids used by the static HTB tree (root class 1:1, default class 1:9999), never handed to subscribers
+RESERVED_CLASSIDS = (0x1, 0x9999)
+
+# u32 classification layout (same on both interfaces, all under one filter priority):
+#   ht 800 (root)   -> hashes the 3rd address octet into ht 100
+#   ht 100, bucket c -> hashes the 4th address octet into ht (200 + c)
+#   ht (200 + c), bucket d -> one /32 match per subscriber, flowid = subscriber class
+# Classification is two hash lookups regardless of how many subscribers there are.
+U32_FILTER_PRIO = 10
+U32_OCTET3_HT = 0x100
+U32_OCTET4_HT_BASE = 0x200
+
+# Byte offset of the address in the IPv4 header
+_IP_DST_OFFSET = 16
+_IP_SRC_OFFSET = 12
+
+@dataclass
+class TrafficShapingRule:
+    ip: str
+    upload_speed_kbit: int # Egress for uplink interface | Shaping
+    download_speed_kbit: int # Egress for subscriber interface | Shaping
+    download_burst_kbit: int # Burst size for shaping (optional)
+    upload_burst_kbit: int # Burst size for shaping (optional)
+
+class _RateLimitedLog:
+    # Structured `key=value` debug lines, capped per second so a reconnect storm can't flood stdout
+
+    def __init__(self, prefix: str, limit_per_sec: int) -> None:
+        self.prefix = prefix
+        self.limit_per_sec = limit_per_sec
+        self._window_start = 0.0
+        self._emitted = 0
+        self._suppressed = 0
+
+    def __call__(self, event: str, **fields) -> None:
+        now = time.monotonic()
+        if now - self._window_start >= 1.0:
+            if self._suppressed:
+                print(f"{self.prefix} event=log_suppressed count={self._suppressed}")
+            self._window_start = now
+            self._emitted = 0
+            self._suppressed = 0
+
+        if self._emitted >= self.limit_per_sec:
+            self._suppressed += 1
+            return
+
+        self._emitted += 1
+        print(" ".join([f"{self.prefix} event={event}"] + [f"{k}={v}" for k, v in fields.items()]))
 
 class BNGTrafficShaper:
     # Handles all traffic shaping related operations through Linux's tc utility.
-    
+    # All of a call's class/qdisc/filter changes go to tc as one batch over a long-lived channel.
+
     def __init__(self, config: BNGTrafficShaperConfig):
         self.config = config
+        self._tc = TcBatchClient(timeout=config.tc_batch_timeout)
+        self._debug = _RateLimitedLog("TrafficShaper", config.debug_log_limit_per_sec)
+
+        self._prefixes = [ipaddress.IPv4Network(p) for p in config.subscriber_prefixes]
+        self._classids = TcClassidAllocator(state_path=config.classid_state_path, reserved=RESERVED_CLASSIDS)
+
+        self._u32_root_ready = False
+        self._u32_octet4_tables: Set[int] = set() # 3rd octets whose 4th-octet table exists
+        # (3rd octet, 4th octet, node id) -> the IP whose filter has that handle, including restored ones
+        self._u32_nodes: Dict[Tuple[int, int, int], str] = {
+            self._u32_location(ip): ip for ip in self._classids.ips()
+        }
 
-    def _generate_handle_with_ip(self, ip: str) -> Tuple[bool, int, str]:
-        # a.b.c.d, handle = c * 256 + d
-        # ISSUE: this means we can only use 65535 unique handles per BNG. For a lab and small-scale ISPs
-        #       this is more than enough. Might have to change the handling for larget scale BNGs though
-        octets = ip.split('.')
-        if len(octets) != 4:
-            return False, -1, "invalid IP address format"
+        self._classid_save: asyncio.Task | None = None
 
+        # Single-subscriber adds and removes from concurrent callers share tc batches
+        self._adds = GroupCommit(self._add_batch)
+        self._removes = GroupCommit(self._remove_batch)
+
+    def _allocate_classid(self, ip: str) -> Tuple[bool, int, str]:
         try:
-            c = int(octets[2])
-            d = int(octets[3])
+            addr = ipaddress.IPv4Address(ip)
+        except ValueError as e:
+            return False, -1, f"invalid IP address: {e}"
 
-            handle = int(c) * 256 + int(d)
+        if self._prefixes and not any(addr in prefix for prefix in self._prefixes):
+            return False, -1, "IP address outside of the configured subscriber prefixes"
 
-            return True, handle, ""
-        except Exception as e:
-            return False, -1, f"error parsing IP address: {str(e)}"
+        # `filter replace` on a handle another IP holds would reroute that subscriber's traffic
+        location = self._u32_location(ip)
+        holder = self._u32_nodes.get(location)
+        if holder is not None and holder != ip:
+            return False, -1, f"u32 filter handle {self._u32_filter_handle(ip)} is already used by {holder}"
+
+        try:
+            classid = self._classids.allocate(ip)
+        except RuntimeError as e:
+            return False, -1, str(e)
+        self._u32_nodes[location] = ip
+        return True, classid, ""
+
+    def _u32_location(self, ip: str) -> Tuple[int, int, int]:
+        # returns: 3rd octet, 4th octet, u32 node id within the bucket
+        # Subscribers from different /16s can share a bucket, the node id keeps their filters apart. It repeats
+        # every 0xffe /16s, so the shaper refuses a second IP on a handle that is already taken.
+        a, b, c, d = ipaddress.IPv4Address(ip).packed
+        node = ((a << 8) | b) % 0xffe + 1 # 12-bit node ids, 0 is reserved
+        return c, d, node
 
-    async def _cmd(self, cmd: str) -> str | None:
-        proc = await asyncio.create_subprocess_shell(
-            cmd,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.STDOUT,
+    def _u32_table_commands(self, octet3: int | None) -> List[str]:
+        # octet3 None: the root's 3rd-octet table and its link, otherwise the 4th-octet table for octet3 and its link.
+        # Hash tables and link filters have fixed handles, so re-adding them after a restart just fails harmlessly.
+        commands = []
+        for iface, offset in (
+            (self.config.subscriber_facing_interface, _IP_DST_OFFSET),
+            (self.config.uplink_interface, _IP_SRC_OFFSET),
+        ):
+            if octet3 is None:
+                commands += [
+                    f"filter add dev {iface} parent 1: prio {U32_FILTER_PRIO} handle {U32_OCTET3_HT:x}: "
+                    f"protocol ip u32 divisor 256",
+                    f"filter add dev {iface} parent 1: prio {U32_FILTER_PRIO} handle 800::1 protocol ip u32 ht 800:: "
+                    f"match u32 0 0 hashkey mask 0x0000ff00 at {offset} link {U32_OCTET3_HT:x}:",
+                ]
+            else:
+                octet4_ht = U32_OCTET4_HT_BASE + octet3
+                commands += [
+                    f"filter add dev {iface} parent 1: prio {U32_FILTER_PRIO} handle {octet4_ht:x}: "
+                    f"protocol ip u32 divisor 256",
+                    f"filter add dev {iface} parent 1: prio {U32_FILTER_PRIO} "
+                    f"handle {U32_OCTET3_HT:x}:{octet3:x}:1 protocol ip u32 ht {U32_OCTET3_HT:x}:{octet3:x}: "
+                    f"match u32 0 0 hashkey mask 0x000000ff at {offset} link {octet4_ht:x}:",
+                ]
+        return commands
+
+    def _u32_filter_handle(self, ip: str) -> str:
+        octet3, octet4, node = self._u32_location(ip)
+        return f"{U32_OCTET4_HT_BASE + octet3:x}:{octet4:x}:{node:x}"
+
+    def _class_commands(self, rule: TrafficShapingRule, classid: int, verb: str) -> Tuple[str, str]:
+        # returns: download class command, upload class command
+        handle = f"{classid:x}" # tc parses class minors and qdisc majors as hex
+        # Keep burst values practical and avoid invalid zero/negative values.
+        download_burst_kbit = max(1, int(rule.download_burst_kbit))
+        upload_burst_kbit = max(1, int(rule.upload_burst_kbit))
+
+        return (
+            f"class {verb} dev {self.config.subscriber_facing_interface} parent 1:1 classid 1:{handle} "
+            f"htb rate {rule.download_speed_kbit}kbit ceil {rule.download_speed_kbit}kbit "
+            f"burst {download_burst_kbit}kbit cburst {download_burst_kbit}kbit",
+            f"class {verb} dev {self.config.uplink_interface} parent 1:1 classid 1:{handle} "
+            f"htb rate {rule.upload_speed_kbit}kbit ceil {rule.upload_speed_kbit}kbit "
+            f"burst {upload_burst_kbit}kbit cburst {upload_burst_kbit}kbit",
         )
-        stdout, _ = await proc.communicate()
-        output = stdout.decode() if stdout else None
 
+    def _add_commands(self, rule: TrafficShapingRule, classid: int) -> List[str]:
+        ip = rule.ip
+        octet3, octet4, _ = self._u32_location(ip)
+        bucket = f"{U32_OCTET4_HT_BASE + octet3:x}:{octet4:x}:"
+        filter_handle = self._u32_filter_handle(ip)
+        handle = f"{classid:x}"
+        download_iface = self.config.subscriber_facing_interface
+        upload_iface = self.config.uplink_interface
+        download_class, upload_class = self._class_commands(rule, classid, "replace")
+
+        return [
+            # For egress on subscriber interface (download shaping)
+            download_class,
+            f"qdisc replace dev {download_iface} parent 1:{handle} handle {handle}: sfq perturb 10",
+            f"filter replace dev {download_iface} parent 1: prio {U32_FILTER_PRIO} handle {filter_handle} "
+            f"protocol ip u32 ht {bucket} match ip dst {ip}/32 flowid 1:{handle}",
+
+            # For egress on uplink interface (upload shaping)
+            upload_class,
+            f"qdisc replace dev {upload_iface} parent 1:{handle} handle {handle}: sfq perturb 10",
+            f"filter replace dev {upload_iface} parent 1: prio {U32_FILTER_PRIO} handle {filter_handle} "
+            f"protocol ip u32 ht {bucket} match ip src {ip}/32 flowid 1:{handle}",
+        ]
+
+    def _remove_commands(self, ip: str, classid: int) -> List[str]:
+        filter_handle = self._u32_filter_handle(ip)
+        handle = f"{classid:x}" # tc parses class minors and qdisc majors as hex
+        download_iface = self.config.subscriber_facing_interface
+        upload_iface = self.config.uplink_interface
+
+        # Delete filters first, then child qdisc and class (both interfaces).
+        return [
+            f"filter del dev {download_iface} parent 1: prio {U32_FILTER_PRIO} handle {filter_handle} protocol ip u32",
+            f"filter del dev {upload_iface} parent 1: prio {U32_FILTER_PRIO} handle {filter_handle} protocol ip u32",
+            f"qdisc del dev {download_iface} parent 1:{handle} handle {handle}:",
+            f"qdisc del dev {upload_iface} parent 1:{handle} handle {handle}:",
+            f"class del dev {download_iface} classid 1:{handle}",
+            f"class del dev {upload_iface} classid 1:{handle}",
+        ]
+
+    async def _run_batch(self, commands: List[str]) -> List[Tuple[int, str]]:
+        failures = await self._tc.run(commands)
         if self.config.debug_mode:
-            print(f"Executed command: {cmd}")
-            if output:
-                print(f"Command output: {output}")
+            self._debug("tc_batch", commands=len(commands), failed=len(failures))
+            for idx, error in failures:
+                self._debug("tc_failed", command=f"\"{commands[idx]}\"", error=f"\"{error}\"")
+        return failures
+
+    async def add_traffic_shaping_rules(self, rules: List[TrafficShapingRule]) -> Dict[str, int | None]:
+        """
+        Applies many subscribers' class/qdisc/filter triples on both interfaces in a single tc batch.
+        returns: {ip: allocated classid, or None on failure}
+        """
+        results: Dict[str, int | None] = {}
+        commands: List[str] = []
+        owner: List[str | None] = [] # commands[i] belongs to owner[i]
+        # Shared hash tables belong to no subscriber: commands[i] -> its table's 3rd octet, None for the root's
+        tables: Dict[int, int | None] = {}
+        queued_tables: Set[int | None] = set()
+
+        for rule in rules:
+            success, classid, error = self._allocate_classid(rule.ip)
+            if not success:
+                print(f"Error allocating classid for IP {rule.ip}: {error}")
+                results[rule.ip] = None
+                continue
+
+            if self.config.debug_mode:
+                self._debug("add", ip=rule.ip, classid=f"1:{classid:x}",
+                            down_kbit=rule.download_speed_kbit, up_kbit=rule.upload_speed_kbit)
+
+            # The shared hash tables may already exist, and if they are really missing the subscriber's own
+            # filters fail with them
+            octet3 = self._u32_location(rule.ip)[0]
+            for table in (None, octet3):
+                if table in queued_tables or (
+                    self._u32_root_ready if table is None else table in self._u32_octet4_tables
+                ):
+                    continue
+                queued_tables.add(table)
+                for command in self._u32_table_commands(table):
+                    tables[len(commands)] = table
+                    commands.append(command)
+                    owner.append(None)
+            for command in self._add_commands(rule, classid):
+                commands.append(command)
+                owner.append(rule.ip)
+            results[rule.ip] = classid
+
+        failed = {idx for idx, _ in await self._run_batch(commands)}
+        for idx in failed:
+            ip = owner[idx]
+            if ip is not None:
+                results[ip] = None
 
-        return output
+        # A table is known to exist once its own commands went in, or a subscriber's filter hanging off it did.
+        # Until then every batch that needs it tries to create it again.
+        created = set(queued_tables)
+        created -= {tables[idx] for idx in failed if idx in tables}
+        for ip, classid in results.items():
+            if classid is not None:
+                created |= {None, self._u32_location(ip)[0]}
+        if None in created:
+            self._u32_root_ready = True
+        self._u32_octet4_tables |= {table for table in created if table is not None}
+
+        self._save_classids_later()
+        return results
+
+    async def _add_batch(self, rules: List[TrafficShapingRule]) -> List[int | None]:
+        results = await self.add_traffic_shaping_rules(rules)
+        return [results.get(rule.ip) for rule in rules]
 
     async def add_traffic_shaping_rule(
             self,
@@ -59,76 +298,188 @@ class BNGTrafficShaper:
             download_speed_kbit: int, # Egress for subscriber interface | Shaping
             download_burst_kbit: int, # Burst size for shaping (optional)
             upload_burst_kbit: int, # Burst size for shaping (optional)
-    ) -> bool:
-        success, handle, error = self._generate_handle_with_ip(ip)
-        if not success:
-            print(f"Error generating handle for IP {ip}: {error}")
-            return False
+    ) -> int | None:
+        """returns: the subscriber's classid, or None if shaping could not be applied"""
+        return await self._adds.submit(
+            TrafficShapingRule(
+                ip=ip,
+                upload_speed_kbit=upload_speed_kbit,
+                download_speed_kbit=download_speed_kbit,
+                download_burst_kbit=download_burst_kbit,
+                upload_burst_kbit=upload_burst_kbit,
+            )
+        )
 
-        if self.config.debug_mode:
-            print(f"Adding traffic shaping rule for IP {ip} with handle {handle}")
+    async def change_traffic_shaping_rules(
+        self,
+        rules: List[TrafficShapingRule],
+        classids: Dict[str, int] | None = None,
+    ) -> Dict[str, bool]:
+        """
+        Retunes existing subscriber classes in place (`tc class change`), in a single tc batch.
+        Qdiscs, filters and the class's queue are left untouched, so the subscriber sees no disruption.
+        IPs that were never shaped fail; callers should fall back to `add_traffic_shaping_rules`.
+        returns: {ip: success}
+        """
+        classids = classids or {}
+        results: Dict[str, bool] = {}
+        commands: List[str] = []
+        owner: List[str] = [] # commands[i] belongs to owner[i]
 
-        handle = str(handle)
-        download_iface = self.config.subscriber_facing_interface
-        upload_iface = self.config.uplink_interface
-        # Keep burst values practical and avoid invalid zero/negative values.
-        download_burst_kbit = max(1, int(download_burst_kbit))
-        upload_burst_kbit = max(1, int(upload_burst_kbit))
-
-        # For egress on subscriber interface (download shaping)
-        await self._cmd(
-            f"tc class replace dev {download_iface} parent 1:1 classid 1:{handle} "
-            f"htb rate {download_speed_kbit}kbit ceil {download_speed_kbit}kbit "
-            f"burst {download_burst_kbit}kbit cburst {download_burst_kbit}kbit"
-        )
-        await self._cmd(
-            f"tc qdisc replace dev {download_iface} parent 1:{handle} handle {handle}: sfq perturb 10"
-        )
-        await self._cmd(
-            f"tc filter replace dev {download_iface} parent 1: protocol ip pref {handle} "
-            f"u32 match ip dst {ip}/32 flowid 1:{handle}"
-        )
+        for rule in rules:
+            classid = classids.get(rule.ip)
+            if classid is None:
+                classid = self._classids.get(rule.ip)
+            if classid is None:
+                results[rule.ip] = False
+                continue
 
-        # For egress on uplink interface (upload shaping)
-        await self._cmd(
-            f"tc class replace dev {upload_iface} parent 1:1 classid 1:{handle} "
-            f"htb rate {upload_speed_kbit}kbit ceil {upload_speed_kbit}kbit "
-            f"burst {upload_burst_kbit}kbit cburst {upload_burst_kbit}kbit"
-        )
-        await self._cmd(
-            f"tc qdisc replace dev {upload_iface} parent 1:{handle} handle {handle}: sfq perturb 10"
-        )
-        await self._cmd(
-            f"tc filter replace dev {upload_iface} parent 1: protocol ip pref {handle} "
-            f"u32 match ip src {ip}/32 flowid 1:{handle}"
-        )
+            if self.config.debug_mode:
+                self._debug("change", ip=rule.ip, classid=f"1:{classid:x}",
+                            down_kbit=rule.download_speed_kbit, up_kbit=rule.upload_speed_kbit)
 
-        return True
+            for command in self._class_commands(rule, classid, "change"):
+                commands.append(command)
+                owner.append(rule.ip)
+            results[rule.ip] = True
 
-    async def remove_traffic_shaping_rule(self, *, ip: str) -> bool:
-        success, handle, error = self._generate_handle_with_ip(ip)
-        if not success:
-            print(f"Error generating handle for IP {ip}: {error}")
-            return False
+        for idx, _ in await self._run_batch(commands):
+            results[owner[idx]] = False
 
-        handle = str(handle)
-        download_iface = self.config.subscriber_facing_interface
-        upload_iface = self.config.uplink_interface
+        return results
 
-        # Delete filters first, then child qdisc and class (both interfaces).
-        await self._cmd(
-            f"tc filter del dev {download_iface} parent 1: protocol ip pref {handle} || true"
-        )
-        await self._cmd(
-            f"tc filter del dev {upload_iface} parent 1: protocol ip pref {handle} || true"
-        )
-        await self._cmd(
-            f"tc qdisc del dev {download_iface} parent 1:{handle} handle {handle}: || true"
+    async def change_traffic_shaping_rule(
+            self,
+            *,
+            ip: str,
+            classid: int | None,
+            upload_speed_kbit: int,
+            download_speed_kbit: int,
+            download_burst_kbit: int,
+            upload_burst_kbit: int,
+    ) -> bool:
+        results = await self.change_traffic_shaping_rules(
+            [
+                TrafficShapingRule(
+                    ip=ip,
+                    upload_speed_kbit=upload_speed_kbit,
+                    download_speed_kbit=download_speed_kbit,
+                    download_burst_kbit=download_burst_kbit,
+                    upload_burst_kbit=upload_burst_kbit,
+                )
+            ],
+            {ip: classid} if classid is not None else None,
         )
-        await self._cmd(
-            f"tc qdisc del dev {upload_iface} parent 1:{handle} handle {handle}: || true"
+        return results.get(ip, False)
+
+    async def remove_traffic_shaping_rules(
+        self,
+        ips: List[str],
+        classids: Dict[str, int] | None = None,
+    ) -> Dict[str, bool]:
+        """
+        Removes many subscribers' shaping in a single tc batch and frees their classids.
+        `classids` carries the ids recorded on the sessions; IPs without one fall back to the allocator's table.
+        Missing objects are not an error.
+        returns: {ip: success}
+        """
+        classids = classids or {}
+        results: Dict[str, bool] = {}
+        commands: List[str] = []
+
+        for ip in ips:
+            classid = classids.get(ip)
+            if classid is None:
+                classid = self._classids.get(ip)
+            if classid is None:
+                # Never shaped (or already removed), nothing to do
+                results[ip] = True
+                continue
+
+            if self.config.debug_mode:
+                self._debug("remove", ip=ip, classid=f"1:{classid:x}")
+
+            commands.extend(self._remove_commands(ip, classid))
+            results[ip] = True
+
+        await self._run_batch(commands)
+
+        for ip in ips:
+            self._classids.release(ip)
+            location = self._u32_location(ip)
+            if self._u32_nodes.get(location) == ip:
+                del self._u32_nodes[location]
+        self._save_classids_later()
+        return results
+
+    async def adopt_traffic_shaping_rules(self, classids: Dict[str, int]) -> Dict[str, bool]:
+        """
+        Warm restart: takes over subscriber classes left in the kernel by the previous process instead of
+        re-creating them. A class is adopted if it exists on both interfaces and its classid is (or can
+        become) the IP's in the allocator.
+        returns: {ip: adopted}
+        """
+        existing = None
+        for iface in (self.config.subscriber_facing_interface, self.config.uplink_interface):
+            found = await tc_list_classids(iface)
+            existing = found if existing is None or found is None else existing & found
+            if existing is None:
+                break
+
+        results: Dict[str, bool] = {}
+        for ip, classid in classids.items():
+            location = self._u32_location(ip)
+            adopted = (
+                existing is not None
+                and classid in existing
+                and self._u32_nodes.get(location, ip) == ip
+                and self._classids.claim(ip, classid)
+            )
+            if adopted:
+                self._u32_nodes[location] = ip
+                # The classifier tables this subscriber's filter hangs off are already in place
+                octet3, _, _ = self._u32_location(ip)
+                self._u32_root_ready = True
+                self._u32_octet4_tables.add(octet3)
+            results[ip] = adopted
+
+        self._save_classids_later()
+        return results
+
+    def _save_classids_later(self) -> None:
+        # The table is O(subscribers) to write, so changes are collected and written off the event loop
+        if self._classid_save is None or self._classid_save.done():
+            self._classid_save = asyncio.get_running_loop().create_task(self._save_classids())
+
+    async def _save_classids(self) -> None:
+        while self._classids.dirty:
+            await asyncio.sleep(CLASSID_SAVE_DELAY_SECONDS)
+            try:
+                await self._classids.save_async()
+            except Exception as e:
+                print(f"Failed to save tc classids: {e}")
+                return
+
+    def close(self) -> None:
+        """Stops the background save and writes the classid table out; call on shutdown."""
+        if self._classid_save is not None:
+            self._classid_save.cancel()
+            self._classid_save = None
+        try:
+            self._classids.save()
+        except Exception as e:
+            print(f"Failed to save tc classids: {e}")
+
+    def shaped_ips(self) -> List[str]:
+        """returns: every IP holding a classid, including ones restored from a previous run"""
+        return self._classids.ips()
+
+    async def _remove_batch(self, removals: List[Tuple[str, int | None]]) -> List[bool]:
+        ips = [ip for ip, _ in removals]
+        results = await self.remove_traffic_shaping_rules(
+            ips, {ip: classid for ip, classid in removals if classid is not None}
         )
-        await self._cmd(f"tc class del dev {download_iface} classid 1:{handle} || true")
-        await self._cmd(f"tc class del dev {upload_iface} classid 1:{handle} || true")
+        return [results.get(ip, False) for ip in ips]
 
-        return True
+    async def remove_traffic_shaping_rule(self, *, ip: str, classid: int | None = None) -> bool:
+        return await self._removes.submit((ip, classid))
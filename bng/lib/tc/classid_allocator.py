@@ -0,0 +1,163 @@
+import asyncio
+import json
+import os
+import threading
+from typing import Dict, Iterable, List
+
+# HTB minor ids are 16 bit
+CLASSID_MAX = 0xffff
+
+
+class TcClassidAllocator:
+    """
+    Bitmap-backed allocator for per-subscriber HTB classids.
+
+    Classids are handed out per subscriber IP, independent of the address itself, so any number of
+    subscriber prefixes can share one BNG without two IPs landing on the same class. Freed ids are
+    reused (lowest free id first) and the ip -> classid table is persisted so a restarted BNG keeps
+    driving the classes that are already in the kernel.
+    """
+
+    def __init__(self, state_path: str | None = None, reserved: Iterable[int] = ()) -> None:
+        self.state_path = state_path
+        self._bitmap = bytearray((CLASSID_MAX + 1) // 8)
+        self._by_ip: Dict[str, int] = {}
+        self._reserved = {0, *reserved}
+        self._next_hint = 0
+        self._dirty = False
+        # Writes may run in worker threads; the newest table taken must be the one left on disk
+        self._write_lock = threading.Lock()
+        self._taken_version = 0
+        self._written_version = 0
+
+        for classid in self._reserved:
+            self._set(classid)
+
+        self._load()
+
+    def _is_set(self, classid: int) -> bool:
+        return bool(self._bitmap[classid >> 3] & (1 << (classid & 7)))
+
+    def _set(self, classid: int) -> None:
+        self._bitmap[classid >> 3] |= 1 << (classid & 7)
+
+    def _clear(self, classid: int) -> None:
+        self._bitmap[classid >> 3] &= ~(1 << (classid & 7)) & 0xff
+
+    def _load(self) -> None:
+        if not self.state_path or not os.path.exists(self.state_path):
+            return
+
+        try:
+            with open(self.state_path) as f:
+                data = json.load(f)
+        except (OSError, json.JSONDecodeError) as e:
+            print(f"TcClassidAllocator: ignoring unreadable state {self.state_path}: {e}")
+            return
+
+        for ip, classid in data.get("classids", {}).items():
+            if not isinstance(classid, int) or not 0 < classid <= CLASSID_MAX:
+                continue
+            if classid in self._reserved or self._is_set(classid):
+                continue
+            self._set(classid)
+            self._by_ip[ip] = classid
+
+        print(f"TcClassidAllocator: restored {len(self._by_ip)} classids from {self.state_path}")
+
+    @property
+    def dirty(self) -> bool:
+        return self._dirty
+
+    def _write(self, by_ip: Dict[str, int], version: int) -> None:
+        with self._write_lock:
+            if version <= self._written_version:
+                return # A newer table is already on disk
+
+            directory = os.path.dirname(self.state_path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+
+            tmp_path = f"{self.state_path}.tmp"
+            with open(tmp_path, "w") as f:
+                json.dump({"classids": by_ip}, f)
+            os.replace(tmp_path, self.state_path)
+            self._written_version = version
+
+    def save(self) -> None:
+        """Writes the table now, blocking the caller; for shutdown. Use `save_async` from the event loop."""
+        if not self.state_path or not self._dirty:
+            return
+        self._taken_version += 1
+        self._write(self._by_ip, self._taken_version)
+        self._dirty = False
+
+    async def save_async(self) -> None:
+        """Writes a copy of the table from a worker thread; changes made meanwhile leave it dirty again."""
+        if not self.state_path or not self._dirty:
+            return
+        by_ip = dict(self._by_ip)
+        self._taken_version += 1
+        self._dirty = False
+        try:
+            await asyncio.to_thread(self._write, by_ip, self._taken_version)
+        except BaseException:
+            self._dirty = True
+            raise
+
+    def get(self, ip: str) -> int | None:
+        return self._by_ip.get(ip)
+
+    def allocate(self, ip: str) -> int:
+        """Returns the IP's classid, allocating the lowest free one if it has none yet."""
+        classid = self._by_ip.get(ip)
+        if classid is not None:
+            return classid
+
+        # Scan a byte at a time from the lowest possibly-free position
+        for byte_idx in range(self._next_hint >> 3, len(self._bitmap)):
+            byte = self._bitmap[byte_idx]
+            if byte == 0xff:
+                continue
+            for bit in range(8):
+                if not byte & (1 << bit):
+                    classid = (byte_idx << 3) | bit
+                    break
+            break
+
+        if classid is None:
+            raise RuntimeError("tc classid space exhausted")
+
+        self._set(classid)
+        self._by_ip[ip] = classid
+        self._next_hint = classid + 1
+        self._dirty = True
+        return classid
+
+    def claim(self, ip: str, classid: int) -> bool:
+        """Records an existing class as the IP's, e.g. one found in the kernel. returns: False if taken"""
+        if self._by_ip.get(ip) == classid:
+            return True
+        if ip in self._by_ip or not 0 < classid <= CLASSID_MAX or self._is_set(classid):
+            return False
+
+        self._set(classid)
+        self._by_ip[ip] = classid
+        self._dirty = True
+        return True
+
+    def ips(self) -> List[str]:
+        return list(self._by_ip)
+
+    def release(self, ip: str) -> int | None:
+        classid = self._by_ip.pop(ip, None)
+        if classid is None:
+            return None
+
+        self._clear(classid)
+        self._next_hint = min(self._next_hint, classid)
+        self._dirty = True
+        return classid
+
+    def __len__(self) -> int:
+        return len(self._by_ip)
@@ -0,0 +1,155 @@
+import asyncio
+import re
+from typing import Dict, List, Set, Tuple
+
+_COMMAND_FAILED_RE = re.compile(r"Command failed (.*):(\d+)")
+_HTB_CLASS_RE = re.compile(r"^class htb 1:([0-9a-f]+) ", re.MULTILINE)
+
+# A device that never exists. `qdisc show` on it always fails, and with -force its
+# "Command failed -:N" line tells us every line up to N has been processed.
+_SYNC_DEVICE = "aether-sync0"
+
+
+class TcBatchClient:
+    """
+    One long-lived `tc -force -batch -` process fed over a pipe.
+
+    A batch of commands is written in one go followed by a sentinel command that is known to fail.
+    tc reports every failed line as "Command failed -:<line>" on stderr, so seeing the sentinel's line
+    means the whole batch was applied and any earlier failure lines belong to it.
+
+    If the channel dies or stalls, the batch is retried through a one-shot `tc -force -batch -`.
+    """
+
+    def __init__(self, timeout: float = 5.0) -> None:
+        self.timeout = timeout
+        self._proc: asyncio.subprocess.Process | None = None
+        self._reader: asyncio.Task | None = None
+        self._lock = asyncio.Lock()
+        self._lines_sent = 0
+        self._pending_errors: List[str] = []
+        self._failures: Dict[int, str] = {}
+        self._sync_line = 0
+        self._sync_event = asyncio.Event()
+
+    async def _start(self) -> None:
+        self._proc = await asyncio.create_subprocess_exec(
+            "tc", "-force", "-batch", "-",
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.DEVNULL,
+            stderr=asyncio.subprocess.PIPE,
+        )
+        self._lines_sent = 0
+        self._pending_errors = []
+        self._failures = {}
+        self._reader = asyncio.create_task(self._read_stderr(self._proc))
+
+    async def _read_stderr(self, proc: asyncio.subprocess.Process) -> None:
+        assert proc.stderr is not None
+        while True:
+            raw = await proc.stderr.readline()
+            if not raw:
+                break
+            line = raw.decode(errors="replace").strip()
+            m = _COMMAND_FAILED_RE.search(line)
+            if m is None:
+                if line:
+                    self._pending_errors.append(line)
+                continue
+
+            line_no = int(m.group(2))
+            self._failures[line_no] = "; ".join(self._pending_errors) or "unknown error"
+            self._pending_errors = []
+            if line_no == self._sync_line:
+                self._sync_event.set()
+        # Process exited, wake up anyone waiting for a sync that will never come
+        self._sync_event.set()
+
+    async def _close(self) -> None:
+        proc, self._proc = self._proc, None
+        if proc is not None and proc.returncode is None:
+            proc.kill()
+            await proc.wait()
+        if self._reader is not None:
+            self._reader.cancel()
+            self._reader = None
+
+    async def _run_channel(self, commands: List[str]) -> List[Tuple[int, str]]:
+        if self._proc is None or self._proc.returncode is not None:
+            await self._close()
+            await self._start()
+
+        assert self._proc is not None and self._proc.stdin is not None
+        first_line = self._lines_sent + 1
+        self._sync_line = first_line + len(commands)
+        self._sync_event.clear()
+
+        payload = "\n".join(commands + [f"qdisc show dev {_SYNC_DEVICE}"]) + "\n"
+        self._proc.stdin.write(payload.encode())
+        await self._proc.stdin.drain()
+        self._lines_sent = self._sync_line
+
+        await asyncio.wait_for(self._sync_event.wait(), timeout=self.timeout)
+        if self._sync_line not in self._failures:
+            raise RuntimeError("tc batch channel exited")
+
+        failures = []
+        for i in range(len(commands)):
+            error = self._failures.pop(first_line + i, None)
+            if error is not None:
+                failures.append((i, error))
+        self._failures.pop(self._sync_line, None)
+        return failures
+
+    async def _run_oneshot(self, commands: List[str]) -> List[Tuple[int, str]]:
+        proc = await asyncio.create_subprocess_exec(
+            "tc", "-force", "-batch", "-",
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.DEVNULL,
+            stderr=asyncio.subprocess.PIPE,
+        )
+        _, stderr = await proc.communicate(("\n".join(commands) + "\n").encode())
+
+        failures = []
+        pending_errors: List[str] = []
+        for line in (stderr or b"").decode(errors="replace").splitlines():
+            m = _COMMAND_FAILED_RE.search(line)
+            if m is None:
+                if line.strip():
+                    pending_errors.append(line.strip())
+                continue
+            idx = int(m.group(2)) - 1
+            if 0 <= idx < len(commands):
+                failures.append((idx, "; ".join(pending_errors) or "unknown error"))
+            pending_errors = []
+        return failures
+
+    async def run(self, commands: List[str]) -> List[Tuple[int, str]]:
+        """
+        Apply `commands` (tc arguments without the leading `tc`) as one batch.
+        returns: list of (index into commands, error) for every command that failed
+        """
+        if not commands:
+            return []
+
+        async with self._lock:
+            try:
+                return await self._run_channel(commands)
+            except Exception as e:
+                print(f"TcBatchClient: channel failed ({e!r}), retrying batch with one-shot tc")
+                await self._close()
+                return await self._run_oneshot(commands)
+
+
+async def tc_list_classids(iface: str) -> Set[int] | None:
+    """returns: minor ids of the HTB classes under 1: on `iface`, None if tc failed"""
+    proc = await asyncio.create_subprocess_exec(
+        "tc", "class", "show", "dev", iface,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+    )
+    stdout, stderr = await proc.communicate()
+    if proc.returncode != 0:
+        print(f"tc class show dev {iface} failed: {stderr.decode(errors='replace').strip()}")
+        return None
+    return {int(m, 16) for m in _HTB_CLASS_RE.findall(stdout.decode(errors="replace"))}
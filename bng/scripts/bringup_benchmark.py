@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+"""
+Time-to-all-online for N new subscribers: bulk bring-up (bring_up_sessions) against the per-session
+pipeline the reconciler used before (rules, SESSION_START, authorize_session, POLICY_APPLY in turn).
+
+Needs root, the lab's RADIUS server and Redis, nftables set up by nft_setup_accounting, and an HTB
+root (1: with class 1:1) on both interfaces. Subscribers RADIUS doesn't know are rejected and count
+as not online. Rules and classes are removed afterwards; the RADIUS accounting sessions stay open.
+
+Run from the bng directory:
+    python3 scripts/bringup_benchmark.py --sessions 5000 --mode bulk
+    python3 scripts/bringup_benchmark.py --sessions 5000 --mode sequential
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+import uuid
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import redis.asyncio as aioredis  # noqa: E402
+
+from lib.nftables.helpers import nft_delete_subscriber_rules, nft_flush_authed_ips, nft_remove_ip  # noqa: E402
+from lib.radius.session import DHCPSession  # noqa: E402
+from lib.secrets import __RADIUS_SECRET  # noqa: E402
+from lib.services.bng_session import authorize_session, install_rules_and_baseline  # noqa: E402
+from lib.services.event_dispatcher import BNGEventDispatcher, BNGEventDispatcherConfig  # noqa: E402
+from lib.services.session_bringup import bring_up_sessions  # noqa: E402
+from lib.services.traffic_shaper import BNGTrafficShaper, BNGTrafficShaperConfig  # noqa: E402
+
+
+def build_sessions(n: int, bng_id: str, iface: str) -> list[DHCPSession]:
+    now = time.time()
+    return [
+        DHCPSession(
+            mac="02:00:%02x:%02x:%02x:%02x" % ((i >> 24) & 0xFF, (i >> 16) & 0xFF, (i >> 8) & 0xFF, i & 0xFF),
+            ip="10.%d.%d.%d" % (64 + ((i >> 16) & 0x3F), (i >> 8) & 0xFF, i & 0xFF),
+            first_seen=now,
+            last_seen=now,
+            expiry=int(now) + 3600,
+            iface=iface,
+            hostname=None,
+            last_interim=now,
+            relay_id=bng_id,
+            remote_id="bench-%08x" % i,
+            circuit_id="1/0/%d" % i,
+            status="ACTIVE",
+        )
+        for i in range(n)
+    ]
+
+
+async def async_main() -> None:
+    parser = argparse.ArgumentParser(description="Bulk session bring-up benchmark")
+    parser.add_argument("--sessions", type=int, default=5000)
+    parser.add_argument("--mode", choices=("bulk", "sequential"), default="bulk")
+    parser.add_argument("--bng-id", default="bng-bringup-bench")
+    parser.add_argument("--radius-server-ip", default=os.getenv("BNG_RADIUS_SERVER_IP", "198.18.0.2"))
+    parser.add_argument("--nas-ip", default=os.getenv("BNG_NAS_IP", "198.18.0.1"))
+    parser.add_argument("--redis-host", default=os.getenv("BNG_REDIS_HOST", "198.18.0.10"))
+    parser.add_argument("--redis-port", type=int, default=int(os.getenv("REDIS_PORT", 6379)))
+    parser.add_argument("--iface", default="eth1")
+    parser.add_argument("--uplink-iface", default="eth2")
+    args = parser.parse_args()
+
+    redis_conn = aioredis.Redis(host=args.redis_host, port=args.redis_port)
+    event_dispatcher = BNGEventDispatcher(
+        config=BNGEventDispatcherConfig(
+            bng_id=args.bng_id,
+            bng_instance_id=str(uuid.uuid4()),
+            nas_ip=args.nas_ip,
+            redis_conn=redis_conn,
+        )
+    )
+    traffic_shaper = BNGTrafficShaper(
+        config=BNGTrafficShaperConfig(
+            bandwidth_limit=100000,
+            bng_id=args.bng_id,
+            bng_instance_id="bench",
+            subscriber_facing_interface=args.iface,
+            uplink_interface=args.uplink_iface,
+        )
+    )
+    sessions = build_sessions(args.sessions, args.bng_id, args.iface)
+
+    started = time.perf_counter()
+    if args.mode == "bulk":
+        await bring_up_sessions(
+            sessions,
+            iface=args.iface,
+            radius_server_ip=args.radius_server_ip,
+            radius_secret=__RADIUS_SECRET,
+            nas_ip=args.nas_ip,
+            nas_port_id=args.iface,
+            traffic_shaper=traffic_shaper,
+            event_dispatcher=event_dispatcher,
+        )
+    else:
+        for s in sessions:
+            await install_rules_and_baseline(s, s.ip, s.mac, args.iface)
+            await event_dispatcher.dispatch_session_start(s)
+            try:
+                await authorize_session(
+                    s,
+                    s.ip,
+                    s.mac,
+                    args.iface,
+                    args.radius_server_ip,
+                    __RADIUS_SECRET,
+                    args.nas_ip,
+                    args.iface,
+                    ensure_rules=True,
+                    traffic_shaper=traffic_shaper,
+                )
+            except Exception as e:
+                print(f"Access-Request failed for mac={s.mac} ip={s.ip}: {e}")
+            await event_dispatcher.dispatch_policy_apply(s)
+    await nft_flush_authed_ips()
+    elapsed = time.perf_counter() - started
+
+    online = sum(1 for s in sessions if s.auth_state == "AUTHORIZED")
+    print("| Mode | Sessions | Online | Seconds |")
+    print("|---|---|---|---|")
+    print(f"| {args.mode} | {args.sessions} | {online} | {elapsed:.2f} |")
+
+    await traffic_shaper.remove_traffic_shaping_rules(traffic_shaper.shaped_ips())
+    for s in sessions:
+        await nft_remove_ip(s.ip)
+        await nft_delete_subscriber_rules(s.ip, s.nft_up_handle, s.nft_down_handle)
+    await nft_flush_authed_ips()
+    await redis_conn.aclose()
+
+
+if __name__ == "__main__":
+    asyncio.run(async_main())
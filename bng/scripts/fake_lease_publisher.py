@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+"""
+Stand-in for Kea's lease event feed: simulates a pool of DHCP subscribers and publishes their
+lease4 add/update/expire/release events to the BNG's lease event stream in Redis.
+
+Run from the bng directory, against a BNG started with BNG_KEA_LEASE_EVENTS=1:
+    python3 scripts/fake_lease_publisher.py --relay-id bng-1 --subscribers 200 --lifetime 120
+"""
+import argparse
+import asyncio
+import ipaddress
+import os
+import random
+import sys
+import time
+
+import redis.asyncio as aioredis
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from lib.dhcp.lease_events import (  # noqa: E402
+    LEASE_EVENT_ADD,
+    LEASE_EVENT_EXPIRE,
+    LEASE_EVENT_RELEASE,
+    LEASE_EVENT_UPDATE,
+    LeaseEvent,
+    LeaseEventPublisher,
+    lease_event_stream,
+)
+
+
+class FakeSubscriber:
+    def __init__(self, index: int, relay_id: str) -> None:
+        self.circuit_id = f"fake-circuit-{index}"
+        self.remote_id = f"fake-remote-{index}"
+        self.relay_id = relay_id
+        self.mac = "02:fa:%02x:%02x:%02x:%02x" % ((index >> 24) & 0xFF, (index >> 16) & 0xFF, (index >> 8) & 0xFF, index & 0xFF)
+        self.ip: str | None = None
+        self.cltt = 0
+        self.valid_lft = 0
+        self.gone_until = 0.0 # Released/expired clients stay offline until then
+        self.vanished = False # Stopped renewing, the lease is left to expire
+
+    def event(self, kind: str, subnet_id: int) -> LeaseEvent:
+        assert self.ip is not None
+        return LeaseEvent(
+            kind=kind,
+            ip=self.ip,
+            mac=self.mac,
+            relay_id=self.relay_id,
+            circuit_id=self.circuit_id,
+            remote_id=self.remote_id,
+            cltt=self.cltt,
+            valid_lft=self.valid_lft,
+            subnet_id=subnet_id,
+        )
+
+
+async def run(args: argparse.Namespace) -> None:
+    redis_conn = aioredis.Redis(host=args.redis_host, port=args.redis_port)
+    await redis_conn.ping()
+    publisher = LeaseEventPublisher(redis_conn)
+
+    pool = [str(ip) for ip in ipaddress.ip_network(args.pool).hosts()]
+    if len(pool) < args.subscribers:
+        raise SystemExit(f"pool {args.pool} has {len(pool)} addresses, need {args.subscribers}")
+    free_ips = list(reversed(pool))
+    subscribers = [FakeSubscriber(i, args.relay_id) for i in range(args.subscribers)]
+    counts = {kind: 0 for kind in (LEASE_EVENT_ADD, LEASE_EVENT_UPDATE, LEASE_EVENT_EXPIRE, LEASE_EVENT_RELEASE)}
+    # Spacing between events so the feed is a steady trickle, not bursts
+    interval = 1.0 / args.rate if args.rate > 0 else 0.0
+
+    async def publish(sub: FakeSubscriber, kind: str) -> None:
+        await publisher.publish(sub.event(kind, args.subnet_id))
+        counts[kind] += 1
+        if interval:
+            await asyncio.sleep(interval)
+
+    print(f"Publishing fake lease events for {args.subscribers} subscribers to {lease_event_stream(args.relay_id)}")
+    started = time.time()
+    last_report = started
+
+    while args.duration <= 0 or time.time() - started < args.duration:
+        now = time.time()
+        for sub in subscribers:
+            if sub.ip is None:
+                if now < sub.gone_until or not free_ips:
+                    continue
+                sub.ip = free_ips.pop()
+                sub.cltt, sub.valid_lft = int(now), args.lifetime
+                await publish(sub, LEASE_EVENT_ADD)
+                continue
+
+            if now >= sub.cltt + sub.valid_lft:
+                await publish(sub, LEASE_EVENT_EXPIRE)
+            elif not sub.vanished and now >= sub.cltt + sub.valid_lft / 2:
+                if random.random() >= args.churn:
+                    # Renew at T1, like a real client
+                    sub.cltt = int(now)
+                    await publish(sub, LEASE_EVENT_UPDATE)
+                    continue
+                if random.random() < 0.5:
+                    await publish(sub, LEASE_EVENT_RELEASE)
+                else:
+                    sub.vanished = True
+                    continue
+            else:
+                continue
+
+            free_ips.insert(0, sub.ip)
+            sub.ip = None
+            sub.vanished = False
+            sub.gone_until = now + random.uniform(0, args.lifetime)
+
+        if now - last_report >= 10:
+            last_report = now
+            active = sum(1 for sub in subscribers if sub.ip is not None)
+            print(f"active={active} " + " ".join(f"{kind}={count}" for kind, count in counts.items()))
+        await asyncio.sleep(1)
+
+    await redis_conn.close()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Fake Kea lease event publisher")
+    parser.add_argument("--relay-id", required=True, help="relay_id (the BNG id) whose stream to publish to")
+    parser.add_argument("--redis-host", default=os.getenv("BNG_REDIS_HOST", "198.18.0.10"))
+    parser.add_argument("--redis-port", type=int, default=int(os.getenv("REDIS_PORT", 6379)))
+    parser.add_argument("--pool", default="10.0.1.0/24", help="address pool to lease from")
+    parser.add_argument("--subnet-id", type=int, default=1)
+    parser.add_argument("--subscribers", type=int, default=50)
+    parser.add_argument("--lifetime", type=int, default=120, help="valid-lft in seconds")
+    parser.add_argument("--churn", type=float, default=0.05, help="chance a client leaves instead of renewing")
+    parser.add_argument("--rate", type=float, default=0, help="max events per second, 0 for unlimited")
+    parser.add_argument("--duration", type=float, default=0, help="seconds to run, 0 for forever")
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+"""
+Cost of the event loop's own machinery per item, with no-op handlers:
+- tasks: the loop before the mailbox. A PriorityQueue for events and a Queue for commands, with a
+  get() task created for each, asyncio.wait on both and the loser cancelled, every iteration.
+- mailbox: one Mailbox with an event and a command channel, drained `--drain` items per wakeup.
+
+Two load shapes:
+- backlog: every item is queued before the loop starts, as after a burst
+- paced: a producer queues one item and yields, so the loop wakes for almost every item
+
+Needs nothing but Python. Run from the bng directory:
+    python3 scripts/mailbox_benchmark.py --items 200000
+"""
+import argparse
+import asyncio
+import contextlib
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from lib.mailbox import COMMAND_PRIORITY, Mailbox  # noqa: E402
+
+COMMAND_EVERY = 10  # One command per this many DHCP events
+
+
+def items(n: int):
+    for seq in range(n):
+        if seq % COMMAND_EVERY == 0:
+            yield "command", ("reconcile", {})
+        else:
+            yield "event", (1, seq, {"event": "dhcp", "msg_type": 5})
+
+
+async def run_tasks(n: int, paced: bool) -> float:
+    event_queue: asyncio.PriorityQueue = asyncio.PriorityQueue()
+    command_queue: asyncio.Queue = asyncio.Queue()
+
+    async def produce() -> None:
+        for kind, item in items(n):
+            (command_queue if kind == "command" else event_queue).put_nowait(item)
+            if paced:
+                await asyncio.sleep(0)
+
+    async def consume() -> None:
+        handled = 0
+        while handled < n:
+            event_get = asyncio.create_task(event_queue.get())
+            command_get = asyncio.create_task(command_queue.get())
+            done, pending = await asyncio.wait({event_get, command_get}, return_when=asyncio.FIRST_COMPLETED)
+            for task in pending:
+                task.cancel()
+                with contextlib.suppress(asyncio.CancelledError):
+                    await task
+            handled += len(done)
+
+    return await timed(produce, consume, paced)
+
+
+async def run_mailbox(n: int, paced: bool, drain: int) -> float:
+    mailbox = Mailbox()
+    event_queue = mailbox.channel()
+    command_queue = mailbox.channel(priority=COMMAND_PRIORITY)
+
+    async def produce() -> None:
+        for kind, item in items(n):
+            (command_queue if kind == "command" else event_queue).put_nowait(item)
+            if paced:
+                await asyncio.sleep(0)
+
+    async def consume() -> None:
+        handled = 0
+        while handled < n:
+            handled += len(await mailbox.get_batch(drain))
+
+    return await timed(produce, consume, paced)
+
+
+async def timed(produce, consume, paced: bool) -> float:
+    started = time.perf_counter()
+    if paced:
+        await asyncio.gather(produce(), consume())
+    else:
+        await produce()
+        await consume()
+    return time.perf_counter() - started
+
+
+async def async_main() -> None:
+    parser = argparse.ArgumentParser(description="Event loop machinery microbenchmark")
+    parser.add_argument("--items", type=int, default=200000)
+    parser.add_argument("--drain", type=int, default=64)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    print("| Loop | Load | µs per item |")
+    print("|---|---|---|")
+    for paced in (False, True):
+        runs = [
+            ("tasks", lambda: run_tasks(args.items, paced)),
+            ("mailbox, 1 per wakeup", lambda: run_mailbox(args.items, paced, 1)),
+            (f"mailbox, {args.drain} per wakeup", lambda: run_mailbox(args.items, paced, args.drain)),
+        ]
+        for name, run in runs:
+            best = min([await run() for _ in range(args.repeat)])
+            print(f"| {name} | {'paced' if paced else 'backlog'} | {best / args.items * 1e6:.2f} |")
+
+
+if __name__ == "__main__":
+    asyncio.run(async_main())
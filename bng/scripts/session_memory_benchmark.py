@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+"""
+Per-subscriber memory of the BNG's session table: SessionStore with its by-IP and by-session-id
+maps, against the previous layout (a plain dataclass session in three dicts).
+
+Run from the bng directory:
+    python3 scripts/session_memory_benchmark.py --sizes 10000 100000
+"""
+import argparse
+import gc
+import os
+import sys
+import time
+import tracemalloc
+import uuid
+from dataclasses import dataclass, field
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from lib.radius.session import DHCPSession  # noqa: E402
+from lib.services.session_store import SessionStore  # noqa: E402
+
+
+@dataclass
+class BaselineSession:
+    # The session record before it was packed: same fields, a plain dataclass
+    mac: str | None
+    ip: str | None
+    first_seen: float
+    last_seen: float
+    expiry: int | None
+    iface: str
+    hostname: str | None
+    last_interim: float | None
+    relay_id: str
+    remote_id: str
+    circuit_id: str
+    session_id: str = field(default_factory=lambda: str(uuid.uuid4()))
+    qos_download_kbit: int | None = None
+    qos_upload_kbit: int | None = None
+    qos_download_burst_kbit: int | None = None
+    qos_upload_burst_kbit: int | None = None
+    tc_classid: int | None = None
+    nft_up_handle: int | None = None
+    nft_down_handle: int | None = None
+    base_up_bytes: int = 0
+    base_down_bytes: int = 0
+    base_up_pkts: int = 0
+    base_down_pkts: int = 0
+    last_up_bytes: int | None = None
+    last_down_bytes: int | None = None
+    last_traffic_seen_ts: float | None = None
+    last_idle_ts: float | None = None
+    status: str = "PENDING"
+    auth_state: str = "PENDING_AUTH"
+    auth_retry_attempts: int = 0
+    last_status_change_ts: float | None = None
+    dhcp_nak_count: int = 0
+
+
+BNG_ID = "bng-1"
+IFACE = "eth1"
+
+
+def subscriber(i: int) -> dict:
+    # Fresh identifier strings per subscriber, like values decoded from a sniffed packet
+    return dict(
+        mac="02:00:%02x:%02x:%02x:%02x" % ((i >> 24) & 0xFF, (i >> 16) & 0xFF, (i >> 8) & 0xFF, i & 0xFF),
+        ip="10.%d.%d.%d" % ((i >> 16) & 0xFF, (i >> 8) & 0xFF, i & 0xFF),
+        first_seen=time.time(),
+        last_seen=time.time(),
+        expiry=int(time.time()) + 3600,
+        iface=IFACE,
+        hostname=None,
+        last_interim=None,
+        relay_id=BNG_ID,
+        remote_id="cpe-%08x" % i,
+        circuit_id="olt-1/port-%d:%d" % (i // 4096, i % 4096),
+        status="ACTIVE",
+        auth_state="AUTHORIZED",
+        qos_download_kbit=100000,
+        qos_upload_kbit=20000,
+        tc_classid=i + 2,
+        nft_up_handle=2 * i + 10,
+        nft_down_handle=2 * i + 11,
+    )
+
+
+def build_baseline(n: int):
+    sessions, by_ip, by_session_id = {}, {}, {}
+    for i in range(n):
+        s = BaselineSession(**subscriber(i))
+        sessions[(s.relay_id, s.circuit_id, s.remote_id)] = s
+        by_ip[s.ip] = s
+        by_session_id[s.session_id] = s
+    return sessions, by_ip, by_session_id
+
+
+def build_store(n: int):
+    store = SessionStore()
+    for i in range(n):
+        s = DHCPSession(**subscriber(i))
+        store[(s.relay_id, s.circuit_id, s.remote_id)] = s
+        store.by_ip[s.ip] = s
+        store.by_session_id[s.session_id] = s
+    return store
+
+
+def measure(build, n: int) -> int:
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    table = build(n)
+    gc.collect()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del table
+    return after - before
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Session table memory benchmark")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000])
+    args = parser.parse_args()
+
+    print("| Sessions | Baseline bytes/session | SessionStore bytes/session | Reduction |")
+    print("|---|---|---|---|")
+    for n in args.sizes:
+        baseline = measure(build_baseline, n)
+        packed = measure(build_store, n)
+        print(f"| {n} | {baseline / n:.0f} | {packed / n:.0f} | {100 * (1 - packed / baseline):.0f}% |")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+"""
+Standby takeover time, stage by stage, for N synthetic authorized subscribers:
+- journal: the active BNG writes its session table to Redis (SessionJournal's first flush)
+- resync: the standby loads it back into sessions (SessionReplica.resync)
+- nft: the standby installs accounting rules in bulk (install_accounting), after which subscribers forward
+- tc: the standby re-creates their HTB classes in one batch (install_shaping)
+
+Needs root, a Redis, nftables set up by nft_setup_accounting, and an HTB root (1: with class 1:1)
+on both interfaces, as tools/config_pipeline.py creates. Everything installed is removed again.
+
+Run from the bng directory:
+    python3 scripts/takeover_benchmark.py --sessions 10000 --iface eth1 --uplink-iface eth2
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+import uuid
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import redis.asyncio as aioredis  # noqa: E402
+
+from lib.nftables.helpers import nft_delete_subscriber_rules  # noqa: E402
+from lib.radius.session import DHCPSession  # noqa: E402
+from lib.services.session_replication import (  # noqa: E402
+    SessionJournal,
+    SessionReplica,
+    install_accounting,
+    install_shaping,
+    session_journal_stream,
+    session_journal_table,
+)
+from lib.services.session_store import SessionStore  # noqa: E402
+from lib.services.traffic_shaper import BNGTrafficShaper, BNGTrafficShaperConfig  # noqa: E402
+
+BNG_ID = "bng-takeover-bench"
+
+
+def build_sessions(n: int) -> SessionStore:
+    store = SessionStore()
+    now = time.time()
+    for i in range(n):
+        s = DHCPSession(
+            mac="02:00:%02x:%02x:%02x:%02x" % ((i >> 24) & 0xFF, (i >> 16) & 0xFF, (i >> 8) & 0xFF, i & 0xFF),
+            ip="10.%d.%d.%d" % (64 + ((i >> 16) & 0x3F), (i >> 8) & 0xFF, i & 0xFF),
+            first_seen=now,
+            last_seen=now,
+            expiry=int(now) + 3600,
+            iface="eth1",
+            hostname=None,
+            last_interim=now,
+            relay_id=BNG_ID,
+            remote_id="cpe-%08x" % i,
+            circuit_id="olt-1/port-%d:%d" % (i // 4096, i % 4096),
+            status="ACTIVE",
+            auth_state="AUTHORIZED",
+            qos_download_kbit=100000,
+            qos_upload_kbit=20000,
+            last_up_bytes=1000 * i,
+            last_down_bytes=5000 * i,
+        )
+        store[(s.relay_id, s.circuit_id, s.remote_id)] = s
+    return store
+
+
+async def bench_journal(redis_conn: aioredis.Redis, store: SessionStore) -> tuple[dict, SessionReplica]:
+    timings = {}
+    store.track_changes()
+    journal = SessionJournal(redis_conn, BNG_ID, str(uuid.uuid4()))
+
+    started = time.perf_counter()
+    await journal.flush(store)
+    timings["journal"] = time.perf_counter() - started
+
+    replica = SessionReplica(redis_conn, BNG_ID)
+    started = time.perf_counter()
+    await replica.resync()
+    timings["resync"] = time.perf_counter() - started
+    return timings, replica
+
+
+async def bench_install(sessions: list[DHCPSession], iface: str, uplink_iface: str, nft: bool, tc: bool) -> dict:
+    timings = {}
+    shaper = BNGTrafficShaper(
+        config=BNGTrafficShaperConfig(
+            bandwidth_limit=100000,
+            bng_id=BNG_ID,
+            bng_instance_id="bench",
+            subscriber_facing_interface=iface,
+            uplink_interface=uplink_iface,
+        )
+    )
+
+    installed = sessions
+    if nft:
+        started = time.perf_counter()
+        installed, failed = await install_accounting(sessions, iface)
+        timings["nft"] = time.perf_counter() - started
+        print(f"nft: {len(installed)}/{len(sessions)} subscribers installed")
+
+    if tc:
+        started = time.perf_counter()
+        failed_shaping = await install_shaping(installed, shaper)
+        timings["tc"] = time.perf_counter() - started
+        print(f"tc: {len(installed) - failed_shaping}/{len(installed)} subscribers shaped")
+
+        started = time.perf_counter()
+        await shaper.remove_traffic_shaping_rules(shaper.shaped_ips())
+        timings["tc cleanup"] = time.perf_counter() - started
+
+    if nft:
+        for s in installed:
+            await nft_delete_subscriber_rules(s.ip, s.nft_up_handle, s.nft_down_handle)
+    return timings
+
+
+async def async_main() -> None:
+    parser = argparse.ArgumentParser(description="Standby takeover benchmark")
+    parser.add_argument("--sessions", type=int, default=10000)
+    parser.add_argument("--redis-host", default=os.getenv("BNG_REDIS_HOST", "127.0.0.1"))
+    parser.add_argument("--redis-port", type=int, default=int(os.getenv("REDIS_PORT", 6379)))
+    parser.add_argument("--iface", default="eth1")
+    parser.add_argument("--uplink-iface", default="eth2")
+    parser.add_argument("--skip-redis", action="store_true", help="install straight from the synthetic table")
+    parser.add_argument("--skip-nft", action="store_true")
+    parser.add_argument("--skip-tc", action="store_true")
+    args = parser.parse_args()
+
+    store = build_sessions(args.sessions)
+    timings = {}
+    sessions = list(store.values())
+
+    if not args.skip_redis:
+        redis_conn = aioredis.Redis(host=args.redis_host, port=args.redis_port)
+        try:
+            journal_timings, replica = await bench_journal(redis_conn, store)
+            timings.update(journal_timings)
+            sessions = list(replica.sessions.values())
+        finally:
+            await redis_conn.delete(session_journal_stream(BNG_ID), session_journal_table(BNG_ID))
+            await redis_conn.aclose()
+
+    timings.update(await bench_install(sessions, args.iface, args.uplink_iface, not args.skip_nft, not args.skip_tc))
+
+    print(f"| Stage | Seconds ({args.sessions} sessions) |")
+    print("|---|---|")
+    for stage, seconds in timings.items():
+        print(f"| {stage} | {seconds:.3f} |")
+    takeover = sum(seconds for stage, seconds in timings.items() if stage in ("resync", "nft", "tc"))
+    print(f"| standby takeover (resync + nft + tc) | {takeover:.3f} |")
+
+
+if __name__ == "__main__":
+    asyncio.run(async_main())
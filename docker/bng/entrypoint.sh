@@ -66,7 +66,8 @@ nft delete table inet aether_auth 2>/dev/null || true
 nft delete table inet bngacct 2>/dev/null || true
 nft add table inet aether_auth 2>/dev/null || true
 nft add table inet bngacct 2>/dev/null || true
-nft "add set inet aether_auth authed_ips { type ipv4_addr; }" 2>/dev/null || true
+# Elements carry the DHCP lease lifetime as timeout, expired subscribers stop forwarding in-kernel
+nft "add set inet aether_auth authed_ips { type ipv4_addr; flags timeout; }" 2>/dev/null || true
 nft "add chain inet aether_auth forward { type filter hook forward priority -10; policy drop; }" 2>/dev/null || true
 nft "add rule inet aether_auth forward ct state established,related accept" 2>/dev/null || true
 # Allow ICMP through for PMTU discovery (frag needed), ping, traceroute